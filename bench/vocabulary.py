@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+'''
+Compares the lookups in a Vocabulary with the ones in the dictionary that it
+replaces: python bench/vocabulary.py [n_words] [n_lookups]
+'''
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from corputils.core.vocabulary import Vocabulary, compile_vocabulary
+
+def main():
+    n_words = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    n_lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 200000
+    words = ['w{0}-n'.format(i) for i in xrange(n_words)]
+    ids = dict((w, i) for i, w in enumerate(words))
+    data = compile_vocabulary(words)
+    rnd = random.Random(0)
+    #zipfian lookups, 10% of them of absent words
+    queries = [words[min(int(rnd.paretovariate(1.0)) - 1, n_words - 1)] if
+        rnd.random() < 0.9 else 'x{0}'.format(rnd.randint(0, n_words)) for _ in
+        xrange(n_lookups)]
+    def cold():
+        #a new vocabulary (and cache) each time
+        vocabulary = Vocabulary(data)
+        return [vocabulary.get_id(w) for w in queries]
+    vocabulary = Vocabulary(data)
+    vocabulary_ids = vocabulary.ids
+    cases = [
+        ('dict.get', lambda: [ids.get(w) for w in queries]),
+        ('get_id (cold cache)', cold),
+        ('get_id', lambda: [vocabulary.get_id(w) for w in queries]),
+        ('get_ids', lambda: vocabulary.get_ids(queries)),
+        ('in + ids[]', lambda: [vocabulary_ids[w] for w in queries if w in
+            vocabulary]),
+        ('in + dict[]', lambda: [ids[w] for w in queries if w in ids]),
+    ]
+    for name, func in cases:
+        t = min(timeit.repeat(func, number=1, repeat=5))
+        print '{0:<20} {1:8.1f} ns/lookup'.format(name, t * 1e9 / n_lookups)
+
+if __name__ == '__main__':
+    main()
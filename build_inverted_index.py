@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import sys
+
+from corputils.core.inverted_index import build_inverted_index
+from corputils.core.sentence_index import ensure_sentence_index
+logging.basicConfig(level=logging.INFO)
+
+def main():
+    parser = argparse.ArgumentParser(description=
+    '''Builds a sidecar inverted index with the sentences in which every
+    word, lemma and pos of (uncompressed) parsed corpora occurs, along with
+    their sentence index, so that dpgrep.py --index only parses the
+    sentences that contain the words required by a query''')
+    parser.add_argument('corpora', help='files with the parsed corpora',
+        nargs='+')
+    parser.add_argument('-s', dest='separator', default='s', help="sentence "
+    "separator (default=s)")
+
+    args = parser.parse_args()
+
+    for corpus in args.corpora:
+        ensure_sentence_index(corpus, args.separator)
+        build_inverted_index(corpus, args.separator)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print >>sys.stderr, 'Aborting!'
+        sys.exit(1)
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import sys
+
+from corputils.core.sentence_index import build_sentence_index
+logging.basicConfig(level=logging.INFO)
+
+def main():
+    parser = argparse.ArgumentParser(description=
+    '''Builds a sidecar index with the byte offsets of the sentence and text
+    boundaries of (uncompressed) parsed corpora, so that they can be read
+    from any sentence on (see the --parts option of parallel_count.py)''')
+    parser.add_argument('corpora', help='files with the parsed corpora',
+        nargs='+')
+    parser.add_argument('-s', dest='separator', default='s', help="sentence "
+    "separator (default=s)")
+
+    args = parser.parse_args()
+
+    for corpus in args.corpora:
+        build_sentence_index(corpus, args.separator)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print >>sys.stderr, 'Aborting!'
+        sys.exit(1)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import sys
+
+from corputils.core.aux import open_corpora
+from corputils.core.compiled import compile_corpus
+logging.basicConfig(level=logging.INFO)
+
+def main():
+    parser = argparse.ArgumentParser(description=
+    '''Compiles a dependency parsed corpus into a binary format that can be
+    read without parsing it again (see the --compiled option of
+    print_cooccurrences.py, dpgrep.py and parallel_count.py)''')
+    parser.add_argument('corpora', help='files with the parsed corpora',
+        default="-", nargs='*')
+    parser.add_argument('-o', '--output', required=True,
+        help='directory where the compiled corpus is written')
+    parser.add_argument('-z', '--gzip', action='store_true', default=False,
+    help="Interpret corpora as gzipped files (otherwise, gzip, bz2 and xz "
+    "files are detected by their extension)")
+    parser.add_argument('-s', dest='separator', default='s', help="sentence "
+    "separator (default=s)")
+
+    args = parser.parse_args()
+
+    input_corpora = open_corpora(args.corpora, gzip=args.gzip)
+
+    compile_corpus(input_corpora, args.output, separator=args.separator)
+
+if __name__ == '__main__':
+    try:
+        main()
+    except KeyboardInterrupt:
+        print >>sys.stderr, 'Aborting!'
+        sys.exit(1)
@@ -8,8 +8,13 @@ logger = logging.getLogger()
 
 import argparse
 import fileinput
+import heapq
 import os
+import re
+import struct
 import sys
+import tempfile
+import zlib
 try:
     import sqlite3
 except ImportError:
@@ -22,7 +27,14 @@ try:
     filterwarnings('ignore', category = MySQLdb.Warning)
 except ImportError:
     logger.warn("Cannot use MySql to store counts: MySQLdb not available")
-from itertools import repeat, islice
+try:
+    import numpy
+except ImportError:
+    numpy = None
+from array import array
+from itertools import islice, groupby
+from multiprocessing.connection import Listener, Client
+from kyototycoon import KyotoTycoon, KyotoTycoonError
 from threading import Thread, RLock
 import operator
 
@@ -35,7 +47,48 @@ MYSQL_HOST='localhost'
 MYSQL_USER='root'
 MYSQL_PASS='root'
 MYSQL_PORT=3306
+#connections (and partitions of each dump) of a MySQLDestination
+MYSQL_CONNECTIONS = 4
+#attempts to merge a partition when MySQL detects a deadlock
+MYSQL_RETRIES = 5
+KYOTO_SERVERS = 'localhost:1978'
+#number of increments sent to a Kyoto Tycoon server in each request
+KYOTO_BATCH = 10000
+#number of requests sent to a server before reading their replies
+KYOTO_PIPELINE = 8
 BATCH_SIZE = 100
+#estimated bytes taken by a record besides its strings: the key tuple, the
+#count and the slots of the dictionary (which is at most 2/3 full, and can be
+#half empty after growing)
+RECORD_OVERHEAD = sys.getsizeof(('', '')) + sys.getsizeof(1 << 20) + \
+    3 * 3 * struct.calcsize('P')
+#estimated bytes taken by a record of a CompactSparseCounter (a key and a
+#count in arrays, or in a dictionary of integers without numpy)
+if numpy is not None:
+    COMPACT_RECORD_SIZE = 2 * 8
+else:
+    COMPACT_RECORD_SIZE = 2 * sys.getsizeof(1 << 40) + \
+        3 * 3 * struct.calcsize('P')
+#bits of the id of w2 in the keys of a CompactSparseCounter
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+#bytes taken by a key buffered by CompactCounts
+BUFFERED_KEY_SIZE = 8
+#maximum number of keys buffered by a CompactSparseCounter before reducing
+#them (unless it already has more distinct records)
+MIN_BUFFER = 1 << 20
+#fraction of its distinct records that a CompactSparseCounter buffers at
+#least, so that reducing them costs O(1) per key even close to the limits
+MIN_BUFFER_FRACTION = 8
+#lengths of the pivot and the context and count of a record of a run
+RUN_RECORD = struct.Struct('<IIq')
+#maximum number of runs merged at once
+MERGE_FAN_IN = 64
+#number of records that a SqliteWriter coalesces before saving them (unless
+#-m or --memory-budget are given)
+WRITER_MANY = 1000000
+#number of pairs sent at once to a SqliteWriter
+WRITER_CHUNK = 10000
 #FIXME: put in unicode o
 def main():
     parser = argparse.ArgumentParser(description=
@@ -57,10 +110,21 @@ def main():
     parser.add_argument('-r', '--rows', help='filter pivots')
     parser.add_argument('-m', '--many', help='number of records needed to '
                         'start dumping', type=int, default=MANY)
+    parser.add_argument('--compact', action='store_true', default=False,
+                        help='keep the counts in memory as integer ids of the '
+                        'words, which takes several times less memory per '
+                        'record')
+    parser.add_argument('--memory-budget', type=parse_size, default=None,
+                        help='estimated memory (in bytes, or with a K, M, G '
+                        'or T suffix, e.g. 4G) that the counts can take before '
+                        'dumping the largest ones')
     parser.add_argument('-b','--batch-size', help='size of batchs inserted '
                         'into the DB', type=int, default=BATCH_SIZE)
-    parser.add_argument('-e', '--db-engine', help="Destination format", 
-                        choices=['mysql', 'sqlite', 'text'], default='text')
+    parser.add_argument('-e', '--db-engine', help="Destination format "
+                        "(default: text, or sqlite with --serve-sqlite and "
+                        "--sqlite-writer)",
+                        choices=['mysql', 'sqlite', 'text', 'runs', 'kyoto'],
+                        default=None)
     parser.add_argument('--asynchronic', dest='synchronic', 
                         help='continue counting while saving',
                         action='store_false', default=True)
@@ -69,9 +133,42 @@ def main():
     parser.add_argument('-H', '--mysql_hostname', help='MYSQL hostname', default=MYSQL_HOST)
     parser.add_argument('-P', '--mysql_port', help='MySQL port', default=MYSQL_PORT, 
                         type=int)
+    parser.add_argument('--kyoto-servers', default=KYOTO_SERVERS,
+                        help='comma separated host:port of the Kyoto Tycoon '
+                        'servers among which the counts are sharded (default: '
+                        '{0})'.format(KYOTO_SERVERS))
+    parser.add_argument('--mysql-connections', type=int,
+                        default=MYSQL_CONNECTIONS, help='number of connections '
+                        'that save the partitions of each dump in parallel')
+    parser.add_argument('--sqlite-ids', action='store_true', default=False,
+                        help='store the SQLite counts with integer ids of the '
+                        'pivots and contexts (see SqliteCounts)')
+    parser.add_argument('--sqlite-context-index', action='store_true',
+                        default=False, help='index the SQLite counts by '
+                        'context too, for column-wise queries')
+    parser.add_argument('--sqlite-writer', metavar='ADDRESS', help='send the '
+                        'SQLite counts to the writer process listening on the '
+                        'given unix socket (see --serve-sqlite), instead of '
+                        'writing them to the DBs')
+    parser.add_argument('--serve-sqlite', metavar='ADDRESS', help='instead of '
+                        'counting, run as the single writer of the SQLite DBs '
+                        'in the output directory, receiving the counts of the '
+                        'counters started with --sqlite-writer ADDRESS')
+    parser.add_argument('--clients', type=int, default=None, help='number of '
+                        'counters after which the writer exits (by default, '
+                        'it runs until it is interrupted)')
     #TODO: add option to customize dense or sparse
 
     args = parser.parse_args()
+    if args.serve_sqlite and args.sqlite_writer:
+        parser.error("--serve-sqlite and --sqlite-writer are exclusive")
+    if args.serve_sqlite or args.sqlite_writer:
+        if args.db_engine not in (None, 'sqlite'):
+            parser.error("--serve-sqlite and --sqlite-writer can only be "
+                         "used with the sqlite engine")
+        args.db_engine = 'sqlite'
+    elif args.db_engine is None:
+        args.db_engine = 'text'
     if args.verbose == 0:
         logger.setLevel(logging.ERROR)
     if args.verbose == 1:
@@ -105,24 +202,70 @@ def main():
     if args.db_engine == 'mysql':
         per_output_db = args.output_dir +  '_peripheral'
         core_output_db = args.output_dir + '_core'
-        per_dest = MySQLDestination(args.hostname, args.port, args.user, args.passwd, 
-                          per_output_db, ['cc'], args.batch_size)
-        core_dest = MySQLDestination(args.hostname, args.port, args.user, args.passwd, 
-                          core_output_db, ['cc'], args.batch_size)
+        per_dest = MySQLDestination(args.mysql_hostname, args.mysql_port,
+                                    args.mysql_user, args.mysql_passwd,
+                                    per_output_db, ['c'], args.batch_size,
+                                    args.mysql_connections)
+        core_dest = MySQLDestination(args.mysql_hostname, args.mysql_port,
+                                     args.mysql_user, args.mysql_passwd,
+                                     core_output_db, ['c'], args.batch_size,
+                                     args.mysql_connections)
+    elif args.db_engine == 'sqlite' and args.sqlite_writer:
+        writer_client = SqliteWriterClient(args.sqlite_writer)
+        per_dest = SqliteWriterDestination(writer_client, 'peripheral')
+        core_dest = SqliteWriterDestination(writer_client, 'core')
     elif args.db_engine == 'sqlite':
         per_output_db = os.path.join(args.output_dir, 'peripheral.db')
         core_output_db = os.path.join(args.output_dir, 'core.db')
-        per_dest = SqliteDestination(per_output_db, args.batch_size)
-        core_dest = SqliteDestination(core_output_db, args.batch_size)
+        per_dest = SqliteDestination(per_output_db, args.batch_size,
+                                     args.sqlite_ids,
+                                     args.sqlite_context_index)
+        core_dest = SqliteDestination(core_output_db, args.batch_size,
+                                      args.sqlite_ids,
+                                      args.sqlite_context_index)
     elif args.db_engine == 'text':
         per_output_db = os.path.join(args.output_dir, 'peripheral')
         core_output_db = os.path.join(args.output_dir, 'core')
         per_dest = TextDestination(per_output_db)
         core_dest = TextDestination(core_output_db)
+    elif args.db_engine == 'kyoto':
+        #peripheral pivots have the compose op, so they do not clash with the
+        #core ones
+        kyoto_servers = parse_servers(args.kyoto_servers)
+        per_dest = KyotoDestination(kyoto_servers)
+        core_dest = KyotoDestination(kyoto_servers)
+    elif args.db_engine == 'runs':
+        per_output_db = os.path.join(args.output_dir, 'peripheral')
+        core_output_db = os.path.join(args.output_dir, 'core')
+        per_dest = RunsDestination(per_output_db)
+        core_dest = RunsDestination(core_output_db)
         
+    if args.memory_budget:
+        memory_budget = MemoryBudget(args.memory_budget)
+    else:
+        memory_budget = None
+    if args.serve_sqlite:
+        destinations = {'core': core_dest, 'peripheral': per_dest}
+        if args.many == MANY and not memory_budget:
+            many = WRITER_MANY
+        else:
+            many = args.many
+        with core_dest, per_dest:
+            SqliteWriter(destinations, many, memory_budget).serve(
+                args.serve_sqlite, args.clients)
+        return
+    if args.compact:
+        if numpy is None:
+            logger.warn("numpy not available: compact counts are kept in "
+                        "dictionaries")
+        counter_type = CompactSparseCounter
+    else:
+        counter_type = SparseCounter
     with core_dest, per_dest:
-        core = SparseCounter(core_dest, args.many, args.synchronic)
-        per = SparseCounter(per_dest, args.many, args.synchronic)
+        core = counter_type(core_dest, args.many, args.synchronic,
+                            memory_budget)
+        per = counter_type(per_dest, args.many, args.synchronic,
+                           memory_budget)
 
         with Timer() as t_counting:
             try: 
@@ -158,8 +301,43 @@ def main():
     logger.info("Finished at {0}".format(str(time.strftime("%d-%m-%Y %H:%M:%S"))))
         
         
+def parse_size(size):
+    '''Parses a number of bytes with an optional K, M, G or T suffix'''
+    units = 'KMGT'
+    size = size.strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * 1024 ** (units.index(size[-1]) + 1))
+    return int(size)
+
+def record_size(w1, w2):
+    '''Estimated bytes taken in memory by the count of a (w1, w2) pair'''
+    return sys.getsizeof(w1) + sys.getsizeof(w2) + RECORD_OVERHEAD
+
+class MemoryBudget():
+    '''
+    Memory (in bytes) that the counts of several SparseCounters can take.
+    When their estimated size exceeds it, the largest one is dumped.
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.counters = []
+
+    def add(self, counter):
+        self.counters.append(counter)
+
+    def used(self):
+        return sum(counter.n_bytes for counter in self.counters)
+
+    def check(self):
+        if self.used() >= self.limit:
+            largest = max(self.counters, key=lambda counter: counter.n_bytes)
+            if len(largest):
+                logger.info('memory budget exceeded')
+                largest.dump()
+
 class SparseCounter():
-    def __init__(self, output_destination, many, synchronic):
+    def __init__(self, output_destination, many, synchronic,
+                 memory_budget=None):
         self.coocurrences = {}
         self.coocurrences_lock = RLock()
         self.saving_thread = None
@@ -167,25 +345,99 @@ class SparseCounter():
         self.output_destination = output_destination
         self.many = many
         self.synchronic = synchronic
-        self.i = 0
+        #number of records and their estimated size in bytes (in total and
+        #for each marker), updated as they are counted and dumped
+        self.n_records = 0
+        self.n_bytes = 0
+        self.marker_bytes = {}
+        self.memory_budget = memory_budget
+        if memory_budget is not None:
+            memory_budget.add(self)
     
+    def get_marker_coocurrences(self, marker):
+        marker_coocurrences = self.coocurrences.get(marker)
+        if marker_coocurrences is None:
+            marker_coocurrences = self.coocurrences[marker] = {}
+            self.marker_bytes[marker] = 0
+        return marker_coocurrences
+
     def count(self, w1, marker, w2):
         with self.coocurrences_lock:
-            if marker not in self.coocurrences:
-                self.coocurrences[marker] = {}
-            marker_coocurrences = self.coocurrences[marker]
-            if (w1,w2) not in marker_coocurrences:
-                marker_coocurrences[(w1,w2)] = 0
-            marker_coocurrences[(w1,w2)] += 1
-            if self.i % 100 == 0:
-                if self.synchronic:
-                    self.check_dump_sync()
+            marker_coocurrences = self.get_marker_coocurrences(marker)
+            key = (w1,w2)
+            if key in marker_coocurrences:
+                marker_coocurrences[key] += 1
+                return
+            marker_coocurrences[key] = 1
+            size = record_size(w1, w2)
+            self.n_records += 1
+            self.n_bytes += size
+            self.marker_bytes[marker] += size
+        #only new records can make a dump necessary
+        self.check_limits()
+
+    def add_counts(self, marker, items):
+        '''Adds ((w1, w2), count) items, such as the counts of other counter'''
+        with self.coocurrences_lock:
+            marker_coocurrences = self.get_marker_coocurrences(marker)
+            size = 0
+            for key, c in items:
+                if key in marker_coocurrences:
+                    marker_coocurrences[key] += c
                 else:
-                    self.check_dump()
-                self.i = 0
+                    marker_coocurrences[key] = c
+                    self.n_records += 1
+                    size += record_size(*key)
+            self.n_bytes += size
+            self.marker_bytes[marker] += size
+        self.check_limits()
+
+    def check_limits(self):
+        if self.n_records >= self.many:
+            if self.synchronic:
+                self.check_dump_sync()
+            else:
+                self.check_dump()
+        if self.memory_budget is not None:
+            self.memory_budget.check()
     
     def __len__(self):
-        return sum([len(mc) for mc in self.coocurrences.itervalues()])
+        return self.n_records
+
+    def pop_marker(self, marker):
+        '''Removes the counts of a marker from the counter and returns them'''
+        with self.coocurrences_lock:
+            marker_coocurrences = self.coocurrences.pop(marker)
+            self.n_records -= len(marker_coocurrences)
+            self.n_bytes -= self.marker_bytes.pop(marker)
+        return marker_coocurrences
+
+    def pop_coocurrences(self):
+        '''
+        Removes all the counts from the counter and returns them (a
+        dictionary of marker to counts)
+        '''
+        with self.coocurrences_lock:
+            coocurrences = self.coocurrences
+            self.coocurrences = {}
+            self.n_records = 0
+            self.n_bytes = 0
+            self.marker_bytes = {}
+        return coocurrences
+
+    def dump(self):
+        '''
+        Dumps the counts (in a thread, unless synchronic), whatever their
+        number
+        '''
+        if self.synchronic:
+            self.save()
+            return
+        with self.saving_thread_lock:
+            if not self.saving_thread:
+                logger.info('asking for DB dump')
+                self.saving_thread = Thread(target=self.run_dump)
+                self.saving_thread.start()
     
     def check_dump(self):
         '''Checks whether counts in memory are already too many and a 
@@ -234,8 +486,230 @@ class SparseCounter():
                                                       t_save.interval, 
                                                       N/t_save.interval))
         
+class CompactSparseCounter(SparseCounter):
+    '''
+    A SparseCounter that keeps the pairs as integer keys packing the ids of
+    their words (see CompactCounts) instead of tuples of strings. With
+    numpy, the keys are buffered and n_records only counts the distinct
+    pairs found when they are reduced, so the buffers are reduced before
+    checking the limits.
+    '''
+    def __init__(self, *args, **kwargs):
+        SparseCounter.__init__(self, *args, **kwargs)
+        self.new_vocabulary()
+        #number of keys buffered by all the markers, and how many can be
+        #buffered before reducing them (see get_buffer_limit)
+        self.n_buffered = 0
+        self.buffer_limit = self.get_buffer_limit()
+
+    def new_vocabulary(self):
+        '''
+        Starts a new vocabulary for the pairs counted from now on, which
+        frees the words of the dumped ones (their CompactCounts keep a
+        reference to the old vocabulary while they are saved)
+        '''
+        self.words = []
+        self.ids = {}
+        self.words_bytes = 0
+
+    def get_id(self, word):
+        i = self.ids.get(word)
+        if i is None:
+            i = self.ids[word] = len(self.words)
+            self.words.append(word)
+            self.words_bytes += sys.getsizeof(word) + RECORD_OVERHEAD
+        return i
+
+    def count(self, w1, marker, w2):
+        with self.coocurrences_lock:
+            marker_counts = self.coocurrences.get(marker)
+            if marker_counts is None:
+                marker_counts = self.coocurrences[marker] = \
+                    CompactCounts(self.words, self.ids)
+            key = self.get_id(w1) << ID_BITS | self.get_id(w2)
+            if numpy is None:
+                if not marker_counts.add(key):
+                    return
+                self.n_records += 1
+            else:
+                marker_counts.add(key)
+                self.n_buffered += 1
+                if self.n_buffered < self.buffer_limit:
+                    self.n_bytes += BUFFERED_KEY_SIZE
+                    return
+                self.reduce()
+            self.update_size()
+        self.check_limits()
+
+    def get_buffer_limit(self):
+        '''
+        Returns the number of keys that can be buffered: up to MIN_BUFFER (or
+        as many as the distinct records), but not more than the ones that
+        could reach the limits if they were all new (unless that is less
+        than 1/MIN_BUFFER_FRACTION of the distinct records)
+        '''
+        limit = min(max(MIN_BUFFER, self.n_records), self.many -
+            self.n_records)
+        if self.memory_budget is not None:
+            limit = min(limit, (self.memory_budget.limit -
+                self.memory_budget.used()) // (COMPACT_RECORD_SIZE +
+                BUFFERED_KEY_SIZE))
+        return max(limit, self.n_records // MIN_BUFFER_FRACTION, 1)
+
+    def reduce(self):
+        '''Reduces the buffered keys of all the markers'''
+        with self.coocurrences_lock:
+            self.n_records = sum(len(counts) for counts in
+                self.coocurrences.itervalues())
+            self.n_buffered = 0
+            self.update_size()
+            self.buffer_limit = self.get_buffer_limit()
+
+    def update_size(self):
+        self.n_bytes = self.words_bytes + self.n_records * \
+            COMPACT_RECORD_SIZE + self.n_buffered * BUFFERED_KEY_SIZE
+
+    def __len__(self):
+        #the buffered keys count, so that the counter is only empty when
+        #everything has been saved
+        return self.n_records + self.n_buffered
+
+    def pop_marker(self, marker):
+        with self.coocurrences_lock:
+            marker_counts = self.coocurrences.pop(marker)
+            if not self.coocurrences:
+                self.new_vocabulary()
+            self.n_records = sum(counts.n_records for counts in
+                self.coocurrences.itervalues())
+            self.n_buffered = sum(counts.n_buffered() for counts in
+                self.coocurrences.itervalues())
+            self.update_size()
+            self.buffer_limit = self.get_buffer_limit()
+        return marker_counts
+
+    def pop_coocurrences(self):
+        with self.coocurrences_lock:
+            coocurrences = self.coocurrences
+            self.coocurrences = {}
+            self.new_vocabulary()
+            self.n_records = 0
+            self.n_buffered = 0
+            self.update_size()
+            self.buffer_limit = self.get_buffer_limit()
+        return coocurrences
+
+class CompactCounts():
+    '''
+    Counts of the pairs of a marker of a CompactSparseCounter, which can be
+    read as a dictionary of (w1, w2) to counts. With numpy, the keys of the
+    pairs are appended to a buffer that is sorted and reduced into arrays of
+    distinct keys and their counts when the counter asks for it, or when
+    they are read. Otherwise, they are counted in a dictionary of integers.
+    '''
+    def __init__(self, words, ids):
+        self.words = words
+        self.ids = ids
+        #number of distinct keys (without the buffered ones)
+        self.n_records = 0
+        if numpy is not None:
+            self.keys = numpy.zeros(0, dtype=numpy.int64)
+            self.counts = numpy.zeros(0, dtype=numpy.int64)
+            self.buffer = array('l')
+        else:
+            self.key_counts = {}
+
+    def add(self, key):
+        '''
+        Counts a key. Without numpy, returns whether it is a new one (with
+        numpy, it is buffered until the counts are reduced).
+        '''
+        if numpy is None:
+            key_counts = self.key_counts
+            if key in key_counts:
+                key_counts[key] += 1
+                return False
+            key_counts[key] = 1
+            self.n_records += 1
+            return True
+        self.buffer.append(key)
+
+    def n_buffered(self):
+        return len(self.buffer) if numpy is not None else 0
+
+    def reduce(self):
+        '''Merges the buffered keys into the arrays of distinct keys'''
+        if numpy is None or not self.buffer:
+            return
+        buffered = numpy.frombuffer(self.buffer, dtype=numpy.int64)
+        keys = numpy.concatenate((self.keys, buffered))
+        counts = numpy.concatenate((self.counts,
+            numpy.ones(len(buffered), dtype=numpy.int64)))
+        order = numpy.argsort(keys, kind='mergesort')
+        keys = keys[order]
+        counts = counts[order]
+        starts = numpy.flatnonzero(numpy.concatenate(([True],
+            keys[1:] != keys[:-1])))
+        self.keys = keys[starts]
+        self.counts = numpy.add.reduceat(counts, starts)
+        self.buffer = array('l')
+        self.n_records = len(self.keys)
+
+    def encode(self, (w1, w2)):
+        return self.ids[w1] << ID_BITS | self.ids[w2]
+
+    def decode(self, key):
+        return self.words[key >> ID_BITS], self.words[key & ID_MASK]
+
+    def __len__(self):
+        self.reduce()
+        return self.n_records
+
+    def iteritems(self):
+        self.reduce()
+        if numpy is None:
+            key_counts = self.key_counts.iteritems()
+        else:
+            key_counts = zip(self.keys.tolist(), self.counts.tolist())
+        for key, count in key_counts:
+            yield self.decode(key), count
+
+    def items(self):
+        return list(self.iteritems())
+
+    def __getitem__(self, pair):
+        self.reduce()
+        key = self.encode(pair)
+        if numpy is None:
+            return self.key_counts[key]
+        k = numpy.searchsorted(self.keys, key)
+        if k == len(self.keys) or self.keys[k] != key:
+            raise KeyError(pair)
+        return int(self.counts[k])
+
+    def __setitem__(self, pair, count):
+        '''Sets the count of a pair that has already been counted'''
+        self.reduce()
+        key = self.encode(pair)
+        if numpy is None:
+            if key not in self.key_counts:
+                raise KeyError(pair)
+            self.key_counts[key] = count
+            return
+        k = numpy.searchsorted(self.keys, key)
+        if k == len(self.keys) or self.keys[k] != key:
+            raise KeyError(pair)
+        self.counts[k] = count
+
 class MySQLDestination():
-    def __init__(self, host, port, user, passwd, output_db, tables, batch_size ):
+    '''
+    Saves the counts into MySQL tables (one per marker). Each dump is split
+    in partitions by the hash of the pivots, which are written to temporary
+    TSV files and merged in parallel (by a pool of connections) with LOAD
+    DATA LOCAL INFILE into a staging table and a single upsert, so that the
+    connections update disjoint sets of rows.
+    '''
+    def __init__(self, host, port, user, passwd, output_db, tables, batch_size,
+                 n_connections=MYSQL_CONNECTIONS):
         self.output_db = output_db
         self.tables = tables
         self.host = host
@@ -243,116 +717,239 @@ class MySQLDestination():
         self.passwd = passwd
         self.port = port
         self.batch_size = batch_size
+        self.n_connections = n_connections
         
-    def __enter__(self):
-        self.conn = MySQLdb.connect(host=self.host, user=self.user, 
-                                    passwd=self.passwd, port=self.port)
-        cur = self.conn.cursor()
+    def connect(self):
+        conn = MySQLdb.connect(host=self.host, user=self.user,
+                               passwd=self.passwd, port=self.port,
+                               charset='utf8', local_infile=1)
+        cur = conn.cursor()
         cur.execute("CREATE SCHEMA IF NOT EXISTS `{0}` DEFAULT CHARACTER SET utf8 ;".format(self.output_db))
         cur.execute("USE {0}".format(self.output_db))
         cur.execute("SET autocommit = 0;")
+        cur.close()
+        return conn
+
+    def __enter__(self):
+        self.conns = [self.connect() for _ in xrange(self.n_connections)]
         for table in self.tables:
-            cur.execute(
-                    """CREATE  TABLE IF NOT EXISTS `{0}` (
-                      `pivot` VARCHAR(150) NOT NULL ,
-                      `context` VARCHAR(150) NOT NULL ,
-                      `occurrences` INT NULL ,
-                      PRIMARY KEY (`pivot`, `context`) ) 
-                      ENGINE = InnoDB;""".format(table))
+            self.create_table(table)
         return self
 
+    def create_table(self, table):
+        cur = self.conns[0].cursor()
+        cur.execute(
+                """CREATE  TABLE IF NOT EXISTS `{0}` (
+                  `pivot` VARCHAR(150) NOT NULL ,
+                  `context` VARCHAR(150) NOT NULL ,
+                  `occurrences` INT NULL ,
+                  PRIMARY KEY (`pivot`, `context`) ) 
+                  ENGINE = InnoDB;""".format(table))
+        cur.close()
+
     def __exit__(self, *args):
-        self.conn.close()
+        for conn in self.conns:
+            conn.close()
         
     def __str__(self):
         return self.output_db
     
     def save(self, counter):
         #keeps a copy and frees the counter
-        coocurrences_copy = {}
-        with counter.coocurrences_lock:
-            for marker in counter.coocurrences.keys():
-                coocurrences_copy[marker] = counter.coocurrences[marker]
-                del counter.coocurrences[marker]
-
-        cur = self.conn.cursor()
-        #repeats in case of deadlock
-        while coocurrences_copy:
-            for marker in coocurrences_copy.keys():
-                marker_coocurrences = coocurrences_copy[marker]             
-                marker_table = '{0}'.format(marker)
-                query = "insert into {0} values( %s, %s ,%s) " \
-                    "on duplicate key update "\
-                    "`occurrences` = `occurrences` + VALUES(`occurrences`);" \
-                    .format(marker_table)
-                
-                #sort to prevent deadlocks (still, they happen)
-                insert_values = ((w1,w2,c) for (w1,w2),c in \
-                                sorted(marker_coocurrences.iteritems(),
-                                       key=operator.itemgetter(0)))
-                for insert_values_chunk in \
-                    split_every(self.batch_size, insert_values.items()):
-                    saved = False
-                    while not saved:
-                        try:
-                            self.conn.begin()
-                            cur.executemany(query, insert_values_chunk)
-                            self.conn.commit()
-                            saved = True
-                        except MySQLdb.OperationalError, ex:
-                            #1213:deadlock detected
-                            #1205: lock timeout
-                            if ex.args[0] == 1213:
-                                #shit happens, we'll try again in the future
-                                logger.warning("DEADLOCK detected, retrying")
-                            elif  ex.args[0] == 1205:
-                                #shit happens, we'll try again in the future
-                                logger.warning("TIMEOUT detected, retrying")
-                            else:
-                                raise
-                    del coocurrences_copy[marker]
-        cur.close()
+        coocurrences_copy = counter.pop_coocurrences()
 
-class KyotoDestination():
-    def __init__(self, output):
-        self.output = output
-        
-    def __enter__(self):
-        #ensures file exists
+        for marker, marker_coocurrences in coocurrences_copy.iteritems():
+            marker_table = '{0}'.format(marker)
+            self.create_table(marker_table)
+            tsv_files = write_partitions(marker_coocurrences.iteritems(),
+                len(self.conns))
+            #the errors of each thread, re-raised here
+            errors = []
+            threads = [Thread(target=self.merge_partition, args=(conn,
+                marker_table, tsv_file, errors)) for conn, tsv_file in
+                zip(self.conns, tsv_files)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if errors:
+                logger.error("Failed to save the counts of {0} into {1} (left "
+                    "in {2})".format(marker, self.output_db, ', '.join(
+                    tsv_file for tsv_file in tsv_files if
+                    os.path.exists(tsv_file))))
+                exc_type, exc_value, exc_traceback = errors[0]
+                raise exc_type, exc_value, exc_traceback
+
+    def merge_partition(self, conn, marker_table, tsv_file, errors):
+        '''
+        Adds the counts of a TSV file to a table, through a staging table, and
+        removes the file. The exc_info of an error is appended to errors.
+        '''
+        staging_table = 'staging_{0}'.format(marker_table)
+        cur = conn.cursor()
         try:
-            os.makedirs(os.path.dirname(self.output))
-        except OSError:
-            #ok
-            pass
+            for attempt in xrange(MYSQL_RETRIES):
+                try:
+                    cur.execute("CREATE TEMPORARY TABLE IF NOT EXISTS {0} "
+                                "LIKE {1}".format(staging_table, marker_table))
+                    cur.execute("DELETE FROM {0}".format(staging_table))
+                    self.load_staging(cur, staging_table, tsv_file)
+                    cur.execute("INSERT INTO {0} SELECT pivot, context, "
+                                "occurrences FROM {1} ORDER BY pivot, context "
+                                "ON DUPLICATE KEY UPDATE `{0}`.`occurrences` "
+                                "= `{0}`.`occurrences` + VALUES(`occurrences`)"
+                                .format(marker_table, staging_table))
+                    conn.commit()
+                    os.remove(tsv_file)
+                    return
+                except MySQLdb.OperationalError, ex:
+                    conn.rollback()
+                    #1213:deadlock detected
+                    #1205: lock timeout
+                    if ex.args[0] not in (1213, 1205) or \
+                        attempt == MYSQL_RETRIES - 1:
+                        raise
+                    logger.warning("{0} detected, retrying".format(
+                        "DEADLOCK" if ex.args[0] == 1213 else "TIMEOUT"))
+                    time.sleep(2 ** attempt)
+        except MySQLdb.Error:
+            logger.exception("Cannot merge {0} into {1}".format(tsv_file,
+                marker_table))
+            errors.append(sys.exc_info())
+        finally:
+            cur.close()
+
+    def load_staging(self, cur, staging_table, tsv_file):
+        try:
+            cur.execute("LOAD DATA LOCAL INFILE %s INTO TABLE {0} CHARACTER "
+                        "SET utf8 (pivot, context, occurrences)".format(
+                        staging_table), (tsv_file,))
+        except (MySQLdb.OperationalError, MySQLdb.ProgrammingError), ex:
+            #1148, 3948: LOAD DATA LOCAL disabled by the server or the client
+            if ex.args[0] not in (1148, 3948):
+                raise
+            logger.warning("LOAD DATA LOCAL not allowed, inserting the "
+                           "counts instead")
+            query = "INSERT INTO {0} VALUES(%s, %s, %s)".format(staging_table)
+            for insert_values_chunk in split_every(self.batch_size,
+                read_tsv(tsv_file)):
+                cur.executemany(query, insert_values_chunk)
+
+def escape_tsv(s):
+    '''Escapes a field for the (default) format of LOAD DATA'''
+    return encode_utf8(s).replace('\\', '\\\\').replace('\t', '\\t')\
+        .replace('\n', '\\n')
+
+TSV_ESCAPES = {'n': '\n', 't': '\t'}
 
+def unescape_tsv(s):
+    return re.sub(r'\\(.)', lambda m: TSV_ESCAPES.get(m.group(1), m.group(1)),
+        s)
+
+def write_partitions(items, n):
+    '''
+    Writes ((w1, w2), count) items to n temporary TSV files, partitioned by
+    the hash of w1. Returns the files.
+    '''
+    partitions = [tempfile.NamedTemporaryFile(suffix='.tsv', delete=False)
+        for _ in xrange(n)]
+    for (w1, w2), c in items:
+        w1 = escape_tsv(w1)
+        partitions[zlib.crc32(w1) % n].write('{0}\t{1}\t{2}\n'.format(w1,
+            escape_tsv(w2), c))
+    for partition in partitions:
+        partition.close()
+    return [partition.name for partition in partitions]
+
+def read_tsv(tsv_file):
+    '''Yields the (w1, w2, count) rows of a TSV file of counts'''
+    with open(tsv_file) as f:
+        for line in f:
+            w1, w2, c = line.rstrip('\n').split('\t')
+            yield unescape_tsv(w1), unescape_tsv(w2), int(c)
+
+class KyotoDestination():
+    '''
+    Adds the counts to Kyoto Tycoon servers with the incrementbulk procedure
+    of kyototycoon_ext.lua (the servers must be started with "ktserver -scr
+    kyototycoon_ext.lua"). The keys are the strings "marker\tpivot\tcontext"
+    and their values the counts, stored by the server as 8-byte big-endian
+    integers. The keys are sharded among the servers by the hash of their
+    pivot, and the batches sent to each server are pipelined.
+    '''
+    def __init__(self, servers, batch_size=KYOTO_BATCH):
+        '''
+        servers: list of (host, port) of the servers
+        batch_size: number of increments sent in each request
+        '''
+        self.servers = servers
+        self.batch_size = batch_size
+
+    def __enter__(self):
+        self.shards = [KyotoTycoon(host, port, lazy=False) for host, port in
+            self.servers]
         return self
 
     def __exit__(self, *args):
-        pass
+        for shard in self.shards:
+            shard.close()
     
     def __str__(self):
-        return self.output_folder
+        return ','.join('{0}:{1}'.format(host, port) for host, port in
+            self.servers)
+
+    def get_shard(self, pivot):
+        '''Returns the server of the keys of a pivot'''
+        return zlib.crc32(pivot) % len(self.shards)
     
     def save(self, counter):
         #keeps a copy and frees the counter
-        coocurrences_copy = {}
-        with counter.coocurrences_lock:
-            for marker in counter.coocurrences.keys():
-                coocurrences_copy[marker] = counter.coocurrences[marker]
-                del counter.coocurrences[marker]
+        coocurrences_copy = counter.pop_coocurrences()
 
-        for marker in coocurrences_copy.keys():
-            marker_coocurrences = coocurrences_copy[marker]             
-            marker_file = os.path.join(self.output_folder, marker)
-            
-            insert_values = ((w1,w2,c) for (w1,w2),c in \
-                            sorted(marker_coocurrences.iteritems(),
-                                   key=operator.itemgetter(0)))
-            #with portalocker.Lock(marker_file, truncate=None) as out:
-            with open(marker_file, 'a') as out:
-                for values in insert_values:
-                    out.write('{0}\t{1}\t{2}\n'.format(*values))
-            del coocurrences_copy[marker]
+        n_shards = len(self.shards)
+        batches = [[] for _ in xrange(n_shards)]
+        #number of requests sent to each server without reading their reply
+        pending = [0] * n_shards
+        def send(k):
+            shard = self.shards[k]
+            if pending[k] >= KYOTO_PIPELINE:
+                self.check_reply(shard)
+                pending[k] -= 1
+            shard.send_play_script('incrementbulk', batches[k])
+            pending[k] += 1
+            batches[k] = []
+
+        for marker, marker_coocurrences in coocurrences_copy.iteritems():
+            marker = encode_utf8(marker)
+            for (w1, w2), c in marker_coocurrences.iteritems():
+                w1 = encode_utf8(w1)
+                k = self.get_shard(w1) if n_shards > 1 else 0
+                batches[k].append(('\t'.join((marker, w1, encode_utf8(w2))),
+                    str(c)))
+                if len(batches[k]) >= self.batch_size:
+                    send(k)
+        for k in xrange(n_shards):
+            if batches[k]:
+                send(k)
+            for _ in xrange(pending[k]):
+                self.check_reply(self.shards[k])
+
+    def check_reply(self, shard):
+        try:
+            shard.read_play_script()
+        except KyotoTycoonError:
+            logger.error("incrementbulk failed in {0}:{1} (is "
+                         "kyototycoon_ext.lua loaded?)".format(shard.host,
+                         shard.port))
+            raise
+
+def parse_servers(servers):
+    '''Parses a comma separated list of host:port'''
+    parsed = []
+    for server in servers.split(','):
+        host, _, port = server.strip().rpartition(':')
+        parsed.append((host or 'localhost', int(port)))
+    return parsed
 
 class TextDestination():
     def __init__(self, output_folder):
@@ -375,17 +972,14 @@ class TextDestination():
     
     def save(self, counter):
         #keeps a copy and frees the counter
-        coocurrences_copy = {}
-        with counter.coocurrences_lock:
-            for marker in counter.coocurrences.keys():
-                coocurrences_copy[marker] = counter.coocurrences[marker]
-                del counter.coocurrences[marker]
+        coocurrences_copy = counter.pop_coocurrences()
 
         for marker in coocurrences_copy.keys():
             marker_coocurrences = coocurrences_copy[marker]             
             marker_file = os.path.join(self.output_folder, marker)
             
-            insert_values = ((w1,w2,c) for (w1,w2),c in \
+            insert_values = ((encode_utf8(w1),encode_utf8(w2),c) for \
+                            (w1,w2),c in \
                             sorted(marker_coocurrences.iteritems(),
                                    key=operator.itemgetter(0)))
             #with portalocker.Lock(marker_file, truncate=None) as out:
@@ -396,10 +990,236 @@ class TextDestination():
 
         
 
+class RunsDestination(TextDestination):
+    '''
+    Writes each dump as a sorted binary run per marker and, when exiting,
+    merges the runs of each marker into a text file (as TextDestination)
+    with one line per pair, in order
+    '''
+    def __init__(self, output_folder):
+        TextDestination.__init__(self, output_folder)
+        self.runs_folder = os.path.join(output_folder, 'runs')
+        self.runs = {}
+        self.n_runs = 0
+
+    def __enter__(self):
+        try:
+            os.makedirs(self.runs_folder)
+        except OSError:
+            #ok
+            pass
+        return self
+
+    def __exit__(self, exc_type, *args):
+        #runs are kept if counting failed
+        if exc_type is None:
+            self.merge()
+
+    def save(self, counter):
+        #keeps a copy and frees the counter
+        coocurrences_copy = counter.pop_coocurrences()
+
+        for marker, marker_coocurrences in coocurrences_copy.iteritems():
+            self.add_run(marker, write_run(self.get_run_file(marker),
+                marker_coocurrences.iteritems()))
+
+    def get_run_file(self, marker):
+        self.n_runs += 1
+        return os.path.join(self.runs_folder, '{0}.{1}'.format(marker,
+            self.n_runs))
+
+    def add_run(self, marker, run_file):
+        self.runs.setdefault(marker, []).append(run_file)
+
+    def merge(self):
+        '''Merges the runs of each marker into its text file'''
+        for marker, runs in self.runs.iteritems():
+            #merges them in several passes if they are too many to be
+            #opened at once
+            while len(runs) > MERGE_FAN_IN:
+                merged = write_run(self.get_run_file(marker),
+                    merge_runs(runs[:MERGE_FAN_IN]), presorted=True)
+                for run_file in runs[:MERGE_FAN_IN]:
+                    os.remove(run_file)
+                runs[:MERGE_FAN_IN] = []
+                self.add_run(marker, merged)
+            logger.info("Merging {0} runs of {1}".format(len(runs), marker))
+            marker_file = os.path.join(self.output_folder, marker)
+            with open(marker_file, 'w') as out:
+                for (w1, w2), c in merge_runs(runs):
+                    out.write('{0}\t{1}\t{2}\n'.format(w1, w2, c))
+            for run_file in runs:
+                os.remove(run_file)
+        self.runs = {}
+        try:
+            os.rmdir(self.runs_folder)
+        except OSError:
+            pass
+
+class SqliteWriter():
+    '''
+    Single writer of the SQLite DBs of several counter processes, which send
+    it their dumps through a unix socket (see SqliteWriterDestination). The
+    dumps are coalesced in a SparseCounter per DB, which is saved in the
+    background. The counters never wait for the DB locks, only for the
+    writer if it falls behind.
+    '''
+    def __init__(self, destinations, many, memory_budget=None):
+        '''
+        destinations: dictionary of the name of each DB (e.g. "core") to its
+        SqliteDestination
+        '''
+        self.counters = dict((name, SparseCounter(destination, many, False,
+            memory_budget)) for name, destination in destinations.iteritems())
+
+    def serve(self, address, n_clients=None):
+        '''
+        Receives counts until n_clients counters have finished (or forever)
+        and saves the ones left
+        '''
+        listener = Listener(address, 'AF_UNIX')
+        logger.info('Waiting for counters at {0}'.format(address))
+        threads = []
+        try:
+            while n_clients is None or len(threads) < n_clients:
+                conn = listener.accept()
+                thread = Thread(target=self.receive, args=(conn,))
+                thread.daemon = True
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            logger.info('Writer interrupted')
+        finally:
+            listener.close()
+            for counter in self.counters.itervalues():
+                counter.join()
+                while len(counter)>0:
+                    counter.save()
+
+    def receive(self, conn):
+        '''Adds the counts sent by a counter until it finishes'''
+        try:
+            while True:
+                message = conn.recv()
+                if message[0] == 'close':
+                    break
+                _, name, marker, items = message
+                counter = self.counters[name]
+                #backpressure: waits for the save in progress before
+                #taking more counts
+                if len(counter) >= 2 * counter.many:
+                    counter.join()
+                counter.add_counts(marker, items)
+        except EOFError:
+            logger.warning('A counter disconnected before finishing')
+        finally:
+            conn.close()
+
+class SqliteWriterClient():
+    '''
+    Connection of a counter process to a SqliteWriter, shared by its
+    destinations
+    '''
+    def __init__(self, address):
+        self.address = address
+        self.lock = RLock()
+        self.conn = None
+        self.users = 0
+
+    def open(self):
+        with self.lock:
+            if self.conn is None:
+                self.conn = Client(self.address, 'AF_UNIX')
+            self.users += 1
+
+    def close(self):
+        with self.lock:
+            self.users -= 1
+            if not self.users:
+                self.conn.send(('close',))
+                self.conn.close()
+                self.conn = None
+
+    def send(self, name, marker, items):
+        '''Sends ((w1, w2), count) items of a marker to a DB of the writer'''
+        with self.lock:
+            for chunk in split_every(WRITER_CHUNK, items):
+                self.conn.send(('counts', name, marker, chunk))
+
+class SqliteWriterDestination():
+    '''Sends the dumps to a DB of a SqliteWriter'''
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def __enter__(self):
+        self.client.open()
+        return self
+
+    def __exit__(self, *args):
+        self.client.close()
+
+    def __str__(self):
+        return '{0}:{1}'.format(self.client.address, self.name)
+
+    def save(self, counter):
+        #keeps a copy and frees the counter
+        coocurrences_copy = counter.pop_coocurrences()
+        for marker, marker_coocurrences in coocurrences_copy.iteritems():
+            self.client.send(self.name, marker,
+                marker_coocurrences.iteritems())
+
+def encode_utf8(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+def write_run(run_file, items, presorted=False):
+    '''
+    Writes ((w1, w2), count) items to a run file, sorted by the utf-8 bytes of
+    the pairs, as records of their lengths and count followed by the pair.
+    Returns the run file.
+    '''
+    records = ((encode_utf8(w1), encode_utf8(w2), c) for (w1, w2), c in items)
+    if not presorted:
+        records = sorted(records)
+    with open(run_file, 'wb') as f:
+        for chunk in split_every(10000, records):
+            f.write(''.join([RUN_RECORD.pack(len(w1), len(w2), c) + w1 + w2
+                for w1, w2, c in chunk]))
+    return run_file
+
+def read_run(run_file):
+    '''Yields the ((w1, w2), count) items of a run file'''
+    with open(run_file, 'rb') as f:
+        while True:
+            header = f.read(RUN_RECORD.size)
+            if not header:
+                break
+            len1, len2, c = RUN_RECORD.unpack(header)
+            pair = f.read(len1 + len2)
+            yield (pair[:len1], pair[len1:]), c
+
+def merge_runs(run_files):
+    '''
+    Yields the ((w1, w2), count) items of several runs in order, with the
+    counts of the same pair summed
+    '''
+    merged = heapq.merge(*[read_run(run_file) for run_file in run_files])
+    for pair, items in groupby(merged, operator.itemgetter(0)):
+        yield pair, sum(c for _, c in items)
+
 class SqliteDestination():
-    def __init__(self, output_db, batch_size):
+    def __init__(self, output_db, batch_size, ids=False, context_index=False):
+        '''
+        ids: store the pivots and contexts in "rows" and "cols" tables, and
+        the counts with their integer ids (see SqliteCounts)
+        context_index: also index the counts by context
+        '''
         self.output_db = output_db
         self.batch_size = batch_size
+        self.ids = ids
+        self.context_index = context_index
     
     def __str__(self):
         return self.output_db
@@ -473,88 +1293,74 @@ class SqliteDestination():
 #        con.commit()
 #        con.close()
     def save(self, counter):
+        #takes the counts out of the counter, which can go on counting
+        #while they are saved
+        coocurrences_copy = counter.pop_coocurrences()
         timeout = 60*60*2 #infinite
-        con = sqlite3.connect(self.output_db,timeout,isolation_level="EXCLUSIVE")
+        #transactions are handled explicitly
+        con = sqlite3.connect(self.output_db, timeout, isolation_level=None)
         con.text_factory = str #FIXME: move to unicode
-        lock_time = time.time()
         cur = con.cursor()
         #Create tables for each marker before falling into lock
-        #It could become a bug if new markers arise after the tables where
-        #created, but since marker are quite stable it's very unlikely.
         #The reason for doing this is that the CREATE TABLE frees the lock
         #and lets other process to take the DB while we where dumping
-        #Any of these firsts queries could lock the DB, but we are not
-        #guaranteed to keep it until we execute the BEGIN EXCLUSIVE
-        with counter.coocurrences_lock:
-            for marker in counter.coocurrences.keys():
-                marker_table = '{0}'.format(marker)
-                cur.execute("CREATE TABLE IF NOT EXISTS {0}(pivot text, "
-                            "context text, occurrences int, PRIMARY "
-                            "KEY(pivot,context))".format(marker_table))
+        for marker in coocurrences_copy.keys():
+            marker_table = '{0}'.format(marker)
+            for query in get_create_queries(marker_table, self.ids,
+                self.context_index):
+                cur.execute(query)
         cur.execute("PRAGMA synchronous=OFF")
         cur.execute("PRAGMA count_changes=OFF")
         cur.execute("PRAGMA journal_mode=OFF")
         cur.execute("PRAGMA temp_store=MEMORY")
-        con.execute('BEGIN EXCLUSIVE TRANSACTION')
-        logger.debug('DB lock acquired (time to lock={0:.2f} s.)'.format(time.time()-lock_time))
-        #database locked, let's lock the sparse_coocurrences
-        with counter.coocurrences_lock:
-            N_rec = len(counter)
-            logger.info('Start dumping {0} records)'.format(N_rec))
-            for marker in counter.coocurrences.keys():
-                marker_coocurrences = counter.coocurrences[marker]
-                marker_table = '{0}'.format(marker)
-                start_op = time.time()
-                #collect database values
-                for marker_cooocurrences_chunk in \
-                split_every(self.batch_size, marker_coocurrences.items()):
-                    params = []
-                    for (w1,w2),c in marker_cooocurrences_chunk:
-                        params.append(w1)
-                        params.append(w2)
-                    select_query = \
-                        "SELECT * FROM {0} WHERE {1}".format(marker_table,
-                        " OR ".join(repeat("(pivot = ? AND context = ?)", 
-                                           len(params)/2)))
-                    cur.execute(select_query, params)
-                    while 1:
-                        saved = cur.fetchone()
-                        if saved:
-                            try:                            
-                                marker_coocurrences[(saved[0],saved[1])] += \
-                                    int(saved[2])
-                            except KeyError:
-                                logger.error("{0} obtained while executing {1}"\
-                                             .format(str(saved)), select_query)
-                        else:
-                            break
-                    
-                #for(w1,w2),c in marker_coocurrences.iteritems():
-                #    cur.execute("SELECT * FROM {0} WHERE pivot = ? AND "
-                #                "context =?".format(marker),(w1,w2))
-                #    saved = cur.fetchone()
-                #    if saved:
-                #        marker_coocurrences[(w1,w2)] += int(saved[2])
-                    
-                insert_values = []    
-                for(w1,w2),c in marker_coocurrences.iteritems():
-                    insert_values.append((w1,w2,c))#"coalesce(select occurrences FROM {0} WHERE pivot = '{1}' and context='{2}',0) + {3}".format(marker,w1.replace("'","''"),w2.replace("'","''"),c)))
-                end_op = time.time()
-                logger.debug('Retrieved values for marker {0}. Time consumed={1:.2f}s. Rec/s={2:.2f}'\
-                        .format(marker, end_op-start_op, len(marker_coocurrences)/(end_op-start_op)))
-                start_op = time.time()
-                query = "INSERT OR REPLACE INTO {0} VALUES( ?, ? ,?)".format(marker)
-                try:
-                    cur.executemany(query, insert_values)
-                except sqlite3.OperationalError:
-                    logger.error("Query Failed: {0)".format(query))
-                    raise
-                end_op = time.time()
-                logger.debug('Saved values for marker {0}. Time consumed={1:.2f}s. Rec/s={2:.2f}'\
-                        .format(marker, end_op-start_op, len(marker_coocurrences)/(end_op-start_op)))
-                #clear from memory
-                del counter.coocurrences[marker]
-        con.commit()
+        #the counts are loaded into (in memory) temporary staging tables
+        #without locking the DB
+        N_rec = sum(len(marker_coocurrences) for marker_coocurrences in
+            coocurrences_copy.itervalues())
+        logger.info('Start dumping {0} records)'.format(N_rec))
+        start_op = time.time()
+        cur.execute('BEGIN')
+        for marker, marker_coocurrences in coocurrences_copy.iteritems():
+            staging_table = 'staging_{0}'.format(marker)
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS {0}(pivot text, "
+                        "context text, occurrences int)".format(staging_table))
+            cur.execute("DELETE FROM {0}".format(staging_table))
+            insert_values = ((w1,w2,c) for (w1,w2),c in
+                marker_coocurrences.iteritems())
+            query = "INSERT INTO {0} VALUES(?, ?, ?)".format(staging_table)
+            for insert_values_chunk in split_every(self.batch_size,
+                insert_values):
+                cur.executemany(query, insert_values_chunk)
+        cur.execute('COMMIT')
+        #frees the memory
+        coocurrences_copy = coocurrences_copy.keys()
+        logger.debug('Staged {0} records. Time consumed={1:.2f}s.'.format(
+            N_rec, time.time()-start_op))
+        lock_time = time.time()
+        cur.execute('BEGIN EXCLUSIVE TRANSACTION')
+        logger.debug('DB lock acquired (time to lock={0:.2f} s.)'.format(
+            time.time()-lock_time))
+        for marker in coocurrences_copy:
+            marker_table = '{0}'.format(marker)
+            staging_table = 'staging_{0}'.format(marker)
+            start_op = time.time()
+            if self.ids:
+                #new pivots and contexts get their ids
+                cur.execute("INSERT OR IGNORE INTO rows(word) SELECT pivot "
+                            "FROM {0}".format(staging_table))
+                cur.execute("INSERT OR IGNORE INTO cols(word) SELECT context "
+                            "FROM {0}".format(staging_table))
+                query = get_ids_merge_query(marker_table, staging_table)
+            else:
+                query = get_merge_query(marker_table, staging_table)
+            try:
+                cur.execute(query)
+            except sqlite3.OperationalError:
+                logger.error("Query Failed: {0}".format(query))
+                raise
+            logger.debug('Merged values for marker {0}. Time consumed='
+                         '{1:.2f}s.'.format(marker, time.time()-start_op))
+        cur.execute('COMMIT')
         con.close()
     
     def __enter__(self):
@@ -563,6 +1369,112 @@ class SqliteDestination():
     def __exit__(self, *args):
         pass
 
+def get_create_queries(table, ids=False, context_index=False):
+    '''
+    Returns the queries that create a table of counts (see
+    SqliteDestination), if it does not exist
+    '''
+    if not ids:
+        queries = ["CREATE TABLE IF NOT EXISTS {0}(pivot text, context text, "
+            "occurrences int, PRIMARY KEY(pivot,context))".format(table)]
+        key = 'context, pivot'
+    else:
+        #tables clustered by their primary key save the rowids
+        without_rowid = ' WITHOUT ROWID' if \
+            sqlite3.sqlite_version_info >= (3, 8, 2) else ''
+        queries = ["CREATE TABLE IF NOT EXISTS rows(id integer PRIMARY KEY, "
+                   "word text UNIQUE)",
+                   "CREATE TABLE IF NOT EXISTS cols(id integer PRIMARY KEY, "
+                   "word text UNIQUE)",
+                   "CREATE TABLE IF NOT EXISTS {0}(row_id int, col_id int, "
+                   "occurrences int, PRIMARY KEY(row_id, col_id)){1}".format(
+                   table, without_rowid)]
+        key = 'col_id, row_id'
+    if context_index:
+        queries.append("CREATE INDEX IF NOT EXISTS {0}_by_context ON {0}({1})"
+            .format(table, key))
+    return queries
+
+def get_merge_query(table, staging_table):
+    '''
+    Returns the query that adds the counts of a staging table to a table
+    of counts, with an upsert if the SQLite library supports it
+    '''
+    if sqlite3.sqlite_version_info >= (3, 24, 0):
+        #the WHERE avoids parsing the ON CONFLICT as a join constraint
+        return "INSERT INTO {0} SELECT pivot, context, occurrences FROM {1} "\
+            "WHERE 1 ORDER BY pivot, context ON CONFLICT(pivot, context) DO "\
+            "UPDATE SET occurrences = occurrences + excluded.occurrences"\
+            .format(table, staging_table)
+    return "INSERT OR REPLACE INTO {0} SELECT s.pivot, s.context, "\
+        "s.occurrences + coalesce(t.occurrences, 0) FROM {1} AS s LEFT JOIN "\
+        "{0} AS t ON t.pivot = s.pivot AND t.context = s.context".format(
+        table, staging_table)
+
+def get_ids_merge_query(table, staging_table):
+    '''
+    Returns the query that adds the counts of a staging table to a table of
+    counts by ids (the pivots and contexts must have their ids)
+    '''
+    staged_ids = "SELECT r.id AS row_id, c.id AS col_id, s.occurrences AS "\
+        "occurrences FROM {0} AS s JOIN rows AS r ON r.word = s.pivot JOIN "\
+        "cols AS c ON c.word = s.context".format(staging_table)
+    if sqlite3.sqlite_version_info >= (3, 24, 0):
+        return "INSERT INTO {0} {1} WHERE 1 ORDER BY 1, 2 ON CONFLICT(row_id, "\
+            "col_id) DO UPDATE SET occurrences = occurrences + "\
+            "excluded.occurrences".format(table, staged_ids)
+    return "INSERT OR REPLACE INTO {0} SELECT s.row_id, s.col_id, "\
+        "s.occurrences + coalesce(t.occurrences, 0) FROM ({1}) AS s LEFT "\
+        "JOIN {0} AS t ON t.row_id = s.row_id AND t.col_id = s.col_id"\
+        .format(table, staged_ids)
+
+class SqliteCounts():
+    '''
+    Reads the counts of a marker saved by a SqliteDestination, with either
+    layout: (pivot, context, occurrences) rows, or (row_id, col_id,
+    occurrences) rows with the pivots and contexts in "rows" and "cols"
+    tables of (id, word)
+    '''
+    def __init__(self, db_file, marker='c'):
+        self.con = sqlite3.connect(db_file)
+        self.con.text_factory = str #FIXME: move to unicode
+        self.ids = self.con.execute("SELECT 1 FROM sqlite_master WHERE type = "
+            "'table' AND name = 'rows'").fetchone() is not None
+        if self.ids:
+            self.counts = "(SELECT r.word AS pivot, c.word AS context, "\
+                "t.occurrences AS occurrences FROM {0} AS t JOIN rows AS r "\
+                "ON r.id = t.row_id JOIN cols AS c ON c.id = t.col_id)"\
+                .format(marker)
+        else:
+            self.counts = marker
+
+    def __iter__(self):
+        '''Yields the (pivot, context, occurrences) rows'''
+        return iter(self.con.execute("SELECT pivot, context, occurrences "
+            "FROM {0}".format(self.counts)))
+
+    def get(self, pivot, context):
+        '''Returns the occurrences of a pair (0 if it has none)'''
+        row = self.con.execute("SELECT occurrences FROM {0} WHERE pivot = ? "
+            "AND context = ?".format(self.counts), (pivot, context)).fetchone()
+        return row[0] if row else 0
+
+    def get_row(self, pivot):
+        '''Returns the (context, occurrences) of a pivot'''
+        return self.con.execute("SELECT context, occurrences FROM {0} WHERE "
+            "pivot = ?".format(self.counts), (pivot,)).fetchall()
+
+    def get_column(self, context):
+        '''
+        Returns the (pivot, occurrences) of a context (it is faster if the
+        counts are indexed by context)
+        '''
+        return self.con.execute("SELECT pivot, occurrences FROM {0} WHERE "
+            "context = ?".format(self.counts), (context,)).fetchall()
+
+    def close(self):
+        self.con.close()
+
 def split_every(n, iterable):
     i = iter(iterable)
     piece = list(islice(i, n))
@@ -1,5 +1,355 @@
-def gziplines(fname):
-    from subprocess import Popen, PIPE
-    f = Popen(['zcat' ] + [fname], stdout=PIPE)
-    for line in f.stdout:
-        yield line
\ No newline at end of file
+'''
+Reading of (possibly compressed) corpus files.
+
+Compressed files are decoded in-process: a thread reads and decompresses
+ahead of the consumer into large buffers, so that decompression overlaps
+with the processing of the lines. BGZF files (blocked gzip, as written by
+bgzip) are made of independent gzip members whose size is stored in their
+headers, so they are decompressed by several worker threads in parallel.
+Other gzip, bz2 and xz files are still decompressed serially (by the single
+read-ahead thread), since their streams cannot be split.
+The compression is selected by the extension of the file. The threads stop
+when the lines stop being read (the generator is closed or collected).
+'''
+import bz2
+import itertools
+import struct
+import sys
+import threading
+import zlib
+from cStringIO import StringIO
+from Queue import Queue, Empty, Full
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+#size of the compressed blocks read from the files
+READ_SIZE = 1 << 20
+#number of BGZF blocks (at most 64KB each) decompressed in one job
+BGZF_BATCH = 16
+DECODER_THREADS = 4
+EXTENSIONS = {'.gz': 'gzip', '.gzip': 'gzip', '.bgz': 'gzip',
+              '.bz2': 'bz2', '.xz': 'xz', '.lzma': 'xz'}
+GZIP_MAGIC = '\x1f\x8b'
+GZIP_FEXTRA = 0x04
+#polling interval of the threads queues (keeps them interruptible)
+POLL_INTERVAL = 1
+
+def gziplines(fname, threads=DECODER_THREADS):
+    return decoded_lines(fname, 'gzip', threads)
+
+def get_compression(fname):
+    '''Returns the compression of fname according to its extension'''
+    for ext, compression in EXTENSIONS.iteritems():
+        if fname.lower().endswith(ext):
+            return compression
+    return None
+
+def open_corpora(fnames, gzip=False, threads=DECODER_THREADS):
+    '''
+    Returns an iterator over the lines of all the files in fnames ("-" is
+    the standard input). The files are decompressed according to their
+    extension, or as gzip files if gzip is True.
+    '''
+    if isinstance(fnames, basestring):
+        fnames = [fnames]
+    if not fnames:
+        fnames = ['-']
+    return itertools.chain.from_iterable(decoded_lines(fname,
+        'gzip' if gzip else get_compression(fname), threads)
+        for fname in fnames)
+
+def decoded_lines(fname, compression=None, threads=DECODER_THREADS):
+    '''
+    Yields the lines of fname decompressed with the given compression
+    ('gzip', 'bz2', 'xz' or None).
+    threads: number of decompression threads (0 decompresses on the
+    calling thread)
+    '''
+    if fname == '-':
+        raw = sys.stdin
+    else:
+        raw = open(fname, 'rb')
+    chunks = None
+    try:
+        if not compression:
+            for line in raw:
+                yield line
+            return
+        parallel = False
+        if compression == 'gzip':
+            f, bgzf = _is_bgzf(raw)
+            parallel = bgzf and threads > 1
+            if parallel:
+                chunks = _parallel_map(_decompress_bgzf_batch,
+                    _split_every(BGZF_BATCH, _bgzf_blocks(f)), threads)
+            else:
+                chunks = _decompress_stream(f, _new_gzip_decompressor)
+        elif compression == 'bz2':
+            chunks = _decompress_stream(raw, bz2.BZ2Decompressor)
+        elif compression == 'xz':
+            if lzma is None:
+                raise ImportError("Cannot read xz files: lzma not available "
+                    "(install backports.lzma)")
+            chunks = _decompress_stream(raw, lzma.LZMADecompressor)
+        else:
+            raise ValueError("Unknown compression: {0}".format(compression))
+        if threads > 0 and not parallel:
+            #decompress ahead on a separate thread
+            chunks = _read_ahead(chunks, threads * 2)
+        for line in _split_lines(chunks):
+            yield line
+    finally:
+        #stops the threads reading the file before closing it
+        if chunks is not None:
+            chunks.close()
+        if raw is not sys.stdin:
+            raw.close()
+
+def _new_gzip_decompressor():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def _decompress_stream(f, new_decompressor):
+    '''
+    Yields the decompressed data of f, which may consist of several
+    concatenated compressed streams (e.g. multi-member gzip or pbzip2 files)
+    '''
+    d = new_decompressor()
+    while True:
+        data = f.read(READ_SIZE)
+        if not data:
+            break
+        while data:
+            try:
+                out = d.decompress(data)
+            except EOFError:
+                #the previous stream ended exactly at the end of a read
+                d = new_decompressor()
+                out = d.decompress(data)
+            if out:
+                yield out
+            data = d.unused_data
+            if data:
+                if not data.strip('\x00'):
+                    #trailing padding
+                    break
+                d = new_decompressor()
+
+def _split_lines(chunks):
+    '''Splits a sequence of buffers into lines (keeping the "\\n")'''
+    pending = ''
+    for chunk in chunks:
+        end = chunk.rfind('\n') + 1
+        if not end:
+            pending += chunk
+            continue
+        if pending:
+            for line in StringIO(pending + chunk[:end]):
+                yield line
+        else:
+            for line in StringIO(chunk[:end]):
+                yield line
+        pending = chunk[end:]
+    if pending:
+        yield pending
+
+class _PrefixedFile(object):
+    '''A file whose first bytes have already been read'''
+    def __init__(self, prefix, f):
+        self.prefix = prefix
+        self.f = f
+
+    def read(self, n):
+        if self.prefix:
+            data = self.prefix[:n]
+            self.prefix = self.prefix[n:]
+            if len(data) < n:
+                data += self.f.read(n - len(data))
+            return data
+        return self.f.read(n)
+
+def _is_bgzf(f):
+    '''
+    Checks whether f is a BGZF file. Returns the file (rewound) and the
+    result of the check
+    '''
+    header = f.read(12)
+    bgzf = False
+    if len(header) == 12 and header[:2] == GZIP_MAGIC and \
+        ord(header[3]) & GZIP_FEXTRA:
+        xlen, = struct.unpack('<H', header[10:12])
+        extra = f.read(xlen)
+        header += extra
+        bgzf = _get_bgzf_block_size(extra) is not None
+    return _PrefixedFile(header, f), bgzf
+
+def _get_bgzf_block_size(extra):
+    '''Returns the BSIZE field in the extra field of a gzip header'''
+    pos = 0
+    while pos + 4 <= len(extra):
+        si1, si2, slen = struct.unpack('<ccH', extra[pos:pos+4])
+        if si1 == 'B' and si2 == 'C' and slen == 2:
+            return struct.unpack('<H', extra[pos+4:pos+6])[0]
+        pos += 4 + slen
+    return None
+
+def _bgzf_blocks(f):
+    '''Yields the (compressed) gzip members of a BGZF file'''
+    while True:
+        header = f.read(12)
+        if not header:
+            break
+        xlen, = struct.unpack('<H', header[10:12])
+        extra = f.read(xlen)
+        block_size = _get_bgzf_block_size(extra)
+        if block_size is None:
+            raise IOError("Corrupted BGZF block")
+        yield header + extra + f.read(block_size + 1 - 12 - xlen)
+
+def _decompress_bgzf_batch(blocks):
+    return ''.join([zlib.decompress(block, 16 + zlib.MAX_WBITS) for block
+        in blocks])
+
+def _split_every(n, iterable):
+    i = iter(iterable)
+    piece = list(itertools.islice(i, n))
+    while piece:
+        yield piece
+        piece = list(itertools.islice(i, n))
+
+def _get(queue):
+    while True:
+        try:
+            return queue.get(timeout=POLL_INTERVAL)
+        except Empty:
+            pass
+
+def _put(queue, item, stop):
+    '''Puts item in queue unless stop is set first. Returns whether it was put'''
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=POLL_INTERVAL)
+            return True
+        except Full:
+            pass
+    return False
+
+def _drain(queue):
+    while True:
+        try:
+            queue.get_nowait()
+        except Empty:
+            return
+
+def _stop(stop, queue, thread):
+    '''
+    Stops a thread that puts items in queue (checking the stop event), and
+    waits for it
+    '''
+    stop.set()
+    #unblocks its last put
+    _drain(queue)
+    thread.join()
+
+class _Job(object):
+    def __init__(self, data):
+        self.data = data
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self):
+        while not self.done.wait(POLL_INTERVAL):
+            pass
+        if self.error:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+def _start_daemon(target):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+def _read_ahead(iterable, max_pending):
+    '''
+    Consumes iterable on a separate thread, keeping at most max_pending
+    items ahead of the caller
+    '''
+    pending = Queue(max_pending)
+    #set when the caller stops reading (e.g. it closes the generator)
+    stop = threading.Event()
+    def producer():
+        try:
+            for item in iterable:
+                job = _Job(None)
+                job.result = item
+                job.done.set()
+                if not _put(pending, job, stop):
+                    return
+        except BaseException:
+            job = _Job(None)
+            job.error = sys.exc_info()
+            job.done.set()
+            _put(pending, job, stop)
+        _put(pending, None, stop)
+    thread = _start_daemon(producer)
+    try:
+        while True:
+            job = _get(pending)
+            if job is None:
+                break
+            yield job.wait()
+    finally:
+        _stop(stop, pending, thread)
+
+def _parallel_map(func, iterable, threads):
+    '''
+    Yields func(item) for each item in iterable (in order), computing them
+    on several threads. At most 2*threads items are pending at any time.
+    '''
+    work = Queue()
+    pending = Queue(threads * 2)
+    #set when the caller stops reading (e.g. it closes the generator)
+    stop = threading.Event()
+    def feeder():
+        try:
+            for item in iterable:
+                job = _Job(item)
+                if not _put(pending, job, stop):
+                    break
+                work.put(job)
+        except BaseException:
+            job = _Job(None)
+            job.error = sys.exc_info()
+            job.done.set()
+            _put(pending, job, stop)
+        _put(pending, None, stop)
+        for _ in xrange(threads):
+            work.put(None)
+    def worker():
+        while True:
+            job = work.get()
+            if job is None:
+                return
+            try:
+                job.result = func(job.data)
+            except BaseException:
+                job.error = sys.exc_info()
+            finally:
+                job.done.set()
+    thread = _start_daemon(feeder)
+    for _ in xrange(threads):
+        _start_daemon(worker)
+    try:
+        while True:
+            job = _get(pending)
+            if job is None:
+                break
+            yield job.wait()
+    finally:
+        _stop(stop, pending, thread)
@@ -0,0 +1,218 @@
+'''
+Compiled (binary) representation of a dependency parsed corpus.
+
+Parsing the tab-separated corpus text is a big share of the running time of
+every tool, so a corpus can be compiled once into a directory with:
+header: a JSON dictionary with the corpus format and sizes
+lexicon: every distinct field value, one per line (the id of a string is
+its line number)
+tokens: for each token, one little-endian int32 lexicon id per field of
+the corpus format (-1 for missing fields)
+sentences: little-endian int64 offsets (in tokens) of the start of each
+sentence, followed by the total number of tokens
+
+The files are memory-mapped when read, so sentences are decoded straight
+from the page cache without parsing any text.
+'''
+import json
+import logging
+import mmap
+import os
+import struct
+
+from corputils.core.readers import Sentence, read_blocks
+
+FORMAT_VERSION = 1
+HEADER_FILE = 'header'
+LEXICON_FILE = 'lexicon'
+TOKENS_FILE = 'tokens'
+SENTENCES_FILE = 'sentences'
+TOKEN_ID_SIZE = 4
+OFFSET_SIZE = 8
+#number of tokens buffered before writing them
+WRITE_BUFFER = 1 << 16
+DEFAULT_CORP_FORMAT = ('word', 'lemma', 'pos', 'id', 'dep_id', 'dep_rel')
+
+def is_compiled_corpus(path):
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
+
+def compile_corpus(corpora, output_dir, separator='s',
+                   corp_format=DEFAULT_CORP_FORMAT):
+    '''
+    Compiles the lines of a DP corpus into output_dir.
+    corpora: an iterable over the lines of the corpus
+    Sentences are delimited as in DPCorpusReader. Returns the header.
+    '''
+    try:
+        os.makedirs(output_dir)
+    except OSError:
+        pass
+    end_separator = '/{0}'.format(separator)
+    n_fields = len(corp_format)
+    lexicon = {}
+    n_tokens = 0
+    n_sentences = 0
+    tokens_buffer = []
+    sentence_start = 0
+    with open(os.path.join(output_dir, LEXICON_FILE), 'w') as f_lexicon, \
+         open(os.path.join(output_dir, TOKENS_FILE), 'wb') as f_tokens, \
+         open(os.path.join(output_dir, SENTENCES_FILE), 'wb') as f_sentences:
+        def flush_tokens():
+            f_tokens.write(struct.pack('<{0}i'.format(len(tokens_buffer)),
+                *tokens_buffer))
+            del tokens_buffer[:]
+        for line in corpora:
+            line = line.rstrip('\n')
+            if line.strip('<>') == end_separator:
+                f_sentences.write(struct.pack('<q', sentence_start))
+                n_sentences += 1
+                sentence_start = n_tokens
+            elif line[0] == '<' and line[-1] == '>':
+                #skip beggining of sentence or text markers
+                continue
+            else:
+                t = line.split('\t')
+                for i in xrange(n_fields):
+                    if i < len(t):
+                        v = t[i]
+                        try:
+                            tokens_buffer.append(lexicon[v])
+                        except KeyError:
+                            lexicon[v] = len(lexicon)
+                            f_lexicon.write(v + '\n')
+                            tokens_buffer.append(lexicon[v])
+                    else:
+                        tokens_buffer.append(-1)
+                n_tokens += 1
+                if len(tokens_buffer) >= WRITE_BUFFER * n_fields:
+                    flush_tokens()
+        flush_tokens()
+        #tokens after the last separator are discarded (as DPCorpusReader does)
+        n_tokens = sentence_start
+        f_tokens.truncate(n_tokens * n_fields * TOKEN_ID_SIZE)
+        f_sentences.write(struct.pack('<q', n_tokens))
+    header = {'version': FORMAT_VERSION,
+              'corp_format': list(corp_format),
+              'separator': separator,
+              'n_sentences': n_sentences,
+              'n_tokens': n_tokens,
+              'lexicon_size': len(lexicon)}
+    with open(os.path.join(output_dir, HEADER_FILE), 'w') as f_header:
+        json.dump(header, f_header)
+    logging.info("Compiled {0} sentences ({1} tokens, {2} types) into "
+                 "{3}".format(n_sentences, n_tokens, len(lexicon), output_dir))
+    return header
+
+def read_header(path):
+    with open(os.path.join(path, HEADER_FILE)) as f_header:
+        header = json.load(f_header)
+    if header['version'] != FORMAT_VERSION:
+        raise ValueError("Unsupported compiled corpus version {0} in "
+            "{1}".format(header['version'], path))
+    return header
+
+def _map_file(filename):
+    with open(filename, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            #empty files cannot be mapped
+            return ''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+class CompiledCorpus(object):
+    '''
+    Random access to the sentences of a compiled corpus
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.header = read_header(path)
+        self.corp_format = tuple(str(k) for k in self.header['corp_format'])
+        self.separator = self.header['separator']
+        with open(os.path.join(path, LEXICON_FILE)) as f_lexicon:
+            self.lexicon = [w.rstrip('\n') for w in f_lexicon]
+        self.tokens = _map_file(os.path.join(path, TOKENS_FILE))
+        self.sentences = _map_file(os.path.join(path, SENTENCES_FILE))
+
+    def __len__(self):
+        return self.header['n_sentences']
+
+    def get_token_ids(self, start, end):
+        '''Returns the flat list of lexicon ids of tokens [start, end)'''
+        n_fields = len(self.corp_format)
+        return struct.unpack_from('<{0}i'.format((end - start) * n_fields),
+            self.tokens, start * n_fields * TOKEN_ID_SIZE)
+
+    def get_sentence_span(self, k):
+        '''Returns the token offsets [start, end) of the k-th sentence'''
+        return struct.unpack_from('<2q', self.sentences, k * OFFSET_SIZE)
+
+    def get_sentence(self, k, corp_types=None, to_lower=False, lexicon=None):
+        start, end = self.get_sentence_span(k)
+        return self.build_sentence(self.get_token_ids(start, end),
+            corp_types, to_lower, lexicon)
+
+    def build_sentence(self, token_ids, corp_types=None, to_lower=False,
+                       lexicon=None):
+        '''Builds a Sentence from a flat list of lexicon ids'''
+        strings = self.lexicon
+        n_fields = len(self.corp_format)
+        values = [strings[i] if i >= 0 else None for i in token_ids]
+        columns = dict((k, values[j::n_fields]) for j, k in
+            enumerate(self.corp_format))
+        plain_text = ['\t'.join(v for v in values[i:i+n_fields] if v is not None)
+            for i in xrange(0, len(values), n_fields)]
+        sentence = Sentence(self.corp_format, corp_types or {}, to_lower,
+            lexicon)
+        sentence.push_columns(columns, plain_text)
+        return sentence
+
+    def __iter__(self):
+        for k in xrange(len(self)):
+            yield self.get_sentence(k)
+
+    def close(self):
+        for mapped in (self.tokens, self.sentences):
+            if mapped:
+                mapped.close()
+
+class CompiledCorpusReader(object):
+    '''
+    Reads sentences from compiled corpora. It can be used wherever a
+    DPCorpusReader is expected.
+    '''
+    def __init__(self, corpora, to_lower=False, lexicon=None):
+        '''
+        corpora: a list of compiled corpus directories
+        lexicon: a Lexicon in which the read values are interned (optional)
+        '''
+        if isinstance(corpora, basestring):
+            corpora = [corpora]
+        self.corpora = corpora
+        self.to_lower = to_lower
+        self.corp_types = {}
+        self.lexicon = lexicon
+        if corpora:
+            self.corp_format = tuple(str(k) for k in
+                read_header(corpora[0])['corp_format'])
+        else:
+            self.corp_format = DEFAULT_CORP_FORMAT
+        self._sentences = self._read_sentences()
+
+    def _read_sentences(self):
+        for path in self.corpora:
+            corpus = CompiledCorpus(path)
+            try:
+                for k in xrange(len(corpus)):
+                    yield corpus.get_sentence(k, self.corp_types,
+                        self.to_lower, self.lexicon)
+            finally:
+                corpus.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._sentences)
+
+    def blocks(self, block_size):
+        '''Reads the corpora in SentenceBlocks of block_size sentences'''
+        return read_blocks(self, block_size)
@@ -2,7 +2,9 @@ import logging
 logging.basicConfig(level=logging.DEBUG)
 import os
 from clutils import JobModule, Pipeline, PinMultiplex, DictionaryPin, TextFilePin
-from readers import DPCorpusReader
+from readers import DPCorpusReader, Lexicon
+from compiled import CompiledCorpusReader
+from sentence_index import open_sentence_range, split_corpus
 from collections import Counter
 from clutils.serialization import TxtSerializer
 #try:
@@ -38,27 +40,39 @@ class CountMatches(JobModule):
 
     def run(self, targets_features_extractor, corpus_file, gzip, 
         target_format, context_format, sentence_separator,
-                  to_lower):
+                  to_lower, compiled=False, sentence_range=None):
+        '''
+        sentence_range: if given, only the sentences [start, end) of the
+        corpus are counted (the corpus must have a sentence index)
+        '''
         targets_features_extractor.initialize()
-        self['corpus'].open(corpus_file, gzip)
         logging.info("CountMatches({0}): starting "
         "counting".format(self))
         
-        corpus_reader = DPCorpusReader(self['corpus'].read(), 
-                                       separator=sentence_separator,
-                                       to_lower=to_lower)
-        for i,(target, feature) in \
-            enumerate(targets_features_extractor(corpus_reader)):
+        lexicon = Lexicon()
+        if compiled:
+            corpus_reader = CompiledCorpusReader(corpus_file,
+                                                 to_lower=to_lower,
+                                                 lexicon=lexicon)
+        elif sentence_range:
+            start, end = sentence_range
+            corpus_reader = open_sentence_range(corpus_file, start, end,
+                                                separator=sentence_separator,
+                                                to_lower=to_lower,
+                                                lexicon=lexicon)
+        else:
+            self['corpus'].open(corpus_file, gzip)
+            corpus_reader = DPCorpusReader(self['corpus'].read(), 
+                                           separator=sentence_separator,
+                                           to_lower=to_lower,
+                                           lexicon=lexicon)
+        for i,(enc_target, enc_context) in \
+            enumerate(targets_features_extractor.value_pairs(corpus_reader)):
             if (i+1) % 100000 == 0:
                 logging.info("CountMatches({0}): {1} features extracted "
                              "so far...".format(self, i+1)) 
                 logging.info("CountMatches({0}): {1} MB used (peak) "\
                                 .format(self, memory_usage()['peak']/1024))
-            #print target.format(target_format),\
-            enc_target = targets_features_extractor.encode_target(target)
-            enc_context = targets_features_extractor.encode_feature(feature)
-            fmt_target = target.format(target_format)#342-344
-            fmt_context = feature.format(context_format)
             self['output'][(enc_target, 
                 enc_context)] += 1
                 #feature.format(context_format))] += 1
@@ -93,19 +107,35 @@ class SumResults(JobModule):
 
 class CountSumPipeline(Pipeline):
     def __init__(self, work_path, targets_features_extractor, corpora, gzip,
-    target_format, context_format, sentence_separator, to_lower):
+    target_format, context_format, sentence_separator, to_lower,
+    compiled=False, parts=1, whole_texts=False):
+        '''
+        parts: number of jobs in which each (uncompressed) corpus file is
+        split, using its sentence index
+        whole_texts: split the corpus files only at text boundaries
+        '''
         super(CountSumPipeline, self).__init__(work_path)
         sum_module = SumResults('sum_matches')
         sum_module.set_args(targets_features_extractor)
         count_modules = []
         for corpus in corpora:
-            count_module = CountMatches('count_matches', os.path.basename(corpus))
-            count_module.set_args(targets_features_extractor, corpus, gzip,
-                                  target_format, context_format, 
-                                  sentence_separator, to_lower)
-            
-            count_module['output'].connect_to(sum_module['counts'])
-            count_modules.append(count_module)
+            if parts > 1 and not gzip and not compiled:
+                sentence_ranges = split_corpus(corpus, parts,
+                    sentence_separator, whole_texts)
+            else:
+                sentence_ranges = [None]
+            for sentence_range in sentence_ranges:
+                count_module_id = os.path.basename(corpus)
+                if sentence_range:
+                    count_module_id += '.{0}-{1}'.format(*sentence_range)
+                count_module = CountMatches('count_matches', count_module_id)
+                count_module.set_args(targets_features_extractor, corpus, gzip,
+                                      target_format, context_format, 
+                                      sentence_separator, to_lower, compiled,
+                                      sentence_range)
+                
+                count_module['output'].connect_to(sum_module['counts'])
+                count_modules.append(count_module)
         self.add_stage(*count_modules)
         self.add_stage(sum_module)
 
@@ -1,5 +1,19 @@
 import logging
 import re
+from functools import partial
+from itertools import chain, izip
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from corputils.core.readers import Token, read_blocks
+from corputils.core.sentence_matchers import FusedMatcher, UnigramMatcher,\
+    get_block_matches
+from corputils.core.vocabulary import open_vocabulary
+
+#number of sentences processed at once
+BLOCK_SIZE = 256
 
 def chunks(l, n):
     """ Yield successive n-sized chunks from l.
@@ -7,6 +21,57 @@ def chunks(l, n):
     for i in xrange(0, len(l), n):
         yield l[i:i+n]
 
+class TypeValues(object):
+    '''
+    The values of a function of the type ids of a lexicon for all its types,
+    in a list that grows with the lexicon (and in a numpy array, if numpy is
+    available), so that they can be gathered for many tokens at once.
+    A value of None marks the types to be discarded.
+    '''
+    def __init__(self, func, lexicon):
+        self.func = func
+        self.lexicon = lexicon
+        self.values = []
+        #number of values copied into the arrays
+        self.filled = 0
+        self.array = None
+        self.valid = None
+
+    def get_values(self):
+        '''Returns the list of the values of all the types'''
+        n = len(self.values)
+        if n < len(self.lexicon):
+            func = self.func
+            self.values.extend([func(type_id) for type_id in xrange(n,
+                len(self.lexicon))])
+        return self.values
+
+    def get_arrays(self):
+        '''
+        Returns a numpy array with the values of all the types and a boolean
+        array telling which ones are not None (both can be longer than the
+        lexicon)
+        '''
+        values = self.get_values()
+        filled = self.filled
+        if filled < len(values):
+            if self.array is None or len(self.array) < len(values):
+                capacity = max(len(values), 2 * filled, 1024)
+                array = numpy.empty(capacity, dtype=object)
+                valid = numpy.zeros(capacity, dtype=bool)
+                if self.array is not None:
+                    array[:filled] = self.array[:filled]
+                    valid[:filled] = self.valid[:filled]
+                self.array, self.valid = array, valid
+            #elements are set one by one, since values can be tuples
+            array = self.array
+            for type_id in xrange(filled, len(values)):
+                array[type_id] = values[type_id]
+            self.valid[filled:len(values)] = [v is not None for v in
+                values[filled:]]
+            self.filled = len(values)
+        return self.array, self.valid
+
 class TargetsFeaturesExtractor():
     '''
     main loop of the feature-extraction procedure
@@ -18,10 +83,12 @@ class TargetsFeaturesExtractor():
         to a set of words that are valid matches
         '''
         self.matchers = matchers
+        self.fused_matcher = FusedMatcher(matchers)
         self.feature_extractor = feature_extractor
         self.target_format = target_format
         self.context_format = context_format
         self.targets = targets
+        self.lexicon = None
 
     def initialize(self):
         self.feature_extractor.initialize()
@@ -29,10 +96,42 @@ class TargetsFeaturesExtractor():
         self.ids_targets = {k: {} for k in self.targets.keys()}
         for k,k_targets in self.targets.iteritems():
             for i, filename in k_targets.iteritems():
-                self.targets[k][i] = set(w.strip() for w in file(filename))
-                self.ids_targets[k][i] = [w.strip() for w in file(filename)]
-                self.targets_ids[k][i] = {w.strip(): j for j,w in
-                    enumerate(file(filename))}
+                vocabulary = open_vocabulary(filename)
+                self.targets[k][i] = vocabulary
+                self.ids_targets[k][i] = vocabulary
+                self.targets_ids[k][i] = vocabulary.ids
+
+    def set_lexicon(self, lexicon):
+        '''
+        Memoizes per token type (see readers.Lexicon) the encoding and the
+        filtering of the targets read with the given lexicon
+        '''
+        self.feature_extractor.set_lexicon(lexicon)
+        if lexicon is not None and \
+            lexicon.format_table(self.target_format) is None:
+            #the target format does not only depend on the type
+            lexicon = None
+        self.lexicon = lexicon
+        if lexicon is None:
+            return
+        self.target_codes = {}
+        self.skip_types = {}
+        for k, k_targets in self.targets.iteritems():
+            self.target_codes[k] = {}
+            self.skip_types[k] = {}
+            for i in k_targets:
+                self.target_codes[k][i] = lexicon.table(partial(
+                    self._encode_target_type, k, i))
+                self.skip_types[k][i] = lexicon.table(partial(
+                    self._skip_target_type, k, i))
+
+    def _encode_target_type(self, k, i, type_id):
+        return self.targets_ids[k][i][self.lexicon.format_table(
+            self.target_format)[type_id]]
+
+    def _skip_target_type(self, k, i, type_id):
+        return self.lexicon.format_table(self.target_format)[type_id] not in\
+            self.targets[k][i]
 
     def encode_feature(self, feature):
         return self.feature_extractor.encode(feature)
@@ -47,6 +146,11 @@ class TargetsFeaturesExtractor():
             #? to be tested
             return target.format(self.target_format)
         
+        if self.lexicon is not None:
+            target_codes = self.target_codes[len(target)]
+            return tuple(target_codes[i+1][t['type_id']] for i,t in
+                enumerate(target))
+
         targets_ids = self.targets_ids[len(target)]
         fmt_target = tuple(t.format(self.target_format) for t in target)
 
@@ -65,6 +169,12 @@ class TargetsFeaturesExtractor():
     def skip_target(self, target):
         if len(target) not in self.targets:
             return False
+        if self.lexicon is not None:
+            for target_pos, skip_types in \
+                self.skip_types[len(target)].iteritems():
+                if skip_types[target[target_pos - 1]['type_id']]:
+                    return True
+            return False
         target_validators = self.targets[len(target)]
         #for each position based filter given
         for target_pos, valid_items in target_validators.iteritems():
@@ -74,30 +184,288 @@ class TargetsFeaturesExtractor():
                 return True
         return False
 
-    def __call__(self, corpus_reader):
-        matchers = self.matchers
+    def __call__(self, corpus_reader, block_size=BLOCK_SIZE):
+        self.set_lexicon(getattr(corpus_reader, 'lexicon', None))
+        for block in read_blocks(corpus_reader, block_size):
+            try:
+                pairs = self.process_block(block)
+            except IOError:
+                raise
+            except StandardError:
+                #go sentence by sentence to isolate the faulty ones
+                pairs = self.process_sentences(block)
+            for pair in pairs:
+                yield pair
+        self.log_cache_stats()
+
+    def log_cache_stats(self):
+        for matcher in self.matchers:
+            if hasattr(matcher, 'log_cache_stats'):
+                matcher.log_cache_stats()
+
+    def process_block(self, block):
+        '''
+        Returns the list of (target, feature) pairs of all the sentences in
+        a SentenceBlock, running all the matchers in a single traversal of
+        each sentence (see FusedMatcher)
+        '''
+        #targets of each sentence, in the order of the matchers
+        block_targets = [[] for _ in block.sentences]
+        for k, target in get_block_matches(self.fused_matcher, block):
+            block_targets[k].append(target)
+        pairs = []
+        for chunk, targets in izip(block.sentences, block_targets):
+            pairs.extend(self.get_pairs(chunk, targets))
+        return pairs
+
+    def get_pairs(self, chunk, targets):
+        '''
+        Yields the (target, feature) pairs of the targets matched in a
+        sentence, skipping the repeated ones. The repetitions are detected on
+        integers packed from the positions of the target and of the feature,
+        so that only the features of the yielded pairs are built.
+        '''
         feature_extractor = self.feature_extractor
-            
+        is_valid = feature_extractor.get_validator(chunk)
+        n = len(chunk)
+        base = n + 1
+        seen_pairs = set()
+        for target in targets:
+            #skip targets that are not in the specified list
+            #of valid targets
+            if self.skip_target(target):
+                continue
+            positions = [t.i for t in target.tokens]
+            target_key = 0
+            for p in positions:
+                target_key = target_key * base + (p + 1)
+            target_key *= base
+            for pm, p in feature_extractor.get_window(positions, n):
+                key = target_key + p
+                if key not in seen_pairs and is_valid(p):
+                    seen_pairs.add(key)
+                    yield target, LexicalFeature(chunk, pm, Token(chunk, p))
+
+    def process_sentences(self, corpus_reader):
+        '''
+        Yields the (target, feature) pairs of each sentence, logging the
+        sentences that cannot be processed
+        '''
+        matchers = self.matchers
         #a chunk is usually a sentence (we cannot get features passed the chunk)
         for chunk in corpus_reader:
             try:
-                seen_pairs = set()
-                for matcher in matchers:
-                    for target in matcher.get_matches(chunk):
-                        #skip targets that are not in the specified list
-                        #of valid targets
-                        if self.skip_target(target):
-                                continue
-                        for feature in feature_extractor.get_features(target, chunk):
-                            if (target, feature) not in seen_pairs:
-                                seen_pairs.add((target,feature))
-                                yield target, feature
+                targets = chain.from_iterable(matcher.get_matches(chunk) for
+                    matcher in matchers)
+                for target, feature in self.get_pairs(chunk, targets):
+                    yield target, feature
             except IOError:
                 raise
             except StandardError:
                 logging.exception("Error while processing sentence: {0}".format(
                     chunk))
 
+    def can_extract_types(self):
+        '''
+        Whether the targets and the features only depend on the types of the
+        tokens, so that they can be computed from their type ids (see
+        value_pairs)
+        '''
+        return self.lexicon is not None and \
+            isinstance(self.feature_extractor, BOWFeatureExtractor) and \
+            self.feature_extractor.lexicon is not None
+
+    def value_pairs(self, corpus_reader, encode=True, block_size=BLOCK_SIZE):
+        '''
+        Yields the same (target, feature) pairs as calling the extractor, but
+        encoded (see encode_target and encode_feature) or, if encode is False,
+        formatted with the target and context formats.
+        When they only depend on the types of the tokens, the pairs are
+        computed from the type ids of the tokens without building the
+        features, and the windows of the unigram targets of a whole block
+        are computed at once with numpy (if available).
+        '''
+        self.set_lexicon(getattr(corpus_reader, 'lexicon', None))
+        if encode:
+            value_pair = lambda target, feature: (self.encode_target(target),
+                self.encode_feature(feature))
+        else:
+            value_pair = lambda target, feature: (
+                target.format(self.target_format),
+                feature.format(self.context_format))
+        if not self.can_extract_types():
+            for target, feature in self(corpus_reader, block_size):
+                yield value_pair(target, feature)
+            return
+        target_values = TypeValues(partial(self._get_unigram_value, encode),
+            self.lexicon)
+        context_values = TypeValues(partial(
+            self.feature_extractor.get_type_value, encode), self.lexicon)
+        groups = self._get_matcher_groups()
+        for block in read_blocks(corpus_reader, block_size):
+            try:
+                pairs = self.process_block_types(block, groups, target_values,
+                    context_values, encode)
+            except IOError:
+                raise
+            except StandardError:
+                #go sentence by sentence to isolate the faulty ones
+                pairs = [value_pair(target, feature) for target, feature in
+                    self.process_sentences(block)]
+            for pair in pairs:
+                yield pair
+        self.log_cache_stats()
+
+    def _get_unigram_value(self, encode, type_id):
+        '''
+        Returns the encoded (or formatted) unigram target of a type, or None
+        if it is skipped
+        '''
+        if 1 in self.targets:
+            for skip_types in self.skip_types[1].itervalues():
+                if skip_types[type_id]:
+                    return None
+        if encode and 1 in self.targets:
+            return (self.target_codes[1][1][type_id],)
+        return self.lexicon.format_table(self.target_format)[type_id]
+
+    def _get_matcher_groups(self):
+        '''
+        Splits the matchers in UnigramMatchers (None) and FusedMatchers of the
+        consecutive matchers between them
+        '''
+        groups = []
+        for matcher in self.matchers:
+            if isinstance(matcher, UnigramMatcher):
+                groups.append(None)
+            elif groups and groups[-1] is not None:
+                groups[-1].append(matcher)
+            else:
+                groups.append([matcher])
+        return [group if group is None else FusedMatcher(group) for group in
+            groups]
+
+    def process_block_types(self, block, groups, target_values,
+                            context_values, encode):
+        '''
+        Returns the list of encoded (or formatted) (target, feature) pairs of
+        all the sentences in a SentenceBlock, in the same order and
+        deduplicated as in process_block
+        groups: the matchers, as returned by _get_matcher_groups
+        target_values, context_values: the TypeValues of the unigram targets
+        and of the features
+        '''
+        feature_extractor = self.feature_extractor
+        contexts = context_values.get_values()
+        if None not in groups:
+            unigram_pairs = None
+        elif numpy is not None:
+            unigram_pairs = self._get_block_unigram_pairs(block,
+                target_values, context_values)
+        else:
+            targets = target_values.get_values()
+            unigram_pairs = [self._get_sentence_unigram_pairs(
+                sentence.columns['type_id'], targets, contexts) for sentence
+                in block.sentences]
+        pairs = []
+        for k, sentence in enumerate(block.sentences):
+            type_ids = sentence.columns['type_id']
+            seen_targets = set()
+            unigrams_done = False
+            for group in groups:
+                if group is None:
+                    if unigrams_done:
+                        continue
+                    if seen_targets:
+                        #skip the unigrams already matched by other matchers
+                        pairs.extend(self._get_sentence_unigram_pairs(
+                            type_ids, target_values.get_values(), contexts,
+                            seen_targets))
+                    else:
+                        pairs.extend(unigram_pairs[k])
+                    unigrams_done = True
+                    continue
+                for match in group.get_matches(sentence):
+                    positions = tuple(t.i for t in match.tokens)
+                    if positions in seen_targets or \
+                        unigrams_done and len(positions) == 1:
+                        continue
+                    seen_targets.add(positions)
+                    if self.skip_target(match):
+                        continue
+                    if encode:
+                        target = self.encode_target(match)
+                    else:
+                        target = match.format(self.target_format)
+                    for p in feature_extractor.get_window_positions(positions,
+                        len(sentence)):
+                        context = contexts[type_ids[p]]
+                        if context is not None:
+                            pairs.append((target, context))
+        return pairs
+
+    def _get_sentence_unigram_pairs(self, type_ids, targets, contexts,
+                                    exclude=None):
+        '''
+        Returns the pairs of the unigram targets of a sentence
+        type_ids: the type ids of the tokens of the sentence
+        targets, contexts: the values of the types (see TypeValues)
+        exclude: a set of targets (tuples of positions) to skip (optional)
+        '''
+        w = self.feature_extractor.w
+        n = len(type_ids)
+        pairs = []
+        for i in xrange(n):
+            target = targets[type_ids[i]]
+            if target is None or exclude and (i,) in exclude:
+                continue
+            lend = max(0,i-w) if w else 0
+            rend = min(n,i+(w+1)) if w else n
+            for p in chain(xrange(lend, i), xrange(i+1, rend)):
+                context = contexts[type_ids[p]]
+                if context is not None:
+                    pairs.append((target, context))
+        return pairs
+
+    def _get_block_unigram_pairs(self, block, target_values, context_values):
+        '''
+        Returns, for each sentence of a SentenceBlock, the pairs of its unigram
+        targets, computing the windows of all the tokens of the block at once
+        with numpy
+        '''
+        targets_array, valid_targets = target_values.get_arrays()
+        contexts_array, valid_contexts = context_values.get_arrays()
+        offsets = numpy.array(block.offsets, dtype=numpy.int64)
+        lengths = numpy.diff(offsets)
+        type_ids = numpy.array(block.columns.get('type_id', []),
+            dtype=numpy.int64)
+        #bounds of the sentence of each token
+        sentence_of = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        starts = offsets[:-1][sentence_of]
+        ends = offsets[1:][sentence_of]
+        targets = numpy.nonzero(valid_targets[type_ids])[0]
+        w = self.feature_extractor.w
+        #window of each target, clipped to its sentence, so that the arrays
+        #only grow with the number of pairs (not with the longest sentence)
+        lends = starts[targets]
+        rends = ends[targets]
+        if w:
+            lends = numpy.maximum(lends, targets - w)
+            rends = numpy.minimum(rends, targets + (w + 1))
+        counts = rends - lends
+        #the context positions of all the targets, one after the other
+        rows = numpy.repeat(numpy.arange(len(targets)), counts)
+        firsts = numpy.cumsum(counts) - counts
+        positions = numpy.arange(counts.sum()) + (lends - firsts)[rows]
+        valid = positions != targets[rows]
+        valid &= valid_contexts[type_ids[positions]]
+        pair_targets = targets[rows[valid]]
+        pair_contexts = positions[valid]
+        pairs = zip(targets_array[type_ids[pair_targets]].tolist(),
+            contexts_array[type_ids[pair_contexts]].tolist())
+        bounds = numpy.searchsorted(pair_targets, offsets).tolist()
+        return [pairs[bounds[k]:bounds[k+1]] for k in xrange(len(block))]
+
 class LexicalFeature(object):
     def __init__(self, chunk, pm, token):
         '''
@@ -137,20 +505,57 @@ class BOWFeatureExtractor(object):
         self.w = w 
         self.context_words = context_words
         self.context_format = context_format
+        self.lexicon = None
 
     def initialize(self):
         if self.context_words:
-            context_words_file = self.context_words
-            self.context_words = set(w.strip() for w in file(context_words_file))
-            self.context_words_ids = {w.strip():i for i,w in
-                enumerate(file(context_words_file))}
-            self.ids_context_words = list(w.strip() for w in file(context_words_file))
+            vocabulary = open_vocabulary(self.context_words)
+            self.context_words = vocabulary
+            self.context_words_ids = vocabulary.ids
+            self.ids_context_words = vocabulary
+
+    def set_lexicon(self, lexicon):
+        '''
+        Memoizes per token type (see readers.Lexicon) the validation and the
+        encoding of the features read with the given lexicon
+        '''
+        if lexicon is not None and \
+            lexicon.format_table(self.context_format) is None:
+            #the context format does not only depend on the type
+            lexicon = None
+        self.lexicon = lexicon
+        if lexicon is None:
+            return
+        context_formats = lexicon.format_table(self.context_format)
+        if self.context_words:
+            self.valid_types = lexicon.table(lambda type_id:
+                context_formats[type_id] in self.context_words)
+            self.context_codes = lexicon.table(lambda type_id:
+                self.context_words_ids[context_formats[type_id]])
+        else:
+            self.valid_types = None
+            self.context_codes = context_formats
     
+    def get_type_value(self, encode, type_id):
+        '''
+        Returns the encoded (or formatted) feature of a type, or None if it is
+        not a valid feature (requires a lexicon)
+        '''
+        if self.valid_types is not None and not self.valid_types[type_id]:
+            return None
+        if encode:
+            return self.context_codes[type_id]
+        return self.lexicon.format_table(self.context_format)[type_id]
+
     def is_valid_feature(self, t):
+        if self.lexicon is not None:
+            return self.valid_types is None or self.valid_types[t['type_id']]
         return not self.context_words or t.format(self.context_format) in\
             self.context_words
 
     def encode(self, t):
+        if self.lexicon is not None:
+            return self.context_codes[t.token['type_id']]
         if self.context_words:
             return self.context_words_ids[t.format(self.context_format)]
         else:
@@ -163,66 +568,69 @@ class BOWFeatureExtractor(object):
             return t
             
         
-    def get_features(self, target, chunk):
+    def get_validator(self, chunk):
+        '''
+        Returns a function that tells whether the token at a given position
+        of chunk is a valid feature
+        '''
+        if self.lexicon is not None:
+            if self.valid_types is None:
+                return lambda p: True
+            valid_types = self.valid_types
+            type_ids = chunk.columns['type_id']
+            return lambda p: valid_types[type_ids[p]]
+        if not self.context_words:
+            return lambda p: True
+        return lambda p: self.is_valid_feature(Token(chunk, p))
+
+    def get_window(self, positions, n):
+        '''
+        Returns the list of (positional marker, position) of the context
+        of a target made of the tokens at the given positions of a sentence of
+        length n
+        '''
+        w = self.w
         #FIXME: generalize!!!!!
-        if len(target.tokens) == 1:
-            i = chunk.get_token_pos(target.tokens[0])
+        if len(positions) == 1:
+            i, = positions
             #only care about linear order
-            sentence = chunk.linear()
-            w = self.w
-            #print coocurrences
             lend = max(0,i-w) if w else 0
-            for lt in sentence[lend:i]:
-                if self.is_valid_feature(lt):
-                    yield LexicalFeature(chunk, "l", lt)
-            rend = min(len(sentence),i+(w+1)) if w else len(sentence)
-            for rt in sentence[i+1:rend]:
-                if self.is_valid_feature(rt):
-                    yield LexicalFeature(chunk, "r", rt)
+            rend = min(n,i+(w+1)) if w else n
+            return [("l", p) for p in xrange(lend, i)] + \
+                [("r", p) for p in xrange(i+1, rend)]
         else:
             #for the time being, asume bigram match
             #FIXME: generalize to n-gram
-            t, comp_t = target.tokens
-            t_pos = chunk.get_token_pos(t)
-            comp_t_pos = chunk.get_token_pos(comp_t)
-            #only care about linear order
-            sentence = chunk.linear()
+            t_pos, comp_t_pos = positions
             #put the composed words in order
-            if t_pos < comp_t_pos:
-                lcomp_t = t
-                rcomp_t = comp_t
-                l = t_pos
-                r = comp_t_pos
-            else:
-                lcomp_t = comp_t
-                rcomp_t = t
-                l = comp_t_pos
-                r = t_pos
-            #yield coocurrences
-            w = self.w
-            #count left of first composed word
-            #and print context as "l" (left)
+            l, r = min(t_pos, comp_t_pos), max(t_pos, comp_t_pos)
+            #left of first composed word
+            #as "l" (left)
             lend = max(0,l-w) if w else 0
-            for lt in sentence[lend:l]:
-                if self.is_valid_feature(lt):
-                    yield LexicalFeature(chunk, "l", lt)
-            #count right of first and left of second in range of
+            #right of first and left of second in range of
             #the first
-            #and print context as "c" (center)
+            #as "c" (center)
             #FIXME: is this even useful?
             lmid = min(r,l+(w+1)) if w else r
-            for ct in sentence[l+1:lmid]:
-                if self.is_valid_feature(ct):
-                    yield LexicalFeature(chunk, "c", ct)
-            #count right of first and left of second in range of
+            #right of first and left of second in range of
             #the second
-            #and print context as "r" (right)
+            #as "c" (center)
             rmid = max(lmid,r-w) if w else r
-            for ct in sentence[rmid:r]:
-                if self.is_valid_feature(ct):
-                    yield LexicalFeature(chunk, "c", ct)
-            rend = min(len(sentence), r+(w+1)) if w else \
-                len(sentence)
-            for rt in sentence[r+1:rend]:
-                if self.is_valid_feature(rt):
-                    yield LexicalFeature(chunk, "r", rt)
+            rend = min(n, r+(w+1)) if w else n
+            return [("l", p) for p in xrange(lend, l)] + \
+                [("c", p) for p in xrange(l+1, lmid)] + \
+                [("c", p) for p in xrange(rmid, r)] + \
+                [("r", p) for p in xrange(r+1, rend)]
+
+    def get_window_positions(self, positions, n):
+        '''
+        Returns the positions of the context of a target (see get_window)
+        '''
+        return [p for _, p in self.get_window(positions, n)]
+
+    def get_features(self, target, chunk):
+        is_valid = self.get_validator(chunk)
+        positions = [chunk.get_token_pos(t) for t in target.tokens]
+        for pm, p in self.get_window(positions, len(chunk)):
+            if is_valid(p):
+                yield LexicalFeature(chunk, pm, Token(chunk, p))
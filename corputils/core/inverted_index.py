@@ -0,0 +1,361 @@
+'''
+Inverted index of a (plain text) DP corpus.
+
+The index is stored next to the corpus in a sidecar file (corpus + SUFFIX)
+and records, for every (lowercased) word, lemma and pos, the sentences in
+which it occurs, so that a query only needs to parse the sentences that
+contain the words it requires. Sentences are numbered as in the sentence
+index (see sentence_index), which is used to read them.
+magic: 8 bytes
+separator: little-endian uint16 length followed by the sentence separator
+n_sentences, n_terms: little-endian int64
+term_offsets: n_terms + 1 int64 offsets of the terms in the terms section
+posting_offsets: n_terms + 1 int64 offsets of the posting lists in the
+postings section
+terms: the sorted terms ("field\\tvalue"), one after the other
+postings: the posting list of each term: the sentence ids in increasing
+order, delta encoded as (LEB128) varints
+'''
+import bisect
+import heapq
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from array import array
+from itertools import groupby
+from operator import itemgetter
+
+from corputils.core.readers import DPCorpusReader, read_blocks
+from corputils.core.sentence_index import open_sentences
+
+SUFFIX = '.iidx'
+MAGIC = 'IIDX\x00\x00\x00\x01'
+OFFSET_SIZE = 8
+FIELDS = ('word', 'lemma', 'pos')
+#number of postings buffered in memory before writing them to a run file
+RUN_SIZE = 1 << 22
+#lengths of the term and the postings of each entry of a run file
+RUN_HEADER = struct.Struct('<II')
+
+def get_index_filename(corpus_file):
+    return corpus_file + SUFFIX
+
+def encode_postings(ids):
+    '''Delta encodes an increasing sequence of sentence ids as varints'''
+    out = array('B')
+    last = 0
+    for i in ids:
+        delta = i - last
+        last = i
+        while delta >= 0x80:
+            out.append(delta & 0x7F | 0x80)
+            delta >>= 7
+        out.append(delta)
+    return out.tostring()
+
+def decode_postings(data):
+    '''Decodes the sentence ids encoded by encode_postings'''
+    ids = []
+    last = 0
+    delta = 0
+    shift = 0
+    for b in array('B', data):
+        delta |= (b & 0x7F) << shift
+        if b & 0x80:
+            shift += 7
+        else:
+            last += delta
+            ids.append(last)
+            delta = 0
+            shift = 0
+    return ids
+
+def _write_run(postings, run_file):
+    '''Writes the buffered postings to a run file sorted by term'''
+    with open(run_file, 'wb') as f:
+        for term in sorted(postings):
+            data = encode_postings(postings[term])
+            f.write(RUN_HEADER.pack(len(term), len(data)))
+            f.write(term)
+            f.write(data)
+
+def _read_run(run_file, k):
+    '''Yields the (term, run number, postings) of a run file'''
+    with open(run_file, 'rb') as f:
+        while True:
+            header = f.read(RUN_HEADER.size)
+            if not header:
+                break
+            term_len, data_len = RUN_HEADER.unpack(header)
+            term = f.read(term_len)
+            yield term, k, f.read(data_len)
+
+def build_inverted_index(corpus_file, separator='s', index_file=None):
+    '''
+    Builds the inverted index of corpus_file and writes it to index_file
+    (by default, next to the corpus). Returns the index file.
+    The postings are accumulated in memory up to RUN_SIZE entries, written
+    to sorted run files and merged at the end.
+    '''
+    index_file = index_file or get_index_filename(corpus_file)
+    end_separator = '/{0}'.format(separator)
+    n_fields = len(FIELDS)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(
+        index_file)))
+    try:
+        runs = []
+        postings = {}
+        n_postings = 0
+        n_sentences = 0
+        sentence_terms = set()
+        field_prefixes = ['{0}\t'.format(field) for field in FIELDS]
+        with open(corpus_file, 'rb') as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if line[:1] == '<' and line[-1:] == '>':
+                    #sentences are delimited as in the sentence index
+                    if line.strip('<>') != end_separator:
+                        #skip beggining of sentence or text markers
+                        continue
+                    for term in sentence_terms:
+                        try:
+                            postings[term].append(n_sentences)
+                        except KeyError:
+                            postings[term] = array('l', [n_sentences])
+                    n_postings += len(sentence_terms)
+                    sentence_terms.clear()
+                    n_sentences += 1
+                    if n_postings >= RUN_SIZE:
+                        runs.append(os.path.join(tmp_dir, str(len(runs))))
+                        _write_run(postings, runs[-1])
+                        postings = {}
+                        n_postings = 0
+                else:
+                    for field_prefix, value in zip(field_prefixes,
+                        line.lower().split('\t', n_fields)[:n_fields]):
+                        sentence_terms.add(field_prefix + value)
+        #terms after the last separator are discarded (as DPCorpusReader does)
+        if postings:
+            runs.append(os.path.join(tmp_dir, str(len(runs))))
+            _write_run(postings, runs[-1])
+        del postings
+        term_offsets = array('l', [0])
+        posting_offsets = array('l', [0])
+        terms_file = os.path.join(tmp_dir, 'terms')
+        postings_file = os.path.join(tmp_dir, 'postings')
+        with open(terms_file, 'wb') as f_terms, \
+             open(postings_file, 'wb') as f_postings:
+            #runs hold increasing sentence ids, so merging them in order
+            #keeps the posting lists sorted
+            merged = heapq.merge(*[_read_run(run, k) for k, run in
+                enumerate(runs)])
+            for term, entries in groupby(merged, itemgetter(0)):
+                ids = []
+                for _, _, data in entries:
+                    ids.extend(decode_postings(data))
+                data = encode_postings(ids)
+                f_terms.write(term)
+                f_postings.write(data)
+                term_offsets.append(term_offsets[-1] + len(term))
+                posting_offsets.append(posting_offsets[-1] + len(data))
+        n_terms = len(term_offsets) - 1
+        with open(index_file, 'wb') as f_index:
+            f_index.write(MAGIC)
+            f_index.write(struct.pack('<H', len(separator)))
+            f_index.write(separator)
+            f_index.write(struct.pack('<2q', n_sentences, n_terms))
+            for offsets in (term_offsets, posting_offsets):
+                f_index.write(struct.pack('<{0}q'.format(len(offsets)),
+                    *offsets))
+            for filename in (terms_file, postings_file):
+                with open(filename, 'rb') as f:
+                    shutil.copyfileobj(f, f_index)
+    finally:
+        shutil.rmtree(tmp_dir)
+    logging.info("Indexed {0} terms in {1} sentences of {2}".format(n_terms,
+        n_sentences, corpus_file))
+    return index_file
+
+class InvertedIndex(object):
+    '''
+    Memory-mapped inverted index of a corpus file
+    '''
+    def __init__(self, corpus_file, index_file=None):
+        self.corpus_file = corpus_file
+        self.index_file = index_file or get_index_filename(corpus_file)
+        with open(self.index_file, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError("{0} is not an inverted index".format(
+                self.index_file))
+        pos = len(MAGIC)
+        sep_len, = struct.unpack_from('<H', self.data, pos)
+        pos += 2
+        self.separator = self.data[pos:pos+sep_len]
+        pos += sep_len
+        self.n_sentences, self.n_terms = struct.unpack_from('<2q', self.data,
+            pos)
+        pos += 2 * OFFSET_SIZE
+        self.term_offsets_pos = pos
+        self.posting_offsets_pos = pos + (self.n_terms + 1) * OFFSET_SIZE
+        self.terms_pos = pos + 2 * (self.n_terms + 1) * OFFSET_SIZE
+        self.postings_pos = self.terms_pos + self._get_offset(
+            self.term_offsets_pos, self.n_terms)
+
+    def __len__(self):
+        return self.n_terms
+
+    def _get_offset(self, base, k):
+        return struct.unpack_from('<q', self.data, base + k * OFFSET_SIZE)[0]
+
+    def get_term(self, k):
+        start = self._get_offset(self.term_offsets_pos, k)
+        end = self._get_offset(self.term_offsets_pos, k + 1)
+        return self.data[self.terms_pos+start:self.terms_pos+end]
+
+    def __getitem__(self, k):
+        '''Returns the k-th term (the index can be bisected)'''
+        if not 0 <= k < self.n_terms:
+            raise IndexError(k)
+        return self.get_term(k)
+
+    def get_postings(self, k):
+        '''Returns the sentence ids of the k-th term'''
+        start = self._get_offset(self.posting_offsets_pos, k)
+        end = self._get_offset(self.posting_offsets_pos, k + 1)
+        return decode_postings(self.data[self.postings_pos+start:
+            self.postings_pos+end])
+
+    def find_terms(self, field, value, prefix=False):
+        '''
+        Returns the numbers of the terms of field equal to (or starting with,
+        if prefix is True) value
+        '''
+        term = '{0}\t{1}'.format(field, value)
+        k = bisect.bisect_left(self, term)
+        if not prefix:
+            return [k] if k < self.n_terms and self.get_term(k) == term else []
+        terms = []
+        while k < self.n_terms and self.get_term(k).startswith(term):
+            terms.append(k)
+            k += 1
+        return terms
+
+    def get_sentences(self, field, words, prefix=False):
+        '''
+        Returns the set of sentences with a token whose (lowercased) field is
+        equal to (or starts with, if prefix is True) one of the words
+        '''
+        sentences = set()
+        for word in words:
+            for k in self.find_terms(field, word, prefix):
+                sentences.update(self.get_postings(k))
+        return sentences
+
+    def get_candidates(self, requirements):
+        '''
+        Returns the sorted list of the sentences that satisfy the required
+        words (see sentence_matchers.get_requirements) of some matcher
+        '''
+        candidates = set()
+        for required_words in requirements:
+            matcher_candidates = None
+            #the most selective conditions first
+            for field, words, prefix in sorted(required_words,
+                key=lambda (field, words, prefix): len(words)):
+                sentences = self.get_sentences(field, words, prefix)
+                if matcher_candidates is None:
+                    matcher_candidates = sentences
+                else:
+                    matcher_candidates &= sentences
+                if not matcher_candidates:
+                    break
+            candidates |= matcher_candidates
+        return sorted(candidates)
+
+    def close(self):
+        self.data.close()
+
+def is_index_up_to_date(corpus_file, separator='s'):
+    '''Checks whether corpus_file has an up to date inverted index'''
+    index_file = get_index_filename(corpus_file)
+    if not os.path.exists(index_file) or \
+        os.path.getmtime(index_file) < os.path.getmtime(corpus_file):
+        return False
+    index = InvertedIndex(corpus_file, index_file)
+    up_to_date = index.separator == separator
+    index.close()
+    return up_to_date
+
+def check_index(corpus_file, separator='s'):
+    '''Raises a ValueError if corpus_file has no up to date inverted index'''
+    if not is_index_up_to_date(corpus_file, separator):
+        raise ValueError("{0} has no up to date inverted index (see "
+            "build_inverted_index.py)".format(corpus_file))
+
+def get_candidate_sentences(corpus_file, requirements):
+    '''
+    Returns the sorted sequence of the sentences of corpus_file that may
+    satisfy the required words of some matcher (see
+    sentence_matchers.get_requirements), according to its inverted index
+    requirements: the required words of each matcher (None returns all the
+    sentences)
+    '''
+    index = InvertedIndex(corpus_file)
+    try:
+        if requirements is None:
+            sentence_ids = xrange(index.n_sentences)
+        else:
+            sentence_ids = index.get_candidates(requirements)
+    finally:
+        index.close()
+    logging.info("Reading {0} of {1} sentences of {2}".format(
+        len(sentence_ids), index.n_sentences, corpus_file))
+    return sentence_ids
+
+class IndexedCorpusReader(object):
+    '''
+    Reads the sentences of indexed corpora that may satisfy some required
+    words (see sentence_matchers.get_requirements), skipping the others
+    without reading them. It can be used wherever a DPCorpusReader is
+    expected.
+    '''
+    def __init__(self, corpora, requirements, separator='s', to_lower=False,
+                 lexicon=None):
+        '''
+        corpora: a list of corpus files with an inverted and a sentence index
+        requirements: the required words of each matcher (None reads all the
+        sentences)
+        lexicon: a Lexicon in which the read values are interned (optional)
+        '''
+        if isinstance(corpora, basestring):
+            corpora = [corpora]
+        for corpus in corpora:
+            check_index(corpus, separator)
+        self.corpora = corpora
+        self.requirements = requirements
+        self.separator = separator
+        self.to_lower = to_lower
+        self.lexicon = lexicon
+        self.corp_format = DPCorpusReader([]).corp_format
+        self._sentences = self._read_sentences()
+
+    def _read_sentences(self):
+        for corpus in self.corpora:
+            sentence_ids = get_candidate_sentences(corpus, self.requirements)
+            for sentence in open_sentences(corpus, sentence_ids,
+                self.separator, self.to_lower, self.lexicon):
+                yield sentence
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._sentences)
+
+    def blocks(self, block_size):
+        '''Reads the corpora in SentenceBlocks of block_size sentences'''
+        return read_blocks(self, block_size)
@@ -1,60 +1,233 @@
 import logging
-import weakref
+from array import array
+from bisect import bisect_right
+from itertools import islice
+from string import Formatter
 
 class Token(object):
     '''
     Represents a token in the corpus.
-    Importantly, the token is assumed to be uniquely identified by the "data".
-    In the DP corpora this is true as long as the tokens belong to one
-    sentence. However, when the sentence boundary is crossed, this assumption
-    is usually violated. For that reason, it might be required to add an ad-hoc
-    attribute to uniquely identify each sentence.
+    A token is a lightweight view over one row of the columns stored in its
+    Sentence: it only keeps a reference to the sentence and its position in
+    it, so tokens can be created on demand and thrown away.
+    Importantly, the token is assumed to be uniquely identified by its
+    position. In the DP corpora this is true as long as the tokens belong to
+    one sentence. However, when the sentence boundary is crossed, this
+    assumption is usually violated. For that reason, it might be required to
+    add an ad-hoc attribute to uniquely identify each sentence.
     '''
-    def __init__(self, chunk, data):
+    __slots__ = ('chunk', 'i')
+
+    def __init__(self, chunk, i):
         self.chunk = chunk
-        self.data = data
-        #FIXME: ad-hoc; move
-        self.data['cat']=data['pos'][0].lower()
+        self.i = i
 
     def __getitem__(self, k):
-        return self.data[k]
+        return self.chunk.get_value(self.i, k)
 
     def __setitem__(self, k, v):
-        self.data[k] = v
+        self.chunk.columns[k][self.i] = v
+
+    @property
+    def data(self):
+        '''A dictionary with all the (derived) attributes of the token'''
+        return self.chunk.get_data(self.i)
 
     def format(self, fmt):
-        return fmt.format(**self.data)
+        return self.chunk.format_token(self.i, fmt)
 
     def __str__(self):
         return str(self.data)
 
     def __eq__(self, ot):
         return self.chunk.get_token_pos(self) == ot.chunk.get_token_pos(ot)
-        #return self.data == ot.data
+
+    def __ne__(self, ot):
+        return not self == ot
 
     def __hash__(self):
         return self.chunk.get_token_pos(self)
-        #try:
-        #    return self._hash
-        #except AttributeError:
-        #    #this might be a relly inefficient computation, so we better store it
-        #    t = tuple((k, self.data[k]) for k in sorted(self.data.keys()))
-        #    self._hash = hash(t)
-        #    return self._hash
 
     def __repr__(self):
         return "Token({0})".format(self.data)
 
-from collections import OrderedDict
+class LinearTokens(object):
+    '''
+    Sequence of the tokens of a sentence in linear order. Tokens are only
+    created for the positions that are actually accessed.
+    '''
+    __slots__ = ('sentence',)
+
+    def __init__(self, sentence):
+        self.sentence = sentence
+
+    def __len__(self):
+        return len(self.sentence)
+
+    def __getitem__(self, k):
+        sentence = self.sentence
+        if isinstance(k, slice):
+            return [Token(sentence, i) for i in
+                xrange(*k.indices(len(sentence)))]
+        if k < 0:
+            k += len(sentence)
+        if not 0 <= k < len(sentence):
+            raise IndexError(k)
+        return Token(sentence, k)
+
+    def __iter__(self):
+        sentence = self.sentence
+        for i in xrange(len(sentence)):
+            yield Token(sentence, i)
+
+#fields that only depend on the (word, lemma, pos) type of a token
+TYPE_FIELDS = ('word', 'lemma', 'pos', 'cat')
+#number of formatted types kept by a TokenFormatter (in each generation)
+FORMAT_CACHE_SIZE = 1 << 16
+
+class TokenFormatter(object):
+    '''
+    A format string compiled for tokens: formatting only reads the fields
+    the format refers to and, when they only depend on the type of the
+    token, the results are memoized in a bounded cache.
+    The cache keeps two generations of at most cache_size entries each: when
+    the current one is full it replaces the old one, which is discarded.
+    '''
+    def __init__(self, fmt, cache_size=FORMAT_CACHE_SIZE):
+        self.fmt = fmt
+        self.fields = tuple(sorted(set(name.split('.')[0].split('[')[0] for
+            _, name, _, _ in Formatter().parse(fmt) if name is not None)))
+        self.by_type = set(self.fields).issubset(TYPE_FIELDS)
+        self.cache_size = cache_size
+        self.cache = {}
+        self.old_cache = {}
+
+    def format_values(self, values):
+        '''Formats the values of the fields (in the order of self.fields)'''
+        return self.fmt.format(**dict(zip(self.fields, values)))
+
+    def __call__(self, sentence, i):
+        '''Formats the i-th token of sentence'''
+        values = tuple([sentence.get_value(i, k) for k in self.fields])
+        if not self.by_type:
+            return self.format_values(values)
+        try:
+            return self.cache[values]
+        except KeyError:
+            pass
+        try:
+            value = self.old_cache[values]
+        except KeyError:
+            value = self.format_values(values)
+        if len(self.cache) >= self.cache_size:
+            self.old_cache = self.cache
+            self.cache = {}
+        self.cache[values] = value
+        return value
+
+_formatters = {}
+def get_formatter(fmt):
+    '''Returns the (shared) TokenFormatter of fmt'''
+    try:
+        return _formatters[fmt]
+    except KeyError:
+        formatter = _formatters[fmt] = TokenFormatter(fmt)
+        return formatter
+
+class TypeTable(dict):
+    '''
+    Memoizes a function of a token type: maps a type id to the result of
+    calling func on it, computing it the first time the type is seen.
+    '''
+    def __init__(self, func):
+        super(TypeTable, self).__init__()
+        self.func = func
+
+    def __missing__(self, type_id):
+        value = self[type_id] = self.func(type_id)
+        return value
+
+class Lexicon(object):
+    '''
+    Corpus-wide vocabulary shared by the sentences read from a corpus.
+    Interns the strings of every field, so that each distinct lemma, pos or
+    dependency relation is kept only once, and assigns an integer id to
+    each (word, lemma, pos) type. Anything that only depends on the type of
+    a token (e.g. its formatting) can then be computed once per type and
+    looked up by id in a TypeTable.
+    '''
+    def __init__(self):
+        self.strings = {}
+        self.types = {}
+        self.type_values = []
+        self.format_tables = {}
+
+    def intern(self, s):
+        return self.strings.setdefault(s, s)
+
+    def get_type_id(self, word, lemma, pos):
+        key = (word, lemma, pos)
+        try:
+            return self.types[key]
+        except KeyError:
+            type_id = self.types[key] = len(self.type_values)
+            self.type_values.append(key)
+            return type_id
+
+    def get_type_data(self, type_id):
+        word, lemma, pos = self.type_values[type_id]
+        return {'word': word, 'lemma': lemma, 'pos': pos,
+                'cat': pos[0].lower()}
+
+    def __len__(self):
+        return len(self.type_values)
+
+    def table(self, func):
+        return TypeTable(func)
+
+    def format_table(self, fmt):
+        '''
+        Returns a TypeTable with the types formatted according to fmt, or None
+        if fmt refers to fields that do not depend on the type (e.g. {id})
+        '''
+        try:
+            return self.format_tables[fmt]
+        except KeyError:
+            formatter = get_formatter(fmt)
+            if formatter.by_type:
+                def format_type(type_id):
+                    data = self.get_type_data(type_id)
+                    return formatter.format_values([data[k] for k in
+                        formatter.fields])
+                table = self.table(format_type)
+            else:
+                table = None
+            self.format_tables[fmt] = table
+            return table
+
 class Sentence(object):
-    def __init__(self, corp_format, corp_types, to_lower) :
-        self.tokens = OrderedDict()
-        self.linear_tokens = []
-        #self.rev_linear_tokens = {}
+    '''
+    A sentence stored column-wise: there is one list per field in the
+    corpus format (word, lemma, pos, ...) and the i-th element of every
+    column belongs to the i-th token. Token objects are views built on
+    demand.
+    When a Lexicon is given, the values are interned in it and the extra
+    column "type_id" holds the id of the type of each token.
+    '''
+    __slots__ = ('columns', 'plain_text', 'corp_format', 'corp_types',
+        'to_lower', 'lexicon', '_id_index', '_formatted')
+
+    def __init__(self, corp_format, corp_types, to_lower, lexicon=None) :
+        self.columns = dict((k, []) for k in corp_format)
         self.plain_text = []
         self.corp_format = corp_format
         self.corp_types = corp_types
         self.to_lower = to_lower
+        self.lexicon = lexicon
+        self._id_index = None
+        self._formatted = {}
+        if lexicon is not None:
+            self.columns['type_id'] = []
 
     def push_token(self, line, splitted_line=None):
         self.plain_text.append(line)
@@ -62,30 +235,123 @@ class Sentence(object):
             t = line.split('\t')
         else:
             t = splitted_line
-        data = dict(zip(self.corp_format, t))
+        columns = self.columns
+        for i, k in enumerate(self.corp_format):
+            columns[k].append(t[i] if i < len(t) else None)
         if self.to_lower:
-            data['word'] = data['word'].lower()
-            data['lemma'] = data['lemma'].lower()
-        for k,conv in self.corp_types:
-            data[k] = conv(data[k])
-        token = Token(weakref.proxy(self), data)
-        self.linear_tokens.append(token)
-        self.tokens[data['id']] = token
-        token['sentence_pos'] = len(self.linear_tokens)-1
-        #self.rev_linear_tokens[token] = len(self.linear_tokens)-1
+            columns['word'][-1] = columns['word'][-1].lower()
+            columns['lemma'][-1] = columns['lemma'][-1].lower()
+        for k,conv in self.corp_types.iteritems():
+            columns[k][-1] = conv(columns[k][-1])
+        if self.lexicon is not None:
+            self._intern_last_token()
+        if self._id_index is not None or self._formatted:
+            #the tokens were already looked up or formatted
+            self._id_index = None
+            self._formatted = {}
+
+    def push_columns(self, columns, plain_text):
+        '''
+        Appends several tokens at once.
+        columns: a dictionary from each field in the corpus format to the list
+        of values of the new tokens
+        plain_text: the corresponding lines
+        '''
+        self.plain_text.extend(plain_text)
+        for k in self.corp_format:
+            values = columns[k]
+            if self.to_lower and k in ('word', 'lemma'):
+                values = [v.lower() for v in values]
+            if k in self.corp_types:
+                values = map(self.corp_types[k], values)
+            self.columns[k].extend(values)
+        if self.lexicon is not None:
+            self._intern_tokens(len(self.plain_text) - len(plain_text))
+        if self._id_index is not None or self._formatted:
+            self._id_index = None
+            self._formatted = {}
+
+    def _intern_last_token(self):
+        '''Interns the values of the last token'''
+        lexicon = self.lexicon
+        intern = lexicon.intern
+        columns = self.columns
+        for k in self.corp_format:
+            column = columns[k]
+            column[-1] = intern(column[-1])
+        columns['type_id'].append(lexicon.get_type_id(columns['word'][-1],
+            columns['lemma'][-1], columns['pos'][-1]))
+
+    def _intern_tokens(self, start):
+        '''Interns the values of the tokens from start on'''
+        lexicon = self.lexicon
+        intern = lexicon.intern
+        columns = self.columns
+        for k in self.corp_format:
+            column = columns[k]
+            column[start:] = [intern(v) for v in column[start:]]
+        columns['type_id'].extend(map(lexicon.get_type_id,
+            columns['word'][start:], columns['lemma'][start:],
+            columns['pos'][start:]))
+
+    def format_token(self, i, fmt):
+        '''
+        Formats the i-th token. Each token is formatted at most once per
+        format (and, when possible, once per type)
+        '''
+        try:
+            formatted = self._formatted[fmt]
+        except KeyError:
+            formatted = self._formatted[fmt] = [None] * len(self)
+        value = formatted[i]
+        if value is None:
+            table = None
+            if self.lexicon is not None:
+                table = self.lexicon.format_table(fmt)
+            if table is not None:
+                value = table[self.columns['type_id'][i]]
+            else:
+                value = get_formatter(fmt)(self, i)
+            formatted[i] = value
+        return value
+
+    def get_value(self, i, k):
+        '''Returns the attribute k of the i-th token'''
+        try:
+            return self.columns[k][i]
+        except KeyError:
+            if k == 'cat':
+                #FIXME: ad-hoc; move
+                return self.columns['pos'][i][0].lower()
+            elif k == 'sentence_pos':
+                return i
+            raise
+
+    def get_data(self, i):
+        '''Returns a dictionary with all the attributes of the i-th token'''
+        data = dict((k, col[i]) for k, col in self.columns.iteritems())
+        data['cat'] = data['pos'][0].lower()
+        data['sentence_pos'] = i
+        return data
 
     def get_token_pos(self, token):
-        return token['sentence_pos']
-        #return self.rev_linear_tokens[token]
+        return token.i
 
     def linear(self):
-        return self.linear_tokens
+        return LinearTokens(self)
+
+    def __len__(self):
+        return len(self.plain_text)
 
     def __getitem__(self, k):
-        return self.tokens[k]
+        '''Returns the token with id k'''
+        if self._id_index is None:
+            self._id_index = dict((token_id, i) for i, token_id in
+                enumerate(self.columns['id']))
+        return Token(self, self._id_index[k])
 
     def __iter__(self):
-        return iter(self.tokens.values())
+        return iter(self.linear())
 
     def get_plain_text(self):
         return self.plain_text
@@ -93,23 +359,85 @@ class Sentence(object):
     def __str__(self):
         return "\n".join(self.plain_text)
 
+class SentenceBlock(object):
+    '''
+    A block of consecutive sentences. Besides the sentences themselves, it
+    exposes their columns concatenated into flat lists ("columns"), where the
+    tokens of the k-th sentence are in [offsets[k], offsets[k+1]).
+    '''
+    __slots__ = ('sentences', 'offsets', '_columns')
+
+    def __init__(self, sentences):
+        self.sentences = sentences
+        self.offsets = array('l', [0])
+        for sentence in sentences:
+            self.offsets.append(self.offsets[-1] + len(sentence))
+        self._columns = None
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            columns = {}
+            for sentence in self.sentences:
+                for k, column in sentence.columns.iteritems():
+                    columns.setdefault(k, []).extend(column)
+            self._columns = columns
+        return self._columns
+
+    def locate(self, j):
+        '''Returns the (sentence, position) of the j-th token of the block'''
+        k = bisect_right(self.offsets, j) - 1
+        return k, j - self.offsets[k]
+
+    def n_tokens(self):
+        return self.offsets[-1]
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def __getitem__(self, k):
+        return self.sentences[k]
+
+    def __iter__(self):
+        return iter(self.sentences)
+
+def read_blocks(corpus_reader, block_size):
+    '''Yields SentenceBlocks of (at most) block_size sentences'''
+    corpus_reader = iter(corpus_reader)
+    while True:
+        sentences = list(islice(corpus_reader, block_size))
+        if not sentences:
+            break
+        yield SentenceBlock(sentences)
+
 class DPCorpusReader(object):
     '''
     Reads sentences from dependency parsed corpora
     '''
-    def __init__(self, corpora, separator='s', to_lower=False):
+    def __init__(self, corpora, separator='s', to_lower=False, lexicon=None,
+                 line_filter=None):
+        '''
+        lexicon: a Lexicon in which the read values are interned (optional)
+        line_filter: a function that takes the lines of a sentence and returns
+        False if it can be skipped without parsing it (optional)
+        '''
         self.end_separator = '/{0}'.format(separator)
         self.corpora = corpora
         self.corp_format = ('word', 'lemma', 'pos', 'id', 'dep_id',
             'dep_rel')
         self.corp_types = {}#{'id': int, 'dep_id': int} #is it needed?
         self.to_lower = to_lower
+        self.lexicon = lexicon
+        self.line_filter = line_filter
 
     def __iter__(self):
         return self
 
     def next(self):
-        sentence = Sentence(self.corp_format, self.corp_types, self.to_lower)
+        if self.line_filter:
+            return self._next_filtered()
+        sentence = Sentence(self.corp_format, self.corp_types, self.to_lower,
+            self.lexicon)
         for line in self.corpora:
             line = line.rstrip('\n')
             if line.strip('<>') == self.end_separator:
@@ -121,3 +449,27 @@ class DPCorpusReader(object):
                 splitted_line = line.split("\t")
                 sentence.push_token(line, splitted_line)
         raise StopIteration
+
+    def _next_filtered(self):
+        '''Returns the next sentence whose lines pass the line filter'''
+        lines = []
+        for line in self.corpora:
+            line = line.rstrip('\n')
+            if line.strip('<>') == self.end_separator:
+                if self.line_filter(lines):
+                    sentence = Sentence(self.corp_format, self.corp_types,
+                        self.to_lower, self.lexicon)
+                    for line in lines:
+                        sentence.push_token(line, line.split("\t"))
+                    return sentence
+                lines = []
+            elif line[0] == '<' and line[-1] == '>':
+                #skip beggining of sentence or text markers
+                continue
+            else:
+                lines.append(line)
+        raise StopIteration
+
+    def blocks(self, block_size):
+        '''Reads the corpus in SentenceBlocks of block_size sentences'''
+        return read_blocks(self, block_size)
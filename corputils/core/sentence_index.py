@@ -0,0 +1,314 @@
+'''
+Sentence-boundary index of a (plain text) DP corpus.
+
+The index is stored next to the corpus in a sidecar file (corpus + SUFFIX)
+and records the byte offsets of the sentence and text boundaries, so that
+any range of sentences can be read by seeking into the corpus instead of
+scanning it from the beginning:
+magic: 8 bytes
+separator: little-endian uint16 length followed by the sentence separator
+n_sentences, n_texts: little-endian int64
+sentence_ends: n_sentences int64 offsets of the byte following each
+end-of-sentence marker
+sentence_starts: n_sentences int64 offsets of each begin-of-sentence marker
+(-1 if the sentence has none)
+text_starts: n_texts int64 offsets of each <text> marker
+
+Sentences are delimited as in DPCorpusReader: the k-th sentence consists of
+all the lines following the (k-1)-th end-of-sentence marker up to its own.
+Compressed corpora cannot be indexed, since they cannot be seeked.
+'''
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+from bisect import bisect_left
+from itertools import groupby
+
+from corputils.core.aux import get_compression
+from corputils.core.readers import DPCorpusReader
+
+SUFFIX = '.sidx'
+MAGIC = 'SIDX\x00\x00\x00\x01'
+OFFSET_SIZE = 8
+#number of offsets kept in memory while building an index
+OFFSETS_CHUNK = 65536
+
+def get_index_filename(corpus_file):
+    return corpus_file + SUFFIX
+
+class _OffsetWriter(object):
+    '''Writes int64 offsets to a file in chunks of OFFSETS_CHUNK'''
+    def __init__(self, f):
+        self.f = f
+        self.chunk = []
+        self.n = 0
+
+    def append(self, offset):
+        self.chunk.append(offset)
+        if len(self.chunk) >= OFFSETS_CHUNK:
+            self.flush()
+
+    def flush(self):
+        self.f.write(struct.pack('<{0}q'.format(len(self.chunk)), *self.chunk))
+        self.n += len(self.chunk)
+        self.chunk = []
+
+    def __len__(self):
+        return self.n + len(self.chunk)
+
+def build_sentence_index(corpus_file, separator='s', index_file=None):
+    '''
+    Builds the index of corpus_file in one streaming pass and writes it to
+    index_file (by default, next to the corpus). Returns the index file.
+    '''
+    index_file = index_file or get_index_filename(corpus_file)
+    end_separator = '/{0}'.format(separator)
+    begin_separator = separator
+    sentence_start = -1
+    offset = 0
+    with open(index_file, 'wb') as f_index:
+        f_index.write(MAGIC)
+        f_index.write(struct.pack('<H', len(separator)))
+        f_index.write(separator)
+        counts_pos = f_index.tell()
+        f_index.write(struct.pack('<2q', 0, 0))
+        #the ends are written in place, the other offsets go after them
+        with tempfile.TemporaryFile() as f_starts, \
+            tempfile.TemporaryFile() as f_texts:
+            sentence_ends = _OffsetWriter(f_index)
+            sentence_starts = _OffsetWriter(f_starts)
+            text_starts = _OffsetWriter(f_texts)
+            with open(corpus_file, 'rb') as f:
+                for line in f:
+                    line_start = offset
+                    offset += len(line)
+                    if line[0] != '<':
+                        continue
+                    marker = line.rstrip('\n')
+                    if marker[-1] != '>':
+                        continue
+                    marker = marker.strip('<>')
+                    if marker == end_separator:
+                        sentence_ends.append(offset)
+                        sentence_starts.append(sentence_start)
+                        sentence_start = -1
+                    elif marker == begin_separator:
+                        sentence_start = line_start
+                    elif marker.startswith('text'):
+                        text_starts.append(line_start)
+            for offsets in (sentence_ends, sentence_starts, text_starts):
+                offsets.flush()
+            for f_offsets in (f_starts, f_texts):
+                f_offsets.seek(0)
+                shutil.copyfileobj(f_offsets, f_index)
+        f_index.seek(counts_pos)
+        f_index.write(struct.pack('<2q', len(sentence_ends), len(text_starts)))
+    logging.info("Indexed {0} sentences and {1} texts of {2}".format(
+        len(sentence_ends), len(text_starts), corpus_file))
+    return index_file
+
+class SentenceIndex(object):
+    '''
+    Memory-mapped sentence-boundary index of a corpus file
+    '''
+    def __init__(self, corpus_file, index_file=None):
+        self.corpus_file = corpus_file
+        self.index_file = index_file or get_index_filename(corpus_file)
+        with open(self.index_file, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError("{0} is not a sentence index".format(
+                self.index_file))
+        pos = len(MAGIC)
+        sep_len, = struct.unpack_from('<H', self.data, pos)
+        pos += 2
+        self.separator = self.data[pos:pos+sep_len]
+        pos += sep_len
+        self.n_sentences, self.n_texts = struct.unpack_from('<2q', self.data,
+            pos)
+        pos += 2 * OFFSET_SIZE
+        self.sentence_ends_pos = pos
+        self.sentence_starts_pos = pos + self.n_sentences * OFFSET_SIZE
+        self.text_starts_pos = pos + 2 * self.n_sentences * OFFSET_SIZE
+
+    def __len__(self):
+        return self.n_sentences
+
+    def _get_offset(self, base, k):
+        return struct.unpack_from('<q', self.data, base + k * OFFSET_SIZE)[0]
+
+    def sentence_end(self, k):
+        '''Offset of the byte following the end marker of the k-th sentence'''
+        return self._get_offset(self.sentence_ends_pos, k)
+
+    def sentence_start(self, k):
+        '''Offset of the begin marker of the k-th sentence (-1 if none)'''
+        return self._get_offset(self.sentence_starts_pos, k)
+
+    def text_start(self, k):
+        '''Offset of the <text> marker of the k-th text'''
+        return self._get_offset(self.text_starts_pos, k)
+
+    def find_text(self, k):
+        '''
+        Returns the text of the k-th sentence (-1 if it comes before the
+        first <text> marker)
+        '''
+        offset = self.sentence_end(k)
+        lo, hi = 0, self.n_texts
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.text_start(mid) < offset:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo - 1
+
+    def text_ranges(self):
+        '''
+        Returns the sentence ranges [start, end) of the texts of the corpus
+        (including the sentences before the first <text> marker, if any)
+        '''
+        starts = [self.find_sentence(self.text_start(t)) for t in
+            xrange(self.n_texts)]
+        if not starts or starts[0] > 0:
+            starts.insert(0, 0)
+        ends = starts[1:] + [self.n_sentences]
+        return [(start, end) for start, end in zip(starts, ends) if
+            end > start]
+
+    def get_span(self, start, end):
+        '''Returns the byte range [b_start, b_end) of sentences [start, end)'''
+        b_start = self.sentence_end(start - 1) if start > 0 else 0
+        b_end = self.sentence_end(end - 1) if end > start else b_start
+        return b_start, b_end
+
+    def find_sentence(self, offset):
+        '''Returns the first sentence that ends after the given byte offset'''
+        lo, hi = 0, self.n_sentences
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sentence_end(mid) <= offset:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def balanced_ranges(self, n, whole_texts=False):
+        '''
+        Splits the corpus in (at most) n sentence ranges [start, end) of
+        roughly the same size in bytes. If whole_texts is True, the ranges
+        only end at text boundaries.
+        '''
+        if not self.n_sentences:
+            return []
+        total = self.sentence_end(self.n_sentences - 1)
+        if whole_texts:
+            text_ends = [end for _, end in self.text_ranges()]
+        ranges = []
+        start = 0
+        for i in xrange(1, n + 1):
+            end = self.find_sentence(total * i // n - 1) + 1 if i < n else \
+                self.n_sentences
+            if whole_texts:
+                end = text_ends[bisect_left(text_ends, end)]
+            end = min(end, self.n_sentences)
+            if end > start:
+                ranges.append((start, end))
+                start = end
+        return ranges
+
+    def close(self):
+        self.data.close()
+
+def read_lines(corpus_file, b_start, b_end):
+    '''Yields the lines of corpus_file within the byte range [b_start, b_end)'''
+    with open(corpus_file, 'rb') as f:
+        f.seek(b_start)
+        offset = b_start
+        while offset < b_end:
+            line = f.readline()
+            if not line:
+                break
+            offset += len(line)
+            yield line
+
+def open_sentence_range(corpus_file, start, end, separator='s',
+                        to_lower=False, lexicon=None, index=None,
+                        line_filter=None):
+    '''
+    Returns a DPCorpusReader over the sentences [start, end) of corpus_file,
+    which must have been indexed (see build_sentence_index)
+    '''
+    close_index = index is None
+    if close_index:
+        index = SentenceIndex(corpus_file)
+    b_start, b_end = index.get_span(start, end)
+    if close_index:
+        index.close()
+    return DPCorpusReader(read_lines(corpus_file, b_start, b_end),
+        separator=separator, to_lower=to_lower, lexicon=lexicon,
+        line_filter=line_filter)
+
+def open_sentences(corpus_file, sentence_ids, separator='s', to_lower=False,
+                   lexicon=None, index=None):
+    '''
+    Returns a DPCorpusReader over the given sentences of corpus_file (a
+    sorted sequence of sentence numbers), which must have been indexed (see
+    build_sentence_index). Consecutive sentences are read in one go.
+    '''
+    def lines():
+        sentence_index = SentenceIndex(corpus_file) if index is None else \
+            index
+        try:
+            with open(corpus_file, 'rb') as f:
+                for _, group in groupby(enumerate(sentence_ids),
+                    lambda (j, k): k - j):
+                    group = list(group)
+                    b_start, b_end = sentence_index.get_span(group[0][1],
+                        group[-1][1] + 1)
+                    f.seek(b_start)
+                    offset = b_start
+                    while offset < b_end:
+                        line = f.readline()
+                        if not line:
+                            break
+                        offset += len(line)
+                        yield line
+        finally:
+            if index is None:
+                sentence_index.close()
+    return DPCorpusReader(lines(), separator=separator, to_lower=to_lower,
+        lexicon=lexicon)
+
+def ensure_sentence_index(corpus_file, separator='s'):
+    '''Builds the index of corpus_file unless it is already up to date'''
+    index_file = get_index_filename(corpus_file)
+    if os.path.exists(index_file) and \
+        os.path.getmtime(index_file) >= os.path.getmtime(corpus_file):
+        index = SentenceIndex(corpus_file, index_file)
+        up_to_date = index.separator == separator
+        index.close()
+        if up_to_date:
+            return index_file
+    return build_sentence_index(corpus_file, separator, index_file)
+
+def split_corpus(corpus_file, parts, separator='s', whole_texts=False):
+    '''
+    Returns the (at most) parts sentence ranges of balanced size in which
+    corpus_file can be read (indexing it if needed), or [None] (the whole
+    file) if it cannot be split, because it is compressed, the standard
+    input or has no sentences
+    '''
+    if parts <= 1 or corpus_file == '-' or \
+        get_compression(corpus_file) is not None:
+        return [None]
+    ensure_sentence_index(corpus_file, separator)
+    index = SentenceIndex(corpus_file)
+    try:
+        return index.balanced_ranges(parts, whole_texts) or [None]
+    finally:
+        index.close()
@@ -7,18 +7,118 @@ sentence: a list of sentences where each token is represented as a tuple contain
 formatted identifier to output when it's context)
 and plain_text_sentence: a list of lines as read from a parsed corpus file. 
 '''
-import fileinput
+import os
 import re
+import sre_constants
+import sre_parse
+from itertools import izip
 from functools import partial
-from itertools import repeat
 import logging
 
-def load_words(filename):
+from corputils.core.readers import Token, get_formatter
+
+#first character used as a symbol by PeripheralLinearBigramMatcher (the CJK
+#ideographs, which have no case)
+SYMBOLS_BASE = 0x4E00
+#maximum number of types whose predicates are memoized
+MAX_CACHED_TYPES = 1 << 18
+
+#word lists read by load_words: (file, lowercased) -> (mtime, words)
+_word_lists = {}
+
+def load_words(filename, lower=False):
+    '''
+    Returns the set of words (one per line) in filename, lowercased if lower
+    is True. The lists are cached, so each file is only read once per process
+    (unless it is modified)
+    '''
+    key = (os.path.abspath(filename), lower)
+    mtime = os.path.getmtime(filename)
+    try:
+        cached_mtime, pivots = _word_lists[key]
+        if cached_mtime == mtime:
+            return pivots
+    except KeyError:
+        pass
     pivots = set()
-    for line in fileinput.input(filename):
-        pivots.add(line.strip(' \t\n'))
+    with open(filename) as f:
+        for line in f:
+            word = line.strip(' \t\n')
+            pivots.add(word.lower() if lower else word)
+    pivots = frozenset(pivots)
+    _word_lists[key] = (mtime, pivots)
     return pivots
 
+def get_value_words(value, files=True):
+    '''
+    Returns the (lowercased) set of words a field must be equal to (or start
+    with, for regular expressions used as prefixes) to match a value: the
+    words of a file(...) value, or the alternatives of a regular expression
+    made only of literal words. Returns None for any other value
+    files: whether file(...) values are allowed
+    '''
+    if not value:
+        return None
+    file_value_expr = re.match(r"file\((.*?)\)\Z", value)
+    if file_value_expr and files:
+        return load_words(file_value_expr.group(1), lower=True)
+    words = value.split('|')
+    if any(not w or re.search(r'[][.^$*+?{}\\()]', w) for w in words):
+        return None
+    return frozenset(w.lower() for w in words)
+
+#columns on which get_required_words gives conditions
+REQUIRED_WORDS_FIELDS = ('word', 'lemma', 'pos')
+
+def get_requirements(matchers):
+    '''
+    Returns the required words (see get_required_words) of each matcher, or
+    None if some matcher gives no condition on the words of the sentences
+    '''
+    if not matchers:
+        return None
+    requirements = []
+    for matcher in matchers:
+        get_required_words = getattr(matcher, 'get_required_words', None)
+        required_words = get_required_words() if get_required_words else None
+        if not required_words:
+            return None
+        requirements.append(required_words)
+    return requirements
+
+def get_line_filter(matchers):
+    '''
+    Returns a function that takes the lines of a sentence (without its
+    markers) and returns False if none of the matchers can match it, so that
+    the sentence does not need to be parsed. Returns None if some matcher
+    gives no condition on the words of the sentence.
+    Only the word, lemma and pos columns are checked, ignoring their case.
+    '''
+    requirements = get_requirements(matchers)
+    if requirements is None:
+        return None
+    n_fields = len(REQUIRED_WORDS_FIELDS)
+    def line_filter(lines):
+        columns = [set() for _ in REQUIRED_WORDS_FIELDS]
+        for line in lines:
+            for values, v in izip(columns, line.lower().split('\t',
+                n_fields)[:n_fields]):
+                values.add(v)
+        fields = dict(izip(REQUIRED_WORDS_FIELDS, columns))
+        for required_words in requirements:
+            for field, words, prefix in required_words:
+                values = fields[field]
+                if prefix:
+                    prefixes = tuple(words)
+                    if not any(v.startswith(prefixes) for v in values):
+                        break
+                elif words.isdisjoint(values):
+                    break
+            else:
+                return True
+        return False
+    return line_filter
+
 def get_composition_matchers(args):
     '''
     Represent a list of matchers based on the specification described in args.
@@ -35,6 +135,78 @@ def get_composition_matchers(args):
         args.target_format, token_sep=args.token_sep))
     return match_funcs
 
+class FusedMatcher(object):
+    '''
+    Runs several matchers over each sentence in a single traversal of its
+    columns. The values that each matcher computes per type of token (see
+    their get_type_func) are looked up once per token in a table shared by
+    all of them, and the matchers build their matches from those values.
+    Matchers that cannot be fused (without get_type_func, or for which it
+    returns None) are run on the sentence as usual. The matches are
+    returned in the same order as running the matchers one after the other.
+    '''
+    def __init__(self, matchers):
+        self.matchers = list(matchers)
+        self.type_funcs = None
+        #type -> tuple of the values of the fused matchers
+        self.type_values = {}
+
+    def lazy_init(self):
+        if self.type_funcs is None:
+            self.type_funcs = [getattr(matcher, 'get_type_func',
+                lambda: None)() for matcher in self.matchers]
+            self.fused_funcs = [f for f in self.type_funcs if f]
+
+    def get_type_values(self, sentence):
+        '''
+        Returns, for each fused matcher, the list of the values of the tokens
+        of sentence
+        '''
+        columns = sentence.columns
+        type_funcs = self.fused_funcs
+        table = self.type_values
+        values = []
+        for i, key in enumerate(izip(columns['word'], columns['lemma'],
+            columns['pos'])):
+            try:
+                values.append(table[key])
+            except KeyError:
+                if len(table) >= MAX_CACHED_TYPES:
+                    table.clear()
+                value = table[key] = tuple([f(sentence, i) for f in
+                    type_funcs])
+                values.append(value)
+        if not values:
+            return [[] for _ in type_funcs]
+        return zip(*values)
+
+    def get_matches(self, sentence):
+        self.lazy_init()
+        type_values = iter(self.get_type_values(sentence)) if \
+            self.fused_funcs else None
+        for matcher, type_func in izip(self.matchers, self.type_funcs):
+            if type_func:
+                matches = matcher.get_matches(sentence, next(type_values))
+            else:
+                matches = matcher.get_matches(sentence)
+            for match in matches:
+                yield match
+
+    def get_block_matches(self, block):
+        return [(k, match) for k, sentence in enumerate(block.sentences)
+            for match in self.get_matches(sentence)]
+
+def get_block_matches(matcher, block):
+    '''
+    Returns the list of (sentence index, match) of a matcher over all the
+    sentences of a SentenceBlock, in order
+    '''
+    block_matcher = getattr(matcher, 'get_block_matches', None)
+    if block_matcher:
+        return block_matcher(block)
+    return [(k, match) for k, sentence in enumerate(block.sentences)
+            for match in matcher.get_matches(sentence)]
+
 class Match(object):
     '''
     represents a subset of a sentence.
@@ -88,74 +260,247 @@ class UnigramMatcher():
     def get_matches(self, sentence):
         for token in sentence:
             yield Match((token,))
+
+    def get_block_matches(self, block):
+        matches = []
+        for k, sentence in enumerate(block.sentences):
+            matches.extend((k, Match((Token(sentence, i),))) for i in
+                xrange(len(sentence)))
+        return matches
             
 
 class PeripheralLinearBigramMatcher():
     '''Match phrases based on a pseudo-regular expression.
     Each token is represented with a T<> marker which can 
     take as optional arguments "word" and "pos". 
-    E.g. T<word=big,pos=JJ>(T<pos=JJ>)*T<word=file(rows.txt),pos=NN|NNS>'''
+    E.g. T<word=big,pos=JJ>(T<pos=JJ>)*T<word=file(rows.txt),pos=NN|NNS>
+
+    The expression is compiled into an automaton over tokens: each T<>
+    marker becomes a predicate over the columns of a token, every token
+    of a sentence is mapped to one symbol that encodes which predicates it
+    satisfies, and the markers are replaced by the classes of symbols that
+    satisfy them. The expression is then run over the sequence of symbols
+    (one per token) in a single scan.'''
 
     def __init__(self, linear_comp, ignore_case=False, token_sep='<-->'):
         if not linear_comp:
             self.linear_comp_match = None
         self.token_sep = token_sep
-        def token_expr(expr):
-            '''Auxiliary function that returns a regular expression
-            that matches tokens in the corpus the specification
-            inside a T<> expression'''
-            ret_exprs = list(repeat(r"[^\t\|]*", 6))
-            
-            def _sanitize(value):
-                return re.sub(r'(?<!\\)\.',  r'[^\\t\|]', value)
-            
-            def _aux_value_to_regexp(value):
-                '''Auxiliary function that returns a regular expression
-                for a value expression.
-                value -> literal_string
-                value -> file(filename) 
-                ''' 
-                file_value_expr = re.match("file\((.*?)\)", value)
-                if file_value_expr:
-                    value = file_value_expr.group(1) 
-                    return "|".join(load_words(value))
-                return _sanitize(value)
-            
+        self.flags = re.IGNORECASE if ignore_case else 0
+
+        def _sanitize(value):
+            return re.sub(r'(?<!\\)\.',  r'[^\\t\|]', value)
+        
+        def _aux_value_to_match_func(value):
+            '''Auxiliary function that returns a function that matches a
+            field against a value expression.
+            value -> literal_string (a regular expression)
+            value -> file(filename) (a list of words, one per line)
+            ''' 
+            file_value_expr = re.match("file\((.*?)\)", value)
+            if file_value_expr:
+                if ignore_case:
+                    words = load_words(file_value_expr.group(1), lower=True)
+                    return lambda v: v.lower() in words
+                return load_words(file_value_expr.group(1)).__contains__
+            return re.compile(r"(?:{0})\Z".format(_sanitize(value)),
+                self.flags).match
+
+        def marker_values(expr):
+            '''Auxiliary function that returns the field values that a
+            token must satisfy to match the specification inside a T<>
+            expression'''
+            field_values = {}
             for _, kw, value in re.findall(r'(([^,=]+)=([^,=]+))', expr):
-                if kw == 'pos':
-                    ret_exprs[2] = "({0})".format(_aux_value_to_regexp(value))
-                if kw == 'word':
-                    ret_exprs[0] = "({0})".format(_aux_value_to_regexp(value))
-                if kw == 'lemma':
-                    ret_exprs[1] = "({0})".format(_aux_value_to_regexp(value))
-            return '\\t'.join(ret_exprs)
-        #tokens are delimited by |
-        #print list(filter(bool,re.split(r'(T<.*?>)', linear_comp)))
-        #re.sub(r'T<(.*)>'
-        #linear_comp = r"\|".join(filter(bool,re.split(r'(T<.*?>)', linear_comp)))
-        expr = re.sub(r'T<(.*?)>', lambda m:r"(\|{0}\|)".format(token_expr(m.group(1))), linear_comp)
-        self.expr = expr
-        self.linear_comp_match = re.compile(expr, flags=re.IGNORECASE if
-        ignore_case else 0 )
-    
-    def get_matches(self, sentence):
-        plain_text_sentence = sentence.plain_text
-        if self.linear_comp_match:
-            #we transform the sentence into a string
-            sep = "||"
-            sentence_str = "|{0}|".format(sep.join(plain_text_sentence))
-            token_lens = [len(t)+len(sep) for t in plain_text_sentence]
-            partial_sums = [sum(token_lens[:i]) for i in range(len(token_lens)+1)]
-            #token_lims = [(s,e-1) for s,e in zip(partial_sums[:-1], partial_sums[1:])] 
-            token_start2pos = {s:i for i,s in enumerate(partial_sums[:-1])}
-            token_end2pos = {e:i for i,e in enumerate(partial_sums[1:])}
+                if kw in ('word', 'lemma', 'pos'):
+                    field_values[kw] = value
+            return field_values
+
+        #the expression is split in the T<> markers (odd positions) and
+        #the regular expression operators around them (even positions)
+        parts = re.split(r'T<(.*?)>', linear_comp)
+        self.outer_exprs = parts[::2]
+        self.marker_values = [marker_values(expr) for expr in parts[1::2]]
+        #(field, match function) that a token must satisfy for each marker
+        self.predicates = [[(kw, _aux_value_to_match_func(value)) for kw,
+            value in sorted(values.iteritems())] for values in
+            self.marker_values]
+        #bitmask of the markers that every match contains
+        self.required_markers = sum(1 << j for j in
+            self._get_required_markers())
+        #symbol of each combination of satisfied predicates (as a bitmask)
+        self.symbols = {}
+        #bitmask of the predicates satisfied by each type
+        self.type_signatures = {}
+        self._compile()
+
+    def _get_required_markers(self):
+        '''
+        Returns the indices of the T<> markers that appear in every match of
+        the expression, found by parsing it with a placeholder per marker
+        '''
+        placeholders = [unichr(SYMBOLS_BASE + j) for j in
+            xrange(len(self.predicates))]
+        expr = [self.outer_exprs[0]]
+        for placeholder, outer_expr in zip(placeholders, self.outer_exprs[1:]):
+            expr.append(placeholder)
+            expr.append(outer_expr)
+        def required(pattern):
+            markers = set()
+            for op, av in pattern:
+                if op == sre_constants.LITERAL:
+                    j = av - SYMBOLS_BASE
+                    if 0 <= j < len(placeholders):
+                        markers.add(j)
+                elif op == sre_constants.SUBPATTERN:
+                    markers |= required(av[-1])
+                elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+                    if av[0] > 0:
+                        markers |= required(av[2])
+                elif op == sre_constants.BRANCH:
+                    markers |= set.intersection(*[required(p) for p in av[1]])
+            return markers
+        return required(sre_parse.parse(u''.join(expr), re.UNICODE))
+
+    def may_match(self, sentence, signatures=None):
+        '''
+        Returns False if the sentence cannot be matched because no token
+        satisfies some of the markers that every match contains
+        signatures: the signatures of the types of the tokens (optional)
+        '''
+        required = self.required_markers
+        if not required:
+            return True
+        if signatures is None:
+            get_type_value = self.get_type_value
+            signatures = (get_type_value(sentence, i) for i in
+                xrange(len(sentence)))
+        satisfied = 0
+        for signature in signatures:
+            satisfied |= signature
+            if satisfied & required == required:
+                return True
+        return False
+
+    def get_required_words(self):
+        '''
+        Returns a list of (field, words, prefix) such that every matched
+        sentence has, for each of them, a token whose field (lowercased) is
+        equal to one of the words (see get_line_filter)
+        '''
+        required_words = []
+        for j, values in enumerate(self.marker_values):
+            if self.required_markers >> j & 1:
+                for kw, value in sorted(values.iteritems()):
+                    words = get_value_words(value)
+                    if words is not None:
+                        required_words.append((kw, words, False))
+        return required_words
+
+    def _compile(self):
+        '''Builds the regular expression over the symbols seen so far'''
+        expr = [self.outer_exprs[0]]
+        for j, outer_expr in enumerate(self.outer_exprs[1:]):
+            symbols = u''.join(symbol for signature, symbol in
+                self.symbols.iteritems() if signature >> j & 1)
+            expr.append(u"(?:[{0}])".format(symbols) if symbols else u"(?!)")
+            expr.append(outer_expr)
+        self.expr = u''.join(expr)
+        self.linear_comp_match = re.compile(self.expr, re.UNICODE)
+
+    def _get_symbol(self, signature):
+        try:
+            return self.symbols[signature]
+        except KeyError:
+            symbol = self.symbols[signature] = unichr(SYMBOLS_BASE +
+                len(self.symbols))
+            self._compile()
+            return symbol
+
+    def _get_type_signature(self, word, lemma, pos):
+        key = (word, lemma, pos)
+        try:
+            return self.type_signatures[key]
+        except KeyError:
+            values = {'word': word, 'lemma': lemma, 'pos': pos}
+            signature = 0
+            for j, predicate in enumerate(self.predicates):
+                if all(match(values[kw]) for kw, match in predicate):
+                    signature |= 1 << j
+            if len(self.type_signatures) >= MAX_CACHED_TYPES:
+                self.type_signatures.clear()
+            self.type_signatures[key] = signature
+            return signature
+
+    def get_type_value(self, sentence, i):
+        '''Returns the signature of the type of the i-th token'''
+        if sentence.to_lower:
+            #patterns are matched against the lines as they are in the
+            #corpus, not against the lowercased columns
+            fields = sentence.plain_text[i].split('\t', 3)
+            if len(fields) < 3:
+                return 0
+            word, lemma, pos = fields[:3]
+        else:
+            columns = sentence.columns
+            word, lemma, pos = columns['word'][i], columns['lemma'][i], \
+                columns['pos'][i]
+            if word is None or lemma is None or pos is None:
+                return 0
+        return self._get_type_signature(word, lemma, pos)
+
+    def get_type_func(self):
+        return self.get_type_value
+
+    def _get_malformed(self, sentence):
+        '''
+        Returns the positions of the tokens that cannot be matched, because
+        their line does not have exactly the fields of the corpus format or
+        some field contains "|"
+        '''
+        n_tabs = len(sentence.corp_format) - 1
+        return [i for i, line in enumerate(sentence.plain_text) if
+            line.count('\t') != n_tabs or '|' in line]
+
+    def get_symbols(self, sentence, signatures=None):
+        '''
+        Returns the string of symbols of the tokens of sentence
+        signatures: the signatures of the types of the tokens (optional)
+        '''
+        if signatures is None:
+            get_type_value = self.get_type_value
+            signatures = [get_type_value(sentence, i) for i in
+                xrange(len(sentence))]
+        else:
+            signatures = list(signatures)
+        #only well formed tokens can match
+        for i in self._get_malformed(sentence):
+            signatures[i] = 0
+        get_symbol = self._get_symbol
+        return u''.join([get_symbol(signature) for signature in signatures])
+
+    def get_matches(self, sentence, type_values=None):
+        '''
+        type_values: the signatures of the types of the tokens, if already
+        computed (see FusedMatcher)
+        '''
+        if sentence.to_lower:
+            #the fused values are per lowercased type (see get_type_value)
+            type_values = None
+        if self.linear_comp_match and self.may_match(sentence, type_values):
+            #the symbols are computed first, since new symbols recompile the
+            #expression
+            symbols = self.get_symbols(sentence, type_values)
             #for each match of the pseudo-regexp in the sentence
-            for i,m in enumerate(self.linear_comp_match.finditer(sentence_str)):
+            for m in self.linear_comp_match.finditer(symbols):
                 #obtain the matched tokens
-                left_match_pos = token_start2pos[m.start(0)]
-                right_match_pos = token_end2pos[m.end(0)]
-                yield Match(tuple(sentence.linear()[left_match_pos:right_match_pos+1]), 
-                            token_sep=self.token_sep)
+                if m.end(0) > m.start(0):
+                    yield Match(tuple(sentence.linear()[m.start(0):m.end(0)]), 
+                                token_sep=self.token_sep)
+
+    def get_block_matches(self, block):
+        return [(k, match) for k, sentence in enumerate(block.sentences)
+            for match in self.get_matches(sentence)]
 
 class PeripheralDependencyBigramMatcher():
     def __init__(self, deprel, depword, deplemma, deppos, depfile, headword, headlemma, 
@@ -175,22 +520,119 @@ class PeripheralDependencyBigramMatcher():
         self.filefmt = filefmt
         self.dep_comp_match = None
         self.head_comp_match = None
+        #results of the predicates, by type (and by relation for deprel)
+        self.deprel_table = {}
+        #number of predicate evaluations and how many were found in the
+        #tables
+        self.lookups = 0
+        self.hits = 0
 
     def lazy_init(self):
         if not self.dep_comp_match:
-            self.dep_comp_match = \
+            self.dep_match_at, self.dep_by_type = self._build_type_match_func(
             self._build_composition_match_func(self.depword, self.deplemma, 
-            self.deppos, self.depfile, self.filefmt)
-            self.head_comp_match =\
+            self.deppos, self.depfile, self.filefmt), self.depfile)
+            self.head_match_at, self.head_by_type = \
+            self._build_type_match_func(
             self._build_composition_match_func(self.headword, self.headlemma,
-            self.headpos, self.headfile, self.filefmt)
+            self.headpos, self.headfile, self.filefmt), self.headfile)
+            dep_match_at = self.dep_match_at
+            head_match_at = self.head_match_at
+            self.dep_comp_match = lambda t: dep_match_at(t.chunk, t.i)
+            self.head_comp_match = lambda t: head_match_at(t.chunk, t.i)
+            #sides of the arc with some selection criteria
+            self.dep_selective = any((self.depword, self.deplemma,
+                self.deppos, self.depfile))
+            self.head_selective = any((self.headword, self.headlemma,
+                self.headpos, self.headfile))
         
+    def _build_type_match_func(self, match_func, wordset_file):
+        '''
+        Returns a function of (sentence, i) equivalent to match_func that
+        evaluates it once per type (word, lemma, pos) and then looks the
+        result up in a bounded table, and whether it could be memoized
+        '''
+        if wordset_file and not get_formatter(self.filefmt).by_type:
+            #the selection depends on fields that are not part of the type
+            return lambda sentence, i: match_func(Token(sentence, i)), False
+        table = {}
+        def type_match_func(sentence, i):
+            columns = sentence.columns
+            key = (columns['word'][i], columns['lemma'][i], columns['pos'][i])
+            self.lookups += 1
+            try:
+                result = table[key]
+                self.hits += 1
+                return result
+            except KeyError:
+                pass
+            if len(table) >= MAX_CACHED_TYPES:
+                table.clear()
+            result = table[key] = bool(match_func(Token(sentence, i)))
+            return result
+        return type_match_func, True
+
+    def may_match(self, sentence):
+        '''
+        Returns False if the sentence cannot be matched because no token
+        satisfies the dependent or the head criteria (only checked when
+        they are memoized per type)
+        '''
+        self.lazy_init()
+        for selective, by_type, match_at in (
+            (self.dep_selective, self.dep_by_type, self.dep_match_at),
+            (self.head_selective, self.head_by_type, self.head_match_at)):
+            if selective and by_type and not any(match_at(sentence, i) for
+                i in xrange(len(sentence))):
+                return False
+        return True
+
+    def get_required_words(self):
+        '''
+        Returns a list of (field, words, prefix) such that every matched
+        sentence has, for each of them, a token whose field (lowercased) is
+        equal to (or starts with, if prefix is True) one of the words (see
+        get_line_filter)
+        '''
+        required_words = []
+        file_field = re.match(r'\{(word|lemma|pos)\}\Z', self.filefmt or '')
+        for regexps, wordset_file in (
+            ((self.depword, self.deplemma, self.deppos), self.depfile),
+            ((self.headword, self.headlemma, self.headpos), self.headfile)):
+            for field, regexp in izip(('word', 'lemma', 'pos'), regexps):
+                words = get_value_words(regexp, files=False)
+                if words is not None:
+                    required_words.append((field, words, True))
+            if wordset_file and file_field:
+                required_words.append((file_field.group(1),
+                    load_words(wordset_file, lower=True), False))
+        return required_words
+
+    def match_deprel(self, dep_rel):
+        self.lookups += 1
+        try:
+            result = self.deprel_table[dep_rel]
+            self.hits += 1
+            return result
+        except KeyError:
+            pass
+        if len(self.deprel_table) >= MAX_CACHED_TYPES:
+            self.deprel_table.clear()
+        result = self.deprel_table[dep_rel] = bool(re.match(self.reprel,
+            dep_rel))
+        return result
+
+    def log_cache_stats(self):
+        if self.lookups:
+            logging.info("PeripheralDependencyBigramMatcher: {0} of {1} "
+                "predicate lookups ({2:.1%}) found in the type tables".format(
+                self.hits, self.lookups, float(self.hits) / self.lookups))
     
     def composition_target(self,  dep_t, sentence):
         '''If dep_t is a matching left node, then return
         the node which is dependent upon'''
         if self.dep_comp_match(dep_t) and dep_t['dep_id'] != '0':
-            if self.reprel and not re.match(self.reprel, dep_t['dep_rel']):
+            if self.reprel and not self.match_deprel(dep_t['dep_rel']):
                 return None
             try:
                 head_t = sentence[dep_t['dep_id']]
@@ -203,13 +645,75 @@ class PeripheralDependencyBigramMatcher():
 
         return None
 
-    def get_matches(self, sentence):
+    def get_type_func(self):
+        '''
+        Returns a function of (sentence, i) that tells whether the i-th
+        token can be a dependent and a head of the matched arcs, or None if
+        that does not only depend on the type of the token
+        '''
         self.lazy_init()
+        if not (self.dep_by_type and self.head_by_type):
+            return None
+        dep_match_at = self.dep_match_at
+        head_match_at = self.head_match_at
+        return lambda sentence, i: (dep_match_at(sentence, i),
+            head_match_at(sentence, i))
+
+    def get_matches(self, sentence, type_values=None):
+        '''
+        type_values: the values of get_type_func for each token, if already
+        computed (see FusedMatcher)
+        '''
+        if type_values is not None:
+            for match in self._get_matches_from_types(sentence, type_values):
+                yield match
+            return
+        if not self.may_match(sentence):
+            return
         for i, dep_t in enumerate(sentence): #i,t = index,tuple in sentence
             head_t = self.composition_target(dep_t, sentence)
             if head_t:
                 yield Match((dep_t,head_t), token_sep=self.token_sep)
 
+    def _get_matches_from_types(self, sentence, type_values):
+        if self.dep_selective and not any(dep for dep, _ in type_values) or \
+            self.head_selective and not any(head for _, head in type_values):
+            return
+        dep_ids = sentence.columns['dep_id']
+        dep_rels = sentence.columns['dep_rel']
+        for i, (dep, _) in enumerate(type_values):
+            #roots cannot be dependents
+            if not dep or dep_ids[i] == '0':
+                continue
+            if self.reprel and not self.match_deprel(dep_rels[i]):
+                continue
+            dep_t = Token(sentence, i)
+            try:
+                head_t = sentence[dep_ids[i]]
+            except KeyError:
+                logging.warn("Dangling reference at sentence: {0} in token {1}".format(sentence, dep_t))
+                continue
+            if type_values[head_t.i][1]:
+                yield Match((dep_t,head_t), token_sep=self.token_sep)
+
+    def get_block_matches(self, block):
+        self.lazy_init()
+        matches = []
+        for k, sentence in enumerate(block.sentences):
+            if not self.may_match(sentence):
+                continue
+            dep_ids = sentence.columns['dep_id']
+            for i in xrange(len(sentence)):
+                #roots cannot be dependents
+                if dep_ids[i] == '0':
+                    continue
+                dep_t = Token(sentence, i)
+                head_t = self.composition_target(dep_t, sentence)
+                if head_t:
+                    matches.append((k, Match((dep_t,head_t),
+                        token_sep=self.token_sep)))
+        return matches
+
     def _build_composition_match_func(self, word_regexp, lemma_regexp, pos_regexp, wordset_file, wordset_fmt):
         '''
         Returns a function that selects tokens in a DP.
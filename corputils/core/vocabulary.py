@@ -0,0 +1,254 @@
+'''
+Compiled vocabulary of a word list (one word per line, such as the target
+and context lists given to the co-occurrence counters).
+
+Word lists can have millions of entries, and reading them into sets, lists
+and dictionaries takes a long time and a lot of memory in every process.
+The compiled vocabulary is stored next to the list in a sidecar file (list +
+SUFFIX) that is memory-mapped read-only, so that its pages are shared by
+all the processes that use it:
+magic: 8 bytes
+n_words, n_slots, strings_size: little-endian int64
+offsets: n_words + 1 little-endian int64 offsets of each word in strings
+slots: n_slots little-endian int32 ids of an open-addressing (linear
+probing) hash table of the words (-1 for empty slots)
+strings: the words, concatenated
+
+The id of a word is its line number in the list (the last one, if it is
+repeated), as when the list is read into a dictionary.
+
+Each process memoizes the words it looks up (up to CACHE_SIZE) in the ids
+dictionary of the Vocabulary, so that the frequent ones are found at the
+cost of a dictionary lookup.
+'''
+import logging
+import mmap
+import os
+import struct
+import zlib
+
+SUFFIX = '.vocab'
+MAGIC = 'VOCB\x00\x00\x00\x01'
+HEADER = struct.Struct('<3q')
+OFFSET = struct.Struct('<q')
+OFFSETS = struct.Struct('<2q')
+SLOT = struct.Struct('<i')
+#number of looked up words memoized by a Vocabulary
+CACHE_SIZE = 1 << 17
+
+def get_vocabulary_filename(words_file):
+    return words_file + SUFFIX
+
+_dict_get = dict.get
+_dict_contains = dict.__contains__
+
+def _hash(word):
+    return zlib.crc32(word) & 0xffffffff
+
+def read_words(words_file):
+    '''Returns the list of the (stripped) words of a word list'''
+    with open(words_file) as f:
+        return [w.strip() for w in f]
+
+def compile_vocabulary(words):
+    '''Returns the compiled vocabulary (a string) of a list of words'''
+    n_slots = 1
+    while n_slots < 2 * len(words):
+        n_slots <<= 1
+    mask = n_slots - 1
+    slots = [-1] * n_slots
+    offsets = [0]
+    for i, word in enumerate(words):
+        offsets.append(offsets[-1] + len(word))
+        slot = _hash(word) & mask
+        while slots[slot] != -1 and words[slots[slot]] != word:
+            slot = (slot + 1) & mask
+        slots[slot] = i
+    return ''.join([MAGIC, HEADER.pack(len(words), n_slots, offsets[-1]),
+        struct.pack('<{0}q'.format(len(offsets)), *offsets),
+        struct.pack('<{0}i'.format(n_slots), *slots)] + words)
+
+def build_vocabulary(words_file, vocabulary_file=None):
+    '''
+    Compiles the word list in words_file and writes it to vocabulary_file
+    (by default, next to the list). Returns the vocabulary file.
+    '''
+    vocabulary_file = vocabulary_file or get_vocabulary_filename(words_file)
+    data = compile_vocabulary(read_words(words_file))
+    #written under another name and renamed, since other processes could be
+    #reading it at the same time
+    tmp_file = '{0}.{1}.tmp'.format(vocabulary_file, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_file, vocabulary_file)
+    logging.info("Compiled the vocabulary of {0}".format(words_file))
+    return vocabulary_file
+
+def ensure_vocabulary(words_file):
+    '''Compiles the word list in words_file unless it is already up to date'''
+    vocabulary_file = get_vocabulary_filename(words_file)
+    if os.path.exists(vocabulary_file) and \
+        os.path.getmtime(vocabulary_file) >= os.path.getmtime(words_file):
+        return vocabulary_file
+    return build_vocabulary(words_file, vocabulary_file)
+
+def open_vocabulary(words_file):
+    '''
+    Returns the Vocabulary of a word list, compiling it if needed. If the
+    compiled vocabulary cannot be written next to the list, it is kept in
+    memory.
+    '''
+    try:
+        vocabulary_file = ensure_vocabulary(words_file)
+    except (IOError, OSError):
+        logging.warning("Cannot write the vocabulary of {0}, keeping it in "
+                        "memory".format(words_file))
+        vocabulary = Vocabulary(compile_vocabulary(read_words(words_file)))
+    else:
+        with open(vocabulary_file, 'rb') as f:
+            vocabulary = Vocabulary(mmap.mmap(f.fileno(), 0,
+                access=mmap.ACCESS_READ))
+    vocabulary.words_file = words_file
+    return vocabulary
+
+class Vocabulary(object):
+    '''
+    A compiled vocabulary (see compile_vocabulary). It behaves as the list of
+    its words (by id), and its ids attribute as the dictionary of their ids.
+    '''
+    def __init__(self, data):
+        if data[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a compiled vocabulary")
+        self.data = data
+        self.words_file = None
+        self.n_words, self.n_slots, _ = HEADER.unpack_from(data, len(MAGIC))
+        self.offsets_pos = len(MAGIC) + HEADER.size
+        self.slots_pos = self.offsets_pos + (self.n_words + 1) * OFFSET.size
+        self.strings_pos = self.slots_pos + self.n_slots * SLOT.size
+        #the words looked up so far are memoized in ids, or in absent if they
+        #are not in the vocabulary
+        self.ids = VocabularyIds(self)
+        self.absent = set()
+
+    def __len__(self):
+        return self.n_words
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.n_words:
+            raise IndexError(i)
+        start, end = OFFSETS.unpack_from(self.data,
+            self.offsets_pos + i * OFFSET.size)
+        return self.data[self.strings_pos + start:self.strings_pos + end]
+
+    def __iter__(self):
+        for i in xrange(self.n_words):
+            yield self[i]
+
+    def get_id(self, word, default=None):
+        '''Returns the id of a word, or default if it is not in the vocabulary'''
+        i = _dict_get(self.ids, word)
+        if i is None:
+            if word in self.absent:
+                return default
+            i = self._lookup(word)
+        return default if i < 0 else i
+
+    def get_ids(self, words, default=None):
+        '''
+        Returns the list of the ids of several words (default for the ones
+        that are not in the vocabulary)
+        '''
+        ids = self.ids
+        absent = self.absent
+        lookup = self._lookup
+        result = []
+        for word in words:
+            i = _dict_get(ids, word)
+            if i is None:
+                i = -1 if word in absent else lookup(word)
+                if i < 0:
+                    i = default
+            result.append(i)
+        return result
+
+    def _lookup(self, word):
+        '''Finds the id of a word (-1 if it is absent) and memoizes it'''
+        i = -1
+        if self.n_words:
+            data = self.data
+            unpack_slot = SLOT.unpack_from
+            unpack_offsets = OFFSETS.unpack_from
+            slots_pos, offsets_pos = self.slots_pos, self.offsets_pos
+            strings_pos = self.strings_pos
+            slot_size, offset_size = SLOT.size, OFFSET.size
+            mask = self.n_slots - 1
+            length = len(word)
+            slot = _hash(word) & mask
+            while True:
+                i, = unpack_slot(data, slots_pos + slot * slot_size)
+                if i < 0:
+                    break
+                start, end = unpack_offsets(data, offsets_pos + i * offset_size)
+                if end - start == length and data[strings_pos + start:
+                    strings_pos + end] == word:
+                    break
+                slot = (slot + 1) & mask
+        if dict.__len__(self.ids) + len(self.absent) >= CACHE_SIZE:
+            dict.clear(self.ids)
+            self.absent.clear()
+        if i < 0:
+            self.absent.add(word)
+        else:
+            dict.__setitem__(self.ids, word, i)
+        return i
+
+    def __contains__(self, word):
+        if _dict_contains(self.ids, word):
+            return True
+        return word not in self.absent and self._lookup(word) >= 0
+
+    def __getstate__(self):
+        #processes reopen the compiled file instead of copying it
+        if self.words_file is not None and not isinstance(self.data, str):
+            return {'words_file': self.words_file}
+        return {'data': str(self.data[:]), 'words_file': self.words_file}
+
+    def __setstate__(self, state):
+        if 'data' in state:
+            self.__init__(state['data'])
+            self.words_file = state['words_file']
+        else:
+            self.__dict__.update(open_vocabulary(state['words_file']).__dict__)
+            self.ids = VocabularyIds(self)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+class VocabularyIds(dict):
+    '''
+    The (read-only) dictionary of the ids of the words of a Vocabulary. It
+    only holds the words looked up so far, and looks up the missing ones in
+    the vocabulary.
+    '''
+    def __init__(self, vocabulary):
+        dict.__init__(self)
+        self.vocabulary = vocabulary
+
+    def __missing__(self, word):
+        i = self.vocabulary.get_id(word, -1)
+        if i < 0:
+            raise KeyError(word)
+        return i
+
+    def get(self, word, default=None):
+        return self.vocabulary.get_id(word, default)
+
+    def __contains__(self, word):
+        return _dict_contains(self, word) or word in self.vocabulary
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+    def __iter__(self):
+        return iter(self.vocabulary)
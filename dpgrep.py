@@ -5,21 +5,38 @@ Created on Jun 12, 2013
 @author: german
 '''
 import argparse
-import fileinput
 
-from corputils.core.sentence_matchers import get_composition_matchers
+from itertools import islice
+from multiprocessing import Pool
+
+from corputils.core.sentence_matchers import get_composition_matchers,\
+    get_line_filter, get_requirements
 from corputils.core.readers import DPCorpusReader
-from corputils.core.aux import gziplines
-import itertools
+from corputils.core.aux import open_corpora, get_compression
+from corputils.core.compiled import CompiledCorpusReader
+from corputils.core.inverted_index import IndexedCorpusReader, check_index,\
+    get_candidate_sentences
+from corputils.core.sentence_index import SentenceIndex, open_sentence_range,\
+    open_sentences, ensure_sentence_index
 import sys
 
+#units of work in which the corpora are split for each worker process
+UNITS_PER_JOB = 4
+
 def main():
     parser = argparse.ArgumentParser(description=
     '''Prints sentences that match the given cirteria''')
     parser.add_argument('corpora', help='files with the parsed corpora',
         default="-", nargs='*')
     parser.add_argument('-z', '--gzip', action='store_true', default=False, 
-    help="Interpret corpora as gzipped files")
+    help="Interpret corpora as gzipped files (otherwise, gzip, bz2 and xz "
+    "files are detected by their extension)")
+    parser.add_argument('--compiled', action='store_true', default=False,
+    help="Interpret corpora as compiled corpora (see compile_corpus.py)")
+    parser.add_argument('--index', action='store_true', default=False,
+    help="Only read the sentences that contain the words required by the "
+    "criteria, according to the inverted index of the corpora (see "
+    "build_inverted_index.py)")
     parser.add_argument('-s', dest='separator', default='s', help="sentence "
     "separator (default=s)")
     parser.add_argument('-x', '--token_sep', default='<-->', help="token "
@@ -54,19 +71,72 @@ def main():
     parser.add_argument('--intersect', default=False, action='store_true',
         help='If a linear composition is combined with a dependency criteria, '\
         'this argument demands that they predicate about the same words')
+    parser.add_argument('--no-prefilter', default=False, action='store_true',
+        help='parse every sentence, instead of skipping the ones that do not '
+        'contain the words required by the criteria')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of worker processes. The corpora are split in files or '
+        'ranges of sentences (using their sentence index) and the matches '
+        'are printed in the corpus order')
+    parser.add_argument('-m', '--max-count', type=int, default=None,
+        help='stop after the given number of matching sentences')
+    parser.add_argument('-c', '--count', default=False, action='store_true',
+        help='only print the number of matching sentences')
 
     args = parser.parse_args()
 
     match_funcs = get_composition_matchers(args)
-    if args.gzip:
-        input_corpora = itertools.chain(*map(gziplines, args.corpora))
+    if args.jobs > 1 and '-' not in args.corpora:
+        results = grep_parallel(args, match_funcs)
     else:
-        input_corpora = fileinput.FileInput(args.corpora)
-    
-    corpus_reader = DPCorpusReader(input_corpora,
+        results = grep_units(args, match_funcs, [None])
+    n_matches = 0
+    for matched in results:
+        n_matches += 1
+        if not args.count:
+            print matched
+        if args.max_count and n_matches >= args.max_count:
+            break
+    results.close()
+    if args.count:
+        print n_matches
+
+def open_unit(args, match_funcs, unit=None):
+    '''
+    Returns a reader of the sentences of a unit of work: a ('file', corpus),
+    ('range', corpus, start, end) or ('ids', corpus, sentence_ids) tuple, or
+    None for all the corpora
+    '''
+    corpora = args.corpora if unit is None else [unit[1]]
+    if args.compiled:
+        return CompiledCorpusReader(corpora, to_lower=args.to_lower)
+    if args.index and unit is None:
+        return IndexedCorpusReader(corpora, get_requirements(match_funcs),
                                    separator=args.separator,
-                                   to_lower=args.to_lower) 
-    
+                                   to_lower=args.to_lower)
+    if unit is not None and unit[0] == 'ids':
+        return open_sentences(unit[1], unit[2], separator=args.separator,
+                              to_lower=args.to_lower)
+    line_filter = None if args.no_prefilter else \
+        get_line_filter(match_funcs)
+    if unit is not None and unit[0] == 'range':
+        _, corpus, start, end = unit
+        return open_sentence_range(corpus, start, end,
+                                   separator=args.separator,
+                                   to_lower=args.to_lower,
+                                   line_filter=line_filter)
+    input_corpora = open_corpora(corpora, gzip=args.gzip)
+
+    return DPCorpusReader(input_corpora,
+                          separator=args.separator,
+                          to_lower=args.to_lower,
+                          line_filter=line_filter)
+
+def grep_units(args, match_funcs, units):
+    '''
+    Yields the matching sentences of the units of work (see open_unit),
+    formatted for the output (or None if only counting them)
+    '''
     if not args.no_color:
         RED = '\033[91m'
         ENDC = '\033[0m'
@@ -74,33 +144,101 @@ def main():
         RED = ''
         ENDC = ''
         
-    corp_format = "\t".join(map(lambda x: "{"+x+"}", corpus_reader.corp_format))
-    for sentence in corpus_reader:
-        #detect compositions
-        #comp_matches is a set, so we don't count repetitions
-        comp_matches = set.union(*(set(match_func.get_matches(sentence))
-            for match_func in match_funcs))
-        if args.intersect:
-            tokens = []
-            for match_func in match_funcs:
-                this_matches = match_func.get_matches(sentence)
-                all_matches = [set(match.get_tokens()) for match in
-                    this_matches]
-                tokens.append(set.union(*all_matches) if all_matches else set())
-            tokens_int = set.intersection(*tokens) if tokens else None
+    for unit in units:
+        corpus_reader = open_unit(args, match_funcs, unit)
+        corp_format = "\t".join(map(lambda x: "{"+x+"}",
+            corpus_reader.corp_format))
+        for sentence in corpus_reader:
+            #detect compositions
+            #comp_matches is a set, so we don't count repetitions
+            comp_matches = set.union(*(set(match_func.get_matches(sentence))
+                for match_func in match_funcs))
+            if args.intersect:
+                tokens = []
+                for match_func in match_funcs:
+                    this_matches = match_func.get_matches(sentence)
+                    all_matches = [set(match.get_tokens()) for match in
+                        this_matches]
+                    tokens.append(set.union(*all_matches) if all_matches else set())
+                tokens_int = set.intersection(*tokens) if tokens else None
+            else:
+                tokens_int = None
+            if comp_matches and (not args.intersect or tokens_int):
+                if args.count:
+                    yield None
+                    continue
+                lines = ["<s>"]
+                #process sentence
+                for s_i in sentence: #i,t = index,tuple in sentence
+                    has_match = any((t ==s_i for match in comp_matches for t in match))
+                    if has_match:
+                        lines.append(RED + s_i.format(corp_format) + ENDC)
+                    else:
+                        lines.append(s_i.format(corp_format))
+                lines.append("</s>")
+                yield "\n".join(lines)
+
+def get_units(args, match_funcs):
+    '''
+    Splits the corpora in units of work (see open_unit) for args.jobs
+    workers: uncompressed corpora are split in ranges of sentences of
+    roughly the same size (or in chunks of the candidate sentences of their
+    inverted index), and other corpora are processed whole
+    '''
+    n_parts = args.jobs * UNITS_PER_JOB
+    requirements = get_requirements(match_funcs)
+    units = []
+    for corpus in args.corpora:
+        if args.compiled or args.gzip or get_compression(corpus):
+            units.append(('file', corpus))
+        elif args.index and requirements is not None:
+            check_index(corpus, args.separator)
+            sentence_ids = get_candidate_sentences(corpus, requirements)
+            size = max(1, -(-len(sentence_ids) // n_parts))
+            for i in xrange(0, len(sentence_ids), size):
+                units.append(('ids', corpus, sentence_ids[i:i+size]))
         else:
-            tokens_int = None
-        if comp_matches and (not args.intersect or tokens_int):
-            print "<s>"
-            #process sentence
-            for s_i in sentence: #i,t = index,tuple in sentence
-                has_match = any((t ==s_i for match in comp_matches for t in match))
-                if has_match:
-                    print RED + s_i.format(corp_format) + ENDC
-                else:
-                    print s_i.format(corp_format)
-            print "</s>"
+            ensure_sentence_index(corpus, args.separator)
+            index = SentenceIndex(corpus)
+            units.extend(('range', corpus, start, end) for start, end in
+                index.balanced_ranges(n_parts))
+            index.close()
+    return units
+
+#arguments and matchers of a worker process
+_worker = {}
+
+def _init_worker(args):
+    _worker['args'] = args
+    _worker['match_funcs'] = get_composition_matchers(args)
 
+def _grep_unit(unit):
+    '''
+    Returns the matching sentences of a unit of work (at most
+    args.max_count)
+    '''
+    args = _worker['args']
+    return list(islice(grep_units(args, _worker['match_funcs'], [unit]),
+        args.max_count))
+
+def grep_parallel(args, match_funcs):
+    '''
+    Yields the matching sentences of the corpora (see grep_units), which are
+    processed in args.jobs worker processes. The results are yielded in the
+    corpus order and the workers are stopped when the consumer stops.
+    '''
+    units = get_units(args, match_funcs)
+    pool = Pool(args.jobs, _init_worker, (args,))
+    try:
+        for matches in pool.imap(_grep_unit, units):
+            for matched in matches:
+                yield matched
+        pool.close()
+    finally:
+        #stops the workers if the results are not consumed (e.g. with
+        #--max-count)
+        pool.terminate()
+        pool.join()
 
 
 if __name__ == '__main__':
@@ -177,6 +177,19 @@ class KyotoTycoon:
     
     
     def play_script(self, name, recs, flags=0):
+        self.send_play_script(name, recs, flags)
+        
+        if flags & FLAG_NOREPLY:
+            return None
+        
+        return self.read_play_script()
+    
+    
+    def send_play_script(self, name, recs, flags=0):
+        '''
+        Sends a play_script request without waiting for its reply, so that
+        several requests can be pipelined (see read_play_script)
+        '''
         if self.socket is None:
             self._connect()
             
@@ -193,10 +206,10 @@ class KyotoTycoon:
         request[1] = struct.pack('!I', cnt)
         
         self._write(''.join(request))
-        
-        if flags & FLAG_NOREPLY:
-            return None
-            
+    
+    
+    def read_play_script(self):
+        '''Reads the reply of the oldest pending play_script request'''
         magic, = struct.unpack('!B', self._read(1))
         if magic == MB_PLAY_SCRIPT:
             recs_cnt, = struct.unpack('!I', self._read(4))
@@ -233,9 +246,10 @@ class KyotoTycoon:
         read = 0
         while read < bytecnt:
             recv = self.socket.recv(bytecnt-read)
-            if recv:
-                buf.append(recv)
-                read += len(recv)
+            if not recv:
+                raise KyotoTycoonError('Connection closed by the server')
+            buf.append(recv)
+            read += len(recv)
         
         return ''.join(buf)
 
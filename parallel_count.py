@@ -31,6 +31,13 @@ def main():
     help='output directory')
     parser.add_argument('-z', '--gzip', action='store_true', default=False, 
     help="Interpret corpora as gzipped files")
+    parser.add_argument('--compiled', action='store_true', default=False,
+    help="Interpret corpora as compiled corpora (see compile_corpus.py)")
+    parser.add_argument('--parts', type=int, default=1, help="split each "
+    "(uncompressed) corpus file in this number of jobs of balanced size, "
+    "using its sentence index (see build_sentence_index.py)")
+    parser.add_argument('--whole-texts', action='store_true', default=False,
+    help="with --parts, split the corpus files only at text boundaries")
     parser.add_argument('-w', dest='window_size', type=int, default=None)
     parser.add_argument('-s', dest='separator', default='s', help="sentence "
     "separator (default=s)")
@@ -139,7 +146,8 @@ def main():
     pipeline = CountSumPipeline( 
         os.path.join(os.getcwd(), args.output), targets_features_extractor, 
         args.corpora, args.gzip, args.target_format, args.context_format,
-        args.separator, args.to_lower)
+        args.separator, args.to_lower, args.compiled, args.parts,
+        args.whole_texts)
     pipeline.run(debug=args.debug, resume=args.resume, config=config)
 
         
@@ -3,10 +3,9 @@
 import argparse
 import sys
 import logging
-import itertools
-import fileinput
-from corputils.core.readers import DPCorpusReader
-from corputils.core.aux import gziplines
+from corputils.core.readers import DPCorpusReader, Lexicon
+from corputils.core.aux import open_corpora
+from corputils.core.compiled import CompiledCorpusReader
 logging.basicConfig(level=logging.INFO)
 
 from corputils.core.sentence_matchers import UnigramMatcher,\
@@ -22,7 +21,10 @@ def main():
     parser.add_argument('corpora', help='files with the parsed corpora',
         default="-", nargs='*')
     parser.add_argument('-z', '--gzip', action='store_true', default=False, 
-    help="Interpret corpora as gzipped files")
+    help="Interpret corpora as gzipped files (otherwise, gzip, bz2 and xz "
+    "files are detected by their extension)")
+    parser.add_argument('--compiled', action='store_true', default=False,
+    help="Interpret corpora as compiled corpora (see compile_corpus.py)")
     parser.add_argument('-w', dest='window_size', type=int, default=None)
     parser.add_argument('-s', dest='separator', default='s', help="sentence "
     "separator (default=s)")
@@ -114,20 +116,24 @@ def main():
                                                           args.context_format,
                                                           targets)
     #open corpus
-    if args.gzip:
-        input_corpora = itertools.chain(*map(gziplines, args.corpora))
+    lexicon = Lexicon()
+    if args.compiled:
+        corpus_reader = CompiledCorpusReader(args.corpora,
+                                             to_lower=args.to_lower,
+                                             lexicon=lexicon)
     else:
-        input_corpora = fileinput.FileInput(args.corpora)
-        
-    corpus_reader = DPCorpusReader(input_corpora,
-                                   separator=args.separator,
-                                   to_lower=args.to_lower)
+        input_corpora = open_corpora(args.corpora, gzip=args.gzip)
+
+        corpus_reader = DPCorpusReader(input_corpora,
+                                       separator=args.separator,
+                                       to_lower=args.to_lower,
+                                       lexicon=lexicon)
 
     targets_features_extractor.initialize()
     #print directional bigrams
-    for target, feature in targets_features_extractor(corpus_reader):
-        print "{0}\t{1}".format(target.format(args.target_format), 
-                                feature.format(args.context_format))
+    for target, feature in targets_features_extractor.value_pairs(
+        corpus_reader, encode=False):
+        print "{0}\t{1}".format(target, feature)
 
         
 
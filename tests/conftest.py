@@ -0,0 +1,59 @@
+import os
+import random
+import sys
+
+import pytest
+
+#the scripts (cooccurrence_count.py, kyototycoon.py...) are in the root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = ['big', 'red', 'car', 'house', 'runs', 'small', 'the', 'cat']
+POS = ['JJ', 'NN', 'NNS', 'VVZ', 'DT']
+
+def dp_lines(sentences):
+    '''
+    Returns the lines of a DP corpus with the given sentences (lists of
+    (word, lemma, pos) or of (word, lemma, pos, id, dep_id, dep_rel))
+    '''
+    lines = ['<text id="0">\n']
+    for sentence in sentences:
+        lines.append('<s>\n')
+        for i, token in enumerate(sentence):
+            if len(token) == 3:
+                token = tuple(token) + (str(i + 1), '0', 'NMOD')
+            lines.append('\t'.join(token) + '\n')
+        lines.append('</s>\n')
+    lines.append('</text>\n')
+    return lines
+
+def random_sentences(n, max_length=12, seed=0):
+    '''Returns n random sentences of (word, lemma, pos) tokens'''
+    rnd = random.Random(seed)
+    sentences = []
+    for _ in xrange(n):
+        sentence = []
+        for _ in xrange(rnd.randint(1, max_length)):
+            word = rnd.choice(WORDS)
+            sentence.append((word, word, rnd.choice(POS)))
+        sentences.append(sentence)
+    return sentences
+
+@pytest.fixture
+def write_corpus(tmpdir):
+    '''Writes the DP corpus of a list of sentences and returns its path'''
+    def write(sentences, name='corpus.txt'):
+        path = str(tmpdir.join(name))
+        with open(path, 'w') as f:
+            f.writelines(dp_lines(sentences))
+        return path
+    return write
+
+@pytest.fixture
+def write_words(tmpdir):
+    '''Writes a word list and returns its path'''
+    def write(words, name='words.txt'):
+        path = str(tmpdir.join(name))
+        with open(path, 'w') as f:
+            f.writelines(w + '\n' for w in words)
+        return path
+    return write
@@ -0,0 +1,95 @@
+import bz2
+import gzip
+import struct
+import threading
+import time
+import zlib
+
+import pytest
+
+from corputils.core import aux
+from corputils.core.aux import decoded_lines, get_compression, open_corpora
+
+from conftest import dp_lines, random_sentences
+
+def bgzf_member(data):
+    '''A BGZF block (a gzip member with its size in the BC extra field)'''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    block_size = 18 + len(deflated) + 8
+    return '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff' + \
+        struct.pack('<H', 6) + 'BC' + struct.pack('<HH', 2, block_size - 1) + \
+        deflated + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+def write_compressed(path, data, compression):
+    if compression == 'gzip':
+        #several members, as written by pigz or by concatenating files
+        with open(path, 'wb') as f:
+            for start in xrange(0, len(data), 5000):
+                f.write(gzip_compress(data[start:start + 5000]))
+    elif compression == 'bgzf':
+        with open(path, 'wb') as f:
+            for start in xrange(0, len(data), 3000):
+                f.write(bgzf_member(data[start:start + 3000]))
+            #end of file marker
+            f.write(bgzf_member(''))
+    elif compression == 'bz2':
+        with open(path, 'wb') as f:
+            f.write(bz2.compress(data))
+    else:
+        with open(path, 'wb') as f:
+            f.write(data)
+
+def gzip_compress(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+EXTENSIONS = {'gzip': '.gz', 'bgzf': '.bgz', 'bz2': '.bz2', None: '.txt'}
+
+@pytest.fixture
+def corpus_data():
+    return ''.join(dp_lines(random_sentences(500)))
+
+@pytest.mark.parametrize('compression', ['gzip', 'bgzf', 'bz2', None])
+@pytest.mark.parametrize('threads', [0, 1, 4])
+def test_decoded_lines(tmpdir, monkeypatch, corpus_data, compression,
+                       threads):
+    monkeypatch.setattr(aux, 'READ_SIZE', 1000)
+    path = str(tmpdir.join('corpus' + EXTENSIONS[compression]))
+    write_compressed(path, corpus_data, compression)
+    lines = corpus_data.splitlines(True)
+    assert list(open_corpora([path], threads=threads)) == lines
+    if compression == 'bgzf':
+        with gzip.open(path) as f:
+            assert f.read() == corpus_data
+
+def count_threads():
+    return threading.active_count()
+
+@pytest.mark.parametrize('compression', ['gzip', 'bgzf'])
+def test_early_close(tmpdir, monkeypatch, corpus_data, compression):
+    monkeypatch.setattr(aux, 'READ_SIZE', 100)
+    monkeypatch.setattr(aux, 'BGZF_BATCH', 1)
+    path = str(tmpdir.join('corpus' + EXTENSIONS[compression]))
+    write_compressed(path, corpus_data * 4, compression)
+    n_threads = count_threads()
+    lines = decoded_lines(path, 'gzip', threads=2)
+    assert next(lines) == corpus_data.splitlines(True)[0]
+    #the readers are blocked on their full queues
+    time.sleep(0.2)
+    assert count_threads() > n_threads
+    lines.close()
+    #the feeder is joined, the workers exit on their own
+    start = time.time()
+    while count_threads() > n_threads and time.time() - start < 5:
+        time.sleep(0.01)
+    assert count_threads() == n_threads
+
+def test_get_compression():
+    assert get_compression('corpus.txt.GZ') == 'gzip'
+    assert get_compression('corpus.bgz') == 'gzip'
+    assert get_compression('corpus.txt.bz2') == 'bz2'
+    assert get_compression('corpus.txt.xz') == 'xz'
+    #compress (LZW) files cannot be decoded by zlib
+    assert get_compression('corpus.txt.Z') is None
+    assert get_compression('corpus.txt') is None
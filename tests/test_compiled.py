@@ -0,0 +1,84 @@
+import pytest
+
+from corputils.core.compiled import CompiledCorpus, CompiledCorpusReader, \
+    compile_corpus
+from corputils.core.readers import DPCorpusReader, Lexicon
+
+from conftest import dp_lines, random_sentences
+
+def corpus_lines(n=60, seed=0):
+    '''Lines of a corpus with mixed case and missing fields'''
+    lines = dp_lines([[(w.upper() if k % 4 == 0 else w, l, p) for k, (w, l,
+        p) in enumerate(sentence)] for sentence in random_sentences(n,
+        seed=seed)])
+    #a token with only word, lemma and pos, an empty sentence and tokens
+    #after the last separator
+    lines[2:2] = ['Car\tcar\tNN\n']
+    lines[-1:] = ['<s>\n', '</s>\n', '<s>\n', 'lost\tlost\tNN\t1\t0\tROOT\n',
+        '</text>\n']
+    return lines
+
+def read_all(reader):
+    '''Returns the columns and the lines of the sentences of a reader'''
+    sentences = []
+    for sentence in reader:
+        columns = dict(sentence.columns)
+        if sentence.lexicon is not None:
+            #type ids are numbered in reading order
+            columns['type_id'] = [sentence.lexicon.get_type_data(i) for i in
+                columns['type_id']]
+        sentences.append((columns, sentence.plain_text))
+    return sentences
+
+@pytest.mark.parametrize('to_lower', [False, True])
+@pytest.mark.parametrize('lexicon', [False, True])
+def test_compiled_corpus(tmpdir, to_lower, lexicon):
+    corpora = [corpus_lines(seed=seed) for seed in (0, 1)]
+    paths = []
+    for k, lines in enumerate(corpora):
+        paths.append(str(tmpdir.join('compiled{0}'.format(k))))
+        header = compile_corpus(iter(lines), paths[-1])
+        assert header['n_sentences'] == 61
+    #the tokens after the last separator of each corpus are discarded
+    expected_lexicon = Lexicon() if lexicon else None
+    expected = sum([read_all(DPCorpusReader(iter(lines), to_lower=to_lower,
+        lexicon=expected_lexicon)) for lines in corpora], [])
+    assert len(expected) == 122
+    assert expected[0][0]['id'][0] is None
+    reader = CompiledCorpusReader(paths, to_lower=to_lower,
+        lexicon=Lexicon() if lexicon else None)
+    assert read_all(reader) == expected
+    reader = CompiledCorpusReader(paths, to_lower=to_lower)
+    blocks = list(reader.blocks(7))
+    assert [len(block) for block in blocks] == [7] * 17 + [3]
+    assert [(sentence.columns, sentence.plain_text) for block in blocks for
+        sentence in block] == sum([read_all(DPCorpusReader(iter(lines),
+        to_lower=to_lower)) for lines in corpora], [])
+    if lexicon:
+        #the values are interned in the lexicon of the reader
+        lexicon = Lexicon()
+        sentences = list(CompiledCorpusReader(paths, lexicon=lexicon))
+        for column in ('word', 'lemma', 'pos', 'dep_rel'):
+            values = [v for sentence in sentences for v in
+                sentence.columns[column]]
+            assert all(lexicon.intern(v) is v for v in values if v is not
+                None)
+
+def test_random_access(tmpdir):
+    lines = corpus_lines()
+    path = str(tmpdir.join('compiled'))
+    compile_corpus(iter(lines), path)
+    expected = read_all(DPCorpusReader(iter(lines)))
+    corpus = CompiledCorpus(path)
+    try:
+        assert len(corpus) == len(expected)
+        for k in reversed(xrange(len(corpus))):
+            sentence = corpus.get_sentence(k)
+            assert (sentence.columns, sentence.plain_text) == expected[k]
+    finally:
+        corpus.close()
+
+def test_empty_corpus(tmpdir):
+    path = str(tmpdir.join('compiled'))
+    assert compile_corpus(iter([]), path)['n_sentences'] == 0
+    assert list(CompiledCorpusReader([path])) == []
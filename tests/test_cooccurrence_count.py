@@ -0,0 +1,557 @@
+# -*- coding: utf-8 -*-
+import os
+import random
+import re
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter
+from threading import Thread
+
+import pytest
+
+import cooccurrence_count
+import kyototycoon
+from cooccurrence_count import CompactSparseCounter, MemoryBudget, \
+    RunsDestination, SparseCounter, SqliteCounts, SqliteDestination, \
+    escape_tsv, merge_runs, \
+    read_run, read_tsv, unescape_tsv, write_partitions, write_run
+
+SCRIPT = cooccurrence_count.__file__.replace('.pyc', '.py')
+WORDS = ['big-j', 'red-j', 'car-n', 'house-n', 'run-v', 'caf\xc3\xa9-n',
+    'the-d']
+
+def cooc_lines(n, seed=0):
+    '''Returns n random co-occurrence lines, with core and peripheral pivots'''
+    rnd = random.Random(seed)
+    lines = []
+    for _ in xrange(n):
+        pivot = rnd.choice(WORDS)
+        if rnd.random() < 0.3:
+            pivot = '{0}<-->{1}'.format(rnd.choice(WORDS), pivot)
+        lines.append('{0}\t{1}\n'.format(pivot, rnd.choice(WORDS)))
+    return lines
+
+def reference(lines):
+    '''Returns the expected core and peripheral counts of some lines'''
+    counts = {'core': Counter(), 'peripheral': Counter()}
+    for line in lines:
+        pivot, context = line.rstrip('\n').split('\t')
+        name = 'peripheral' if '<-->' in pivot else 'core'
+        counts[name][pivot, context] += 1
+    return counts
+
+def read_text(output_dir):
+    '''Returns the counts of a text (or runs) destination'''
+    counts = {}
+    for name in ('core', 'peripheral'):
+        counts[name] = Counter()
+        marker_file = os.path.join(output_dir, name, 'c')
+        if not os.path.exists(marker_file):
+            continue
+        with open(marker_file) as f:
+            for line in f:
+                pivot, context, c = line.rstrip('\n').split('\t')
+                counts[name][pivot, context] += int(c)
+    return counts
+
+def read_sqlite(output_dir):
+    '''Returns the counts of a sqlite destination'''
+    counts = {}
+    for name in ('core', 'peripheral'):
+        counts[name] = Counter()
+        reader = SqliteCounts(os.path.join(output_dir, name + '.db'))
+        for pivot, context, c in reader:
+            counts[name][pivot, context] += c
+        reader.close()
+    return counts
+
+@pytest.fixture
+def write_lines(tmpdir):
+    def write(lines, name='cooc.txt'):
+        path = str(tmpdir.join(name))
+        with open(path, 'w') as f:
+            f.writelines(lines)
+        return path
+    return write
+
+class MemoryDestination(object):
+    '''Destination that adds the saved counts to a Counter'''
+    def __init__(self):
+        self.counts = Counter()
+        self.saves = []
+
+    def save(self, counter):
+        n = 0
+        for marker, counts in counter.pop_coocurrences().iteritems():
+            for (w1, w2), c in counts.iteritems():
+                self.counts[w1, w2] += c
+                n += 1
+        self.saves.append(n)
+
+def add_lines(counter, lines):
+    for line in lines:
+        pivot, context = line.rstrip('\n').split('\t')
+        counter.count(pivot, 'c', context)
+
+def count_lines(counter, lines):
+    '''Counts some lines and saves what is left'''
+    add_lines(counter, lines)
+    counter.join()
+    while len(counter) > 0:
+        counter.save()
+
+def pairs(lines):
+    return Counter(tuple(line.rstrip('\n').split('\t')) for line in lines)
+
+@pytest.fixture(params=['numpy', 'dict'])
+def compact_numpy(request, monkeypatch):
+    '''Runs a test with and without numpy in CompactCounts'''
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(cooccurrence_count, 'numpy', None)
+
+@pytest.mark.parametrize('counter_type', [SparseCounter, CompactSparseCounter])
+@pytest.mark.parametrize('many,budget', [(50, None), (float('inf'), 0.5)])
+def test_counters(compact_numpy, counter_type, many, budget):
+    lines = cooc_lines(3000)
+    destination = MemoryDestination()
+    memory_budget = None
+    if budget:
+        #a fraction of the size of all the counts
+        counter = counter_type(destination, float('inf'), True)
+        add_lines(counter, lines)
+        if counter_type is CompactSparseCounter:
+            counter.reduce()
+        memory_budget = MemoryBudget(int(counter.n_bytes * budget))
+        destination = MemoryDestination()
+    counter = counter_type(destination, many, True, memory_budget)
+    count_lines(counter, lines)
+    assert destination.counts == pairs(lines)
+    assert len(destination.saves) > 2
+    if budget is None:
+        assert max(destination.saves) <= many * 9 // 8
+
+def test_compact_distinct_limit(compact_numpy, monkeypatch):
+    #the limit is on distinct pairs, not on the counted ones
+    monkeypatch.setattr(cooccurrence_count, 'MIN_BUFFER', 64)
+    lines = cooc_lines(5000)
+    distinct = len(pairs(lines))
+    destination = MemoryDestination()
+    counter = CompactSparseCounter(destination, distinct + 1, True)
+    count_lines(counter, lines)
+    assert destination.saves == [distinct]
+    assert destination.counts == pairs(lines)
+
+def test_compact_vocabulary(compact_numpy):
+    #the words of each chunk are new, so the words of all the chunks would
+    #not fit in the budget
+    rnd = random.Random(0)
+    chunks = [['{0}-{1}\t{0}-{2}\n'.format(k, rnd.randrange(30),
+        rnd.randrange(30)) for _ in xrange(300)] for k in xrange(30)]
+    counter = CompactSparseCounter(MemoryDestination(), float('inf'), True)
+    add_lines(counter, chunks[0])
+    counter.reduce()
+    memory_budget = MemoryBudget(counter.n_bytes * 3)
+    destination = MemoryDestination()
+    counter = CompactSparseCounter(destination, float('inf'), True,
+        memory_budget)
+    count_lines(counter, sum(chunks, []))
+    assert destination.counts == pairs(sum(chunks, []))
+    assert len(destination.saves) <= len(chunks)
+    assert counter.words_bytes == 0
+
+def count(*args):
+    '''Runs cooccurrence_count.py with the given arguments'''
+    subprocess.check_call([sys.executable, SCRIPT] + list(args))
+
+def wait_for(path, timeout=30):
+    start = time.time()
+    while not os.path.exists(path):
+        assert time.time() - start < timeout, 'timed out waiting for ' + path
+        time.sleep(0.05)
+
+@pytest.mark.parametrize('layout', [[], ['--sqlite-ids']])
+def test_sqlite_writer(tmpdir, write_lines, layout):
+    lines = [cooc_lines(2000, seed) for seed in (1, 2)]
+    inputs = [write_lines(part, 'cooc{0}.txt'.format(k)) for k, part in
+        enumerate(lines)]
+    address = str(tmpdir.join('writer.sock'))
+    output_dir = str(tmpdir.join('out'))
+    #the engine is sqlite without -e
+    writer = subprocess.Popen([sys.executable, SCRIPT, '--serve-sqlite',
+        address, '--clients', '2', '-m', '500', '-o', output_dir] + layout)
+    try:
+        wait_for(address)
+        for path in inputs:
+            count('--sqlite-writer', address, '-m', '300', '-o',
+                str(tmpdir.join('unused')), path)
+        assert writer.wait() == 0
+    finally:
+        if writer.poll() is None:
+            writer.kill()
+    assert read_sqlite(output_dir) == reference(lines[0] + lines[1])
+    reader = SqliteCounts(os.path.join(output_dir, 'core.db'))
+    assert reader.ids == bool(layout)
+    reader.close()
+
+def test_runs(tmpdir, monkeypatch):
+    monkeypatch.setattr(cooccurrence_count, 'MERGE_FAN_IN', 3)
+    lines = [cooc_lines(500, seed) for seed in xrange(8)]
+    run_files = []
+    for k, part in enumerate(lines):
+        items = pairs(part).items()
+        if k == 0:
+            #unicode pivots are written as utf-8
+            items = [((w1.decode('utf-8'), w2), c) for (w1, w2), c in items]
+        run_file = write_run(str(tmpdir.join('run{0}'.format(k))), items)
+        assert sorted(read_run(run_file)) == list(read_run(run_file)) == \
+            sorted(pairs(part).items())
+        run_files.append(run_file)
+    merged = list(merge_runs(run_files))
+    assert merged == sorted(pairs(sum(lines, [])).items())
+    #the counts of a pair are summed
+    destination = RunsDestination(str(tmpdir.join('out', 'core')))
+    with destination:
+        counter = SparseCounter(destination, 40, True)
+        count_lines(counter, sum(lines, []))
+        assert len(destination.runs['c']) > cooccurrence_count.MERGE_FAN_IN
+    assert not os.path.exists(destination.runs_folder)
+    with open(str(tmpdir.join('out', 'core', 'c'))) as f:
+        assert f.read() == ''.join('{0}\t{1}\t{2}\n'.format(w1, w2, c) for
+            (w1, w2), c in merged)
+
+@pytest.mark.parametrize('engine,read', [('text', read_text),
+    ('runs', read_text), ('sqlite', read_sqlite),
+    ('sqlite --sqlite-ids', read_sqlite)])
+@pytest.mark.parametrize('compact', [False, True])
+def test_destinations(tmpdir, write_lines, engine, read, compact):
+    lines = cooc_lines(3000)
+    output_dir = str(tmpdir.join('out'))
+    args = ['-e'] + engine.split() + ['-m', '50', '-o', output_dir,
+        write_lines(lines)]
+    if compact:
+        args.append('--compact')
+    count(*args)
+    assert read(output_dir) == reference(lines)
+
+@pytest.fixture(params=['upsert', 'replace'])
+def sqlite_version(request, monkeypatch):
+    '''Runs a test with the upsert and with the queries of older SQLites'''
+    if request.param == 'replace':
+        monkeypatch.setattr(cooccurrence_count.sqlite3, 'sqlite_version_info',
+            (3, 8, 0))
+    elif cooccurrence_count.sqlite3.sqlite_version_info < (3, 24, 0):
+        pytest.skip('SQLite has no upsert')
+
+@pytest.mark.parametrize('ids', [False, True])
+@pytest.mark.parametrize('context_index', [False, True])
+def test_sqlite_destination(tmpdir, sqlite_version, ids, context_index):
+    lines = cooc_lines(3000)
+    db_file = str(tmpdir.join('core.db'))
+    destination = SqliteDestination(db_file, 7, ids, context_index)
+    with destination:
+        counter = SparseCounter(destination, 40, True)
+        count_lines(counter, lines)
+    expected = pairs(lines)
+    reader = SqliteCounts(db_file)
+    try:
+        assert reader.ids == ids
+        if ids:
+            #each word has a single id
+            for table, words in (('rows', set(w1 for w1, _ in expected)),
+                ('cols', set(w2 for _, w2 in expected))):
+                rows = reader.con.execute('SELECT id, word FROM ' + table)\
+                    .fetchall()
+                assert sorted(word for _, word in rows) == sorted(words)
+                assert all(isinstance(i, (int, long)) for i, _ in rows)
+        assert Counter(dict(((w1, w2), c) for w1, w2, c in reader)) == \
+            expected
+        for w1 in WORDS:
+            assert sorted(reader.get_row(w1)) == sorted((w2, c) for (p, w2),
+                c in expected.iteritems() if p == w1)
+            assert sorted(reader.get_column(w1)) == sorted((p, c) for (p, w2),
+                c in expected.iteritems() if w2 == w1)
+            for w2 in WORDS:
+                assert reader.get(w1, w2) == expected[w1, w2]
+    finally:
+        reader.close()
+
+@pytest.mark.parametrize('option', ['--serve-sqlite', '--sqlite-writer'])
+def test_sqlite_writer_engine(tmpdir, write_lines, option):
+    path = write_lines(cooc_lines(10))
+    with pytest.raises(subprocess.CalledProcessError):
+        count(option, str(tmpdir.join('writer.sock')), '-e', 'text', '-o',
+            str(tmpdir.join('out')), path)
+
+def mysql_counts(conn, db):
+    cur = conn.cursor()
+    cur.execute('SELECT pivot, context, occurrences FROM `{0}`.c'.format(db))
+    counts = Counter(dict(((w1, w2), c) for w1, w2, c in cur.fetchall()))
+    cur.close()
+    return counts
+
+def test_mysql(tmpdir, write_lines):
+    MySQLdb = pytest.importorskip('MySQLdb')
+    try:
+        conn = MySQLdb.connect(host=cooccurrence_count.MYSQL_HOST,
+            user=cooccurrence_count.MYSQL_USER,
+            passwd=cooccurrence_count.MYSQL_PASS,
+            port=cooccurrence_count.MYSQL_PORT, charset='utf8',
+            use_unicode=False)
+    except MySQLdb.Error, ex:
+        pytest.skip('no MySQL server: {0}'.format(ex))
+    db = 'corputils_test_{0}'.format(os.getpid())
+    lines = [cooc_lines(2000, seed) for seed in (1, 2)]
+    try:
+        #the second dump adds to the counts of the first one
+        for part in lines:
+            subprocess.check_call([sys.executable, SCRIPT, '-e', 'mysql',
+                '-m', '300', '-o', db, write_lines(part)], cwd=str(tmpdir))
+        assert {'core': mysql_counts(conn, db + '_core'), 'peripheral':
+            mysql_counts(conn, db + '_peripheral')} == reference(lines[0] +
+            lines[1])
+    finally:
+        cur = conn.cursor()
+        for suffix in ('_core', '_peripheral'):
+            cur.execute('DROP SCHEMA IF EXISTS `{0}{1}`'.format(db, suffix))
+        conn.close()
+
+class FakeMySQLdb(object):
+    '''The exceptions of MySQLdb'''
+    class Error(Exception):
+        pass
+
+    class OperationalError(Error):
+        pass
+
+    class ProgrammingError(Error):
+        pass
+
+class FakeConnection(object):
+    '''Connection whose upserts fail with an access error'''
+    def cursor(self):
+        return self
+
+    def execute(self, query, args=None):
+        if query.startswith('INSERT'):
+            raise FakeMySQLdb.OperationalError(1142, 'INSERT command denied')
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+def test_mysql_errors(monkeypatch):
+    monkeypatch.setattr(cooccurrence_count, 'MySQLdb', FakeMySQLdb,
+        raising=False)
+    destination = cooccurrence_count.MySQLDestination(None, None, None, None,
+        'db', ['c'], 100, 2)
+    destination.conns = [FakeConnection(), FakeConnection()]
+    counter = SparseCounter(destination, float('inf'), True)
+    lines = cooc_lines(100)
+    add_lines(counter, lines)
+    before = set(os.listdir(tempfile.gettempdir()))
+    #the error of the merging threads is raised
+    with pytest.raises(FakeMySQLdb.OperationalError) as excinfo:
+        counter.save()
+    assert excinfo.value.args[0] == 1142
+    left = set(name for name in os.listdir(tempfile.gettempdir()) if
+        name.endswith('.tsv')) - before
+    assert len(left) == 2
+    rows = []
+    for name in left:
+        tsv_file = os.path.join(tempfile.gettempdir(), name)
+        rows.extend(read_tsv(tsv_file))
+        os.remove(tsv_file)
+    assert sorted(rows) == sorted((w1, w2, c) for (w1, w2), c in
+        pairs(lines).iteritems())
+
+class FakeKyotoServer(object):
+    '''
+    Kyoto Tycoon server (run in threads) that speaks the binary play_script
+    protocol and adds up the increments of incrementbulk.
+    mode: 'ok', 'error' (replies an error) or 'close' (closes the connection
+    instead of replying)
+    '''
+    def __init__(self, mode='ok'):
+        self.mode = mode
+        self.counts = Counter()
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        self.port = self.listener.getsockname()[1]
+        thread = Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except socket.error:
+                return
+            thread = Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        f = conn.makefile('rb')
+        try:
+            while True:
+                header = f.read(13)
+                if len(header) < 13:
+                    break
+                magic, flags, name_len, n = struct.unpack('!BIII', header)
+                assert magic == kyototycoon.MB_PLAY_SCRIPT
+                assert f.read(name_len) == 'incrementbulk'
+                for _ in xrange(n):
+                    key_len, val_len = struct.unpack('!II', f.read(8))
+                    key = f.read(key_len)
+                    self.counts[key] += int(f.read(val_len))
+                if self.mode == 'close':
+                    break
+                elif self.mode == 'error':
+                    conn.sendall(struct.pack('!B', kyototycoon.MB_ERROR))
+                else:
+                    conn.sendall(struct.pack('!BI', kyototycoon.MB_PLAY_SCRIPT,
+                        0))
+        finally:
+            f.close()
+            conn.close()
+
+    def close(self):
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.listener.close()
+
+@pytest.fixture
+def kyoto_servers(request):
+    '''Starts fake Kyoto Tycoon servers'''
+    def start(n, mode='ok'):
+        servers = [FakeKyotoServer(mode) for _ in xrange(n)]
+        for server in servers:
+            request.addfinalizer(server.close)
+        return servers
+    return start
+
+def read_kyoto(servers):
+    '''Returns the counts of the servers of a kyoto destination'''
+    counts = {'core': Counter(), 'peripheral': Counter()}
+    for server in servers:
+        for key, c in server.counts.iteritems():
+            marker, pivot, context = key.split('\t')
+            assert marker == 'c'
+            name = 'peripheral' if '<-->' in pivot else 'core'
+            counts[name][pivot, context] += c
+    return counts
+
+def test_kyoto(tmpdir, write_lines, kyoto_servers):
+    servers = kyoto_servers(2)
+    path = write_lines(cooc_lines(3000))
+    text_dir = str(tmpdir.join('text'))
+    count('-e', 'text', '-m', '50', '-o', text_dir, path)
+    count('-e', 'kyoto', '-m', '50', '--kyoto-servers', ','.join(
+        '127.0.0.1:{0}'.format(server.port) for server in servers), '-o',
+        str(tmpdir.join('unused')), path)
+    assert read_kyoto(servers) == read_text(text_dir)
+    #the keys of each pivot are in a single shard
+    for k, server in enumerate(servers):
+        assert server.counts
+        assert all(zlib.crc32(key.split('\t')[1]) % 2 == k for key in
+            server.counts)
+
+def test_kyoto_pipeline(kyoto_servers, monkeypatch):
+    monkeypatch.setattr(cooccurrence_count, 'KYOTO_PIPELINE', 3)
+    servers = kyoto_servers(2)
+    #requests sent and not read by each client
+    pending = Counter()
+    max_pending = Counter()
+    send_play_script = kyototycoon.KyotoTycoon.send_play_script
+    read_play_script = kyototycoon.KyotoTycoon.read_play_script
+    def send(shard, *args):
+        pending[shard] += 1
+        max_pending[shard] = max(max_pending[shard], pending[shard])
+        return send_play_script(shard, *args)
+    def read(shard):
+        pending[shard] -= 1
+        return read_play_script(shard)
+    monkeypatch.setattr(kyototycoon.KyotoTycoon, 'send_play_script', send)
+    monkeypatch.setattr(kyototycoon.KyotoTycoon, 'read_play_script', read)
+    lines = cooc_lines(3000)
+    destination = cooccurrence_count.KyotoDestination([('127.0.0.1',
+        server.port) for server in servers], batch_size=5)
+    with destination:
+        counter = SparseCounter(destination, 200, True)
+        count_lines(counter, lines)
+        assert not any(pending.values())
+        assert sorted(max_pending.values()) == [3, 3]
+    assert read_kyoto(servers) == reference(lines)
+
+@pytest.mark.parametrize('mode,message', [('error', 'Internal server error'),
+    ('close', 'Connection closed by the server')])
+def test_kyoto_errors(kyoto_servers, mode, message):
+    server, = kyoto_servers(1, mode)
+    destination = cooccurrence_count.KyotoDestination([('127.0.0.1',
+        server.port)])
+    with destination:
+        counter = SparseCounter(destination, float('inf'), True)
+        add_lines(counter, cooc_lines(10))
+        with pytest.raises(kyototycoon.KyotoTycoonError) as excinfo:
+            counter.save()
+    assert message in str(excinfo.value)
+
+TRICKY_WORDS = ['tab\there', 'new\nline', 'back\\slash', '\\t', '\\',
+    '\\N', 'ends\\', 'cr\rreturn', 'caf\xc3\xa9', u'na\xefve', '']
+
+def load_data_unescape(field):
+    '''How LOAD DATA (with the default FIELDS ESCAPED BY '\\') reads a field'''
+    if field == '\\N':
+        return None
+    escapes = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t',
+        'Z': '\x1a'}
+    return re.sub(r'\\(.)', lambda m: escapes.get(m.group(1), m.group(1)),
+        field)
+
+def encode(word):
+    return word.encode('utf-8') if isinstance(word, unicode) else word
+
+def test_escape_tsv():
+    for word in TRICKY_WORDS:
+        escaped = escape_tsv(word)
+        assert '\t' not in escaped and '\n' not in escaped
+        assert load_data_unescape(escaped) == encode(word)
+        assert unescape_tsv(escaped) == encode(word)
+
+@pytest.mark.parametrize('n', [1, 3])
+def test_write_partitions(n):
+    items = [((w1, w2), k) for k, (w1, w2) in enumerate((w1, w2) for w1 in
+        TRICKY_WORDS + WORDS for w2 in TRICKY_WORDS)]
+    tsv_files = write_partitions(items, n)
+    try:
+        assert len(tsv_files) == n
+        rows = []
+        for tsv_file in tsv_files:
+            partition = list(read_tsv(tsv_file))
+            #each pivot is in a single partition
+            for other in tsv_files:
+                if other != tsv_file:
+                    assert not set(w1 for w1, _, _ in partition) & \
+                        set(w1 for w1, _, _ in read_tsv(other))
+            rows.extend(partition)
+    finally:
+        for tsv_file in tsv_files:
+            os.remove(tsv_file)
+    assert sorted(rows) == sorted((encode(w1), encode(w2), c) for (w1, w2), c
+        in items)
@@ -0,0 +1,63 @@
+import random
+import subprocess
+import sys
+
+import pytest
+
+import dpgrep
+
+from conftest import POS, WORDS, dp_lines
+
+SCRIPT = dpgrep.__file__.replace('.pyc', '.py')
+QUERIES = [['-dp', 'JJ', '-hl', 'car'],
+    ['--linear_comp', 'T<pos=JJ>T<pos=NN|NNS>'],
+    ['--linear_comp', 'T<word=big>T<pos=NN>', '-dl', 'red', '--intersect']]
+
+def parsed_sentences(n, seed=0):
+    '''Returns n random sentences with random dependencies'''
+    rnd = random.Random(seed)
+    sentences = []
+    for _ in xrange(n):
+        length = rnd.randint(1, 10)
+        sentence = []
+        for i in xrange(length):
+            word = rnd.choice(WORDS)
+            sentence.append((word, word, rnd.choice(POS), str(i + 1),
+                str(rnd.randint(0, length)), rnd.choice(['NMOD', 'SBJ'])))
+        sentences.append(sentence)
+    return sentences
+
+def grep(*args):
+    return subprocess.check_output([sys.executable, SCRIPT, '--no-color'] +
+        list(args))
+
+@pytest.fixture(scope='module')
+def corpora(tmpdir_factory):
+    tmpdir = tmpdir_factory.mktemp('dpgrep')
+    paths = []
+    for seed in (0, 1):
+        path = str(tmpdir.join('corpus{0}.txt'.format(seed)))
+        with open(path, 'w') as f:
+            f.writelines(dp_lines(parsed_sentences(300, seed)))
+        subprocess.check_call([sys.executable, SCRIPT.replace('dpgrep.py',
+            'build_inverted_index.py'), path])
+        subprocess.check_call([sys.executable, SCRIPT.replace('dpgrep.py',
+            'compile_corpus.py'), path, '-o', path + '.compiled'])
+        paths.append(path)
+    return paths
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_modes(corpora, query):
+    expected = grep(*(query + corpora))
+    n_matches = expected.count('<s>\n')
+    assert n_matches > 5
+    compiled = [path + '.compiled' for path in corpora]
+    for mode in (['-j', '3'], ['--index'], ['--index', '-j', '3']):
+        assert grep(*(mode + query + corpora)) == expected
+    for mode in ([], ['-j', '3']):
+        assert grep(*(mode + ['--compiled'] + query + compiled)) == expected
+    for mode in ([], ['-j', '3'], ['--index']):
+        assert grep(*(mode + ['-c'] + query + corpora)).split() == \
+            [str(n_matches)]
+        first = grep(*(mode + ['-m', '5'] + query + corpora))
+        assert first.count('<s>\n') == 5 and expected.startswith(first)
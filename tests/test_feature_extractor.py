@@ -0,0 +1,61 @@
+import pytest
+
+from corputils.core.feature_extractor import BOWFeatureExtractor, \
+    TargetsFeaturesExtractor, TypeValues
+from corputils.core.readers import DPCorpusReader, Lexicon, read_blocks
+from corputils.core.sentence_matchers import UnigramMatcher
+
+from conftest import random_sentences
+
+def get_extractor(w, contexts=None, targets=None):
+    extractor = TargetsFeaturesExtractor([UnigramMatcher()],
+        BOWFeatureExtractor(w, contexts, '{lemma}-{cat}'), '{lemma}-{cat}',
+        '{lemma}-{cat}', {1: {1: targets} if targets else {}, 2: {}})
+    extractor.initialize()
+    return extractor
+
+def read_corpus(path):
+    '''Returns the blocks of a corpus and their lexicon'''
+    lexicon = Lexicon()
+    with open(path) as f:
+        return list(read_blocks(DPCorpusReader(f, lexicon=lexicon), 16)), \
+            lexicon
+
+@pytest.mark.parametrize('w', [None, 2])
+@pytest.mark.parametrize('encode', [True, False])
+def test_block_unigram_pairs(write_corpus, write_words, w, encode):
+    pytest.importorskip('numpy')
+    #a long sentence among short ones
+    sentences = random_sentences(40)
+    sentences.insert(7, random_sentences(1, max_length=200, seed=1)[0])
+    path = write_corpus(sentences)
+    targets = write_words(['big-j', 'car-n', 'house-n', 'cat-n'],
+        'targets.txt')
+    contexts = write_words(['big-j', 'car-n', 'the-d', 'runs-v', 'cat-n'])
+    for context_words in (None, contexts):
+        extractor = get_extractor(w, context_words, targets)
+        blocks, lexicon = read_corpus(path)
+        extractor.set_lexicon(lexicon)
+        target_values = TypeValues(lambda type_id:
+            extractor._get_unigram_value(encode, type_id), extractor.lexicon)
+        context_values = TypeValues(lambda type_id:
+            extractor.feature_extractor.get_type_value(encode, type_id),
+            extractor.lexicon)
+        for block in blocks:
+            expected = [extractor._get_sentence_unigram_pairs(
+                sentence.columns['type_id'], target_values.get_values(),
+                context_values.get_values()) for sentence in block]
+            assert extractor._get_block_unigram_pairs(block, target_values,
+                context_values) == expected
+
+@pytest.mark.parametrize('w', [None, 2])
+def test_value_pairs(write_corpus, w):
+    path = write_corpus(random_sentences(30))
+    with open(path) as f:
+        expected = [(target.format('{lemma}-{cat}'),
+            feature.format('{lemma}-{cat}')) for target, feature in
+            get_extractor(w)(DPCorpusReader(f))]
+    with open(path) as f:
+        pairs = list(get_extractor(w).value_pairs(DPCorpusReader(f,
+            lexicon=Lexicon()), encode=False))
+    assert pairs == expected
@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+from corputils.core import inverted_index
+from corputils.core.inverted_index import IndexedCorpusReader, \
+    InvertedIndex, build_inverted_index, check_index, decode_postings, \
+    encode_postings, is_index_up_to_date
+from corputils.core.readers import DPCorpusReader
+from corputils.core.sentence_index import build_sentence_index
+
+from conftest import random_sentences
+
+def test_postings():
+    ids = [0, 1, 2, 127, 128, 300, 16383, 16384, 1 << 40, (1 << 40) + 1]
+    assert decode_postings(encode_postings(ids)) == ids
+    assert decode_postings(encode_postings([])) == []
+
+def mixed_case(sentences):
+    return [[(w.upper() if k % 3 == 0 else w, l, p.lower() if k % 5 == 0
+        else p) for k, (w, l, p) in enumerate(sentence)] for sentence in
+        sentences]
+
+def reference(sentences):
+    '''Returns the sentences of each (lowercased) term of some sentences'''
+    postings = {}
+    for k, sentence in enumerate(sentences):
+        for token in sentence:
+            for field, value in zip(('word', 'lemma', 'pos'), token):
+                term = '{0}\t{1}'.format(field, value.lower())
+                postings.setdefault(term, set()).add(k)
+    return postings
+
+@pytest.fixture
+def indexed_corpus(write_corpus, monkeypatch):
+    #postings merged from several runs
+    monkeypatch.setattr(inverted_index, 'RUN_SIZE', 50)
+    sentences = mixed_case(random_sentences(300))
+    path = write_corpus(sentences)
+    build_sentence_index(path)
+    build_inverted_index(path)
+    return path, sentences
+
+def test_inverted_index(indexed_corpus):
+    path, sentences = indexed_corpus
+    expected = reference(sentences)
+    index = InvertedIndex(path)
+    try:
+        assert index.n_sentences == len(sentences)
+        assert [index[k] for k in xrange(len(index))] == sorted(expected)
+        for k in xrange(len(index)):
+            assert index.get_postings(k) == sorted(expected[index[k]])
+        assert index.find_terms('word', 'cat') == \
+            [sorted(expected).index('word\tcat')]
+        assert index.find_terms('word', 'dog') == []
+        assert [index[k] for k in index.find_terms('pos', 'nn', True)] == \
+            ['pos\tnn', 'pos\tnns']
+        assert index.get_sentences('word', ['big', 'red']) == \
+            expected['word\tbig'] | expected['word\tred']
+        #sentences with (a car or a house) and a JJ, or with a cat
+        requirements = [[('lemma', ['car', 'house'], False), ('pos', ['jj'],
+            False)], [('word', ['cat'], False)]]
+        assert index.get_candidates(requirements) == sorted(
+            (expected['lemma\tcar'] | expected['lemma\thouse']) &
+            expected['pos\tjj'] | expected['word\tcat'])
+    finally:
+        index.close()
+
+def test_indexed_reader(indexed_corpus):
+    path, sentences = indexed_corpus
+    expected = reference(sentences)
+    requirements = [[('word', ['small'], False)]]
+    with open(path) as f:
+        all_sentences = list(DPCorpusReader(f))
+    reader = IndexedCorpusReader([path], requirements)
+    assert [(s.columns, s.plain_text) for s in reader] == [(s.columns,
+        s.plain_text) for k, s in enumerate(all_sentences) if k in
+        expected['word\tsmall']]
+    assert len(list(IndexedCorpusReader([path], None))) == len(sentences)
+
+def test_index_up_to_date(indexed_corpus):
+    path, _ = indexed_corpus
+    assert is_index_up_to_date(path)
+    assert not is_index_up_to_date(path, separator='p')
+    os.utime(path, (os.path.getmtime(path) + 10,) * 2)
+    assert not is_index_up_to_date(path)
+    with pytest.raises(ValueError):
+        check_index(path)
+
+def test_long_terms(write_corpus, monkeypatch):
+    monkeypatch.setattr(inverted_index, 'RUN_SIZE', 2)
+    long_word = 'x' * 70000
+    sentences = [[('big', 'big', 'JJ'), (long_word, 'long', 'NN')], [('car',
+        'car', 'NN')], [(long_word, long_word, 'NN')]]
+    path = write_corpus(sentences)
+    build_inverted_index(path)
+    index = InvertedIndex(path)
+    try:
+        assert index.get_sentences('word', [long_word]) == set([0, 2])
+        assert index.get_sentences('lemma', [long_word]) == set([2])
+    finally:
+        index.close()
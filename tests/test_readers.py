@@ -0,0 +1,29 @@
+from corputils.core.readers import DPCorpusReader, Lexicon, Sentence
+
+from conftest import dp_lines, random_sentences
+
+CORP_FORMAT = ('word', 'lemma', 'pos', 'id', 'dep_id', 'dep_rel')
+
+def test_changed_sentence():
+    #tokens added after formatting or looking up the sentence
+    for lexicon in (None, Lexicon()):
+        sentence = Sentence(CORP_FORMAT, {}, False, lexicon)
+        sentence.push_token('big\tbig\tJJ\t1\t2\tNMOD')
+        assert sentence.format_token(0, '{lemma}-{cat}') == 'big-j'
+        assert sentence['1'].i == 0
+        sentence.push_token('car\tcar\tNN\t2\t0\tROOT')
+        assert sentence.format_token(1, '{lemma}-{cat}') == 'car-n'
+        assert sentence['2'].i == 1
+        sentence.push_columns({'word': ['red'], 'lemma': ['red'], 'pos':
+            ['JJ'], 'id': ['3'], 'dep_id': ['2'], 'dep_rel': ['NMOD']},
+            ['red\tred\tJJ\t3\t2\tNMOD'])
+        assert [sentence.format_token(i, '{lemma}-{cat}') for i in
+            xrange(3)] == ['big-j', 'car-n', 'red-j']
+        assert sentence['3'].i == 2
+
+def test_read_sentences():
+    sentences = random_sentences(20)
+    read = list(DPCorpusReader(iter(dp_lines(sentences))))
+    assert [[sentence.format_token(i, '{word}/{pos}') for i in
+        xrange(len(sentence))] for sentence in read] == [['{0}/{1}'.format(w,
+        p) for w, _, p in sentence] for sentence in sentences]
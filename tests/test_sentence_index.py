@@ -0,0 +1,85 @@
+import bz2
+
+from corputils.core import sentence_index
+from corputils.core.readers import DPCorpusReader
+from corputils.core.sentence_index import SentenceIndex, \
+    build_sentence_index, open_sentence_range, open_sentences, split_corpus
+
+from conftest import dp_lines, random_sentences
+
+def texts_corpus(write_corpus, n_texts=5, n_sentences=7):
+    '''Writes a corpus of several texts, returns it and its sentences'''
+    texts = [random_sentences(n_sentences, seed=t) for t in xrange(n_texts)]
+    lines = []
+    for sentences in texts:
+        lines.extend(dp_lines(sentences))
+    path = write_corpus([])
+    with open(path, 'w') as f:
+        f.writelines(lines)
+    return path, texts
+
+def read_words(reader):
+    return [[sentence.get_value(i, 'word') for i in xrange(len(sentence))]
+        for sentence in reader]
+
+def test_offsets(write_corpus, monkeypatch):
+    #offsets written in several chunks
+    monkeypatch.setattr(sentence_index, 'OFFSETS_CHUNK', 4)
+    path, texts = texts_corpus(write_corpus)
+    build_sentence_index(path)
+    index = SentenceIndex(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    ends = [i + len('</s>\n') for i in xrange(len(data)) if
+        data.startswith('</s>\n', i)]
+    starts = [i for i in xrange(len(data)) if data.startswith('<s>\n', i)]
+    text_starts = [i for i in xrange(len(data)) if
+        data.startswith('<text', i)]
+    assert len(index) == len(ends) == 35
+    assert index.n_texts == 5
+    assert [index.sentence_end(k) for k in xrange(len(index))] == ends
+    assert [index.sentence_start(k) for k in xrange(len(index))] == starts
+    assert [index.text_start(t) for t in xrange(index.n_texts)] == \
+        text_starts
+    assert index.text_ranges() == [(7 * t, 7 * (t + 1)) for t in xrange(5)]
+    assert [index.find_text(k) for k in xrange(len(index))] == \
+        [k // 7 for k in xrange(35)]
+    index.close()
+
+def test_sentence_ranges(write_corpus):
+    path, texts = texts_corpus(write_corpus)
+    with open(path) as f:
+        words = read_words(DPCorpusReader(f))
+    build_sentence_index(path)
+    index = SentenceIndex(path)
+    for n in (1, 2, 3, 8, 50):
+        for whole_texts in (False, True):
+            ranges = index.balanced_ranges(n, whole_texts)
+            assert ranges[0][0] == 0 and ranges[-1][1] == len(index)
+            assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+            if whole_texts:
+                assert all(end % 7 == 0 for _, end in ranges)
+            read = []
+            for start, end in ranges:
+                read.extend(read_words(open_sentence_range(path, start, end,
+                    index=index)))
+            assert read == words
+    assert read_words(open_sentences(path, [0, 1, 2, 9, 20, 21])) == \
+        [words[k] for k in [0, 1, 2, 9, 20, 21]]
+    index.close()
+
+def test_split_corpus(write_corpus, tmpdir):
+    path, _ = texts_corpus(write_corpus)
+    ranges = split_corpus(path, 3)
+    assert len(ranges) == 3 and ranges[-1][1] == 35
+    assert split_corpus(path, 1) == [None]
+    #compressed corpora are read whole, whatever their contents
+    compressed = str(tmpdir.join('corpus.txt.bz2'))
+    with open(path) as f:
+        data = f.read()
+    with open(compressed, 'wb') as f:
+        f.write(bz2.compress(data))
+    assert split_corpus(compressed, 3) == [None]
+    #as are the corpora without sentences
+    empty = write_corpus([], 'empty.txt')
+    assert split_corpus(empty, 3) == [None]
@@ -0,0 +1,38 @@
+import pytest
+
+from corputils.core.readers import DPCorpusReader, Lexicon
+from corputils.core.sentence_matchers import FusedMatcher, \
+    PeripheralLinearBigramMatcher, UnigramMatcher
+
+from conftest import dp_lines
+
+SENTENCE = [('Big', 'big', 'JJ'), ('Car', 'car', 'NN'), ('big', 'big', 'JJ'),
+    ('house', 'house', 'NN'), ('big', 'big', 'JJ'), ('cat', 'cat', 'NN'),
+    ('BIG', 'Big', 'JJ'), ('Dog', 'dog', 'NN')]
+
+def read_sentence(to_lower, lexicon):
+    lines = dp_lines([SENTENCE])
+    #a line with an extra column cannot be matched
+    lines[5] = lines[5].rstrip('\n') + '\textra\n'
+    return next(DPCorpusReader(iter(lines), to_lower=to_lower,
+        lexicon=lexicon))
+
+def match_positions(matcher, sentence):
+    return [tuple(t.i for t in match.tokens) for match in
+        matcher.get_matches(sentence) if len(match.tokens) > 1]
+
+@pytest.mark.parametrize('to_lower', [False, True])
+@pytest.mark.parametrize('lexicon', [None, Lexicon()])
+@pytest.mark.parametrize('fused', [False, True])
+@pytest.mark.parametrize('ignore_case,expected', [
+    (False, [(4, 5)]),
+    (True, [(0, 1), (4, 5), (6, 7)])])
+def test_linear_matches(to_lower, lexicon, fused, ignore_case, expected):
+    matcher = PeripheralLinearBigramMatcher('T<word=big>T<pos=NN>',
+        ignore_case=ignore_case)
+    if fused:
+        matcher = FusedMatcher([UnigramMatcher(), matcher])
+    #the lowercased columns do not change what is matched
+    for _ in xrange(2):
+        assert match_positions(matcher, read_sentence(to_lower, lexicon)) == \
+            expected
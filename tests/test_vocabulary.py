@@ -0,0 +1,70 @@
+import os
+import pickle
+
+import pytest
+
+from corputils.core import vocabulary as vocabulary_module
+from corputils.core.vocabulary import Vocabulary, compile_vocabulary, \
+    get_vocabulary_filename, open_vocabulary
+
+WORDS = ['big-j', 'car-n', 'red-j', 'house-n', 'car-n', '', 'caf\xc3\xa9-n',
+    'a\tb']
+ABSENT = ['cat-n', 'big', 'big-j ', 'car-n\n', 'x' * 100]
+
+def expected_ids(words):
+    #the last line of a repeated word
+    return dict((w, i) for i, w in enumerate(words))
+
+def check_vocabulary(vocabulary, words):
+    ids = expected_ids(words)
+    assert len(vocabulary) == len(words)
+    assert list(vocabulary) == words
+    assert [vocabulary[i] for i in xrange(len(words))] == words
+    #twice, to go through the memoized ids
+    for _ in xrange(2):
+        for word, i in ids.iteritems():
+            assert word in vocabulary and word in vocabulary.ids
+            assert vocabulary.get_id(word) == i
+            assert vocabulary.ids[word] == i
+            assert vocabulary.ids.get(word) == i
+        for word in ABSENT:
+            assert word not in vocabulary and word not in vocabulary.ids
+            assert vocabulary.get_id(word, -1) == -1
+            assert vocabulary.ids.get(word) is None
+            with pytest.raises(KeyError):
+                vocabulary.ids[word]
+        assert vocabulary.get_ids(ABSENT + list(ids)) == [None] * \
+            len(ABSENT) + list(ids.values())
+    with pytest.raises(IndexError):
+        vocabulary[len(words)]
+
+@pytest.mark.parametrize('words', [WORDS, [], ['w{0}'.format(i) for i in
+    xrange(5000)]])
+def test_compiled_vocabulary(words):
+    check_vocabulary(Vocabulary(compile_vocabulary(words)), words)
+
+def test_cache_size(monkeypatch):
+    monkeypatch.setattr(vocabulary_module, 'CACHE_SIZE', 3)
+    vocabulary = Vocabulary(compile_vocabulary(WORDS))
+    check_vocabulary(vocabulary, WORDS)
+    assert dict.__len__(vocabulary.ids) + len(vocabulary.absent) <= 3
+
+def test_open_vocabulary(tmpdir, write_words):
+    path = write_words(WORDS)
+    vocabulary = open_vocabulary(path)
+    assert os.path.exists(get_vocabulary_filename(path))
+    check_vocabulary(vocabulary, WORDS)
+    #processes reopen the file
+    state = vocabulary.__getstate__()
+    assert 'data' not in state
+    check_vocabulary(pickle.loads(pickle.dumps(vocabulary, 2)), WORDS)
+    check_vocabulary(pickle.loads(pickle.dumps(vocabulary.ids))
+        .vocabulary, WORDS)
+    vocabulary.close()
+    #the list is recompiled when it changes
+    words = WORDS + ['new-n']
+    write_words(words)
+    os.utime(path, (os.path.getmtime(path) + 10,) * 2)
+    check_vocabulary(open_vocabulary(path), words)
+    with pytest.raises(ValueError):
+        Vocabulary('not a vocabulary')